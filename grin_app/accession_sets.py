@@ -0,0 +1,54 @@
+"""
+An in-process LRU of search result sets, so the evaluation views can
+accept a short handle for the accessions of a previous search, instead
+of the client posting the full list of accession ids again.
+
+usage:
+
+handle = accession_sets.register(['PI 123', 'PI 456'])
+...
+accession_ids = accession_sets.lookup(handle)  # None if expired/evicted
+
+The sets live only in the memory of one worker process, so a lookup can
+miss when another worker handles the request; clients should fall back
+to sending the accession_ids in that case.
+"""
+
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+
+MAX_SETS = getattr(settings, 'ACCESSION_SET_MAX', 256)
+TTL = getattr(settings, 'ACCESSION_SET_TTL', 600)  # seconds
+
+_sets = OrderedDict()
+_lock = threading.Lock()
+
+
+def register(accession_ids):
+    """Store the accession ids and return a new handle for them."""
+    handle = uuid.uuid4().hex
+    with _lock:
+        _sets[handle] = (time.time() + TTL, list(accession_ids))
+        while len(_sets) > MAX_SETS:
+            _sets.popitem(last=False)
+    return handle
+
+
+def lookup(handle):
+    """Return the accession ids for the handle, or None if the handle is
+    unknown or expired.
+    """
+    with _lock:
+        entry = _sets.get(handle, None)
+        if entry is None:
+            return None
+        expires, accession_ids = entry
+        if expires < time.time():
+            del _sets[handle]
+            return None
+        _sets.move_to_end(handle)
+        return accession_ids
@@ -0,0 +1,16 @@
+import os
+
+from django.apps import AppConfig
+from django.conf import settings
+
+
+class GrinAppConfig(AppConfig):
+    name = 'grin_app'
+
+    def ready(self):
+        # open the search index snapshot (if configured and built) when
+        # the worker starts, instead of on the first search.
+        from grin_app import search_index
+        path = getattr(settings, 'SEARCH_INDEX_PATH', None)
+        if path and os.path.exists(path):
+            search_index.get_index()
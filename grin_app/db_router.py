@@ -0,0 +1,91 @@
+"""
+Route the read-only views to the replica databases, falling back to the
+primary ('default') when no replica is configured, reachable, or caught
+up to within settings.REPLICA_MAX_LAG seconds.
+
+The views run raw SQL, so sql_metrics.instrumented picks the database
+with read_alias() once per request, and sql_metrics.cursor() uses it.
+The ReplicaRouter applies the same choice to any ORM queries, and is
+enabled in settings.DATABASE_ROUTERS. Outside of the views (management
+commands, scripts) queries go to the primary.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+REPLICAS = getattr(settings, 'REPLICA_DATABASES', [])
+MAX_LAG = getattr(settings, 'REPLICA_MAX_LAG', 30)  # seconds
+LAG_CHECK_INTERVAL = getattr(settings, 'REPLICA_LAG_CHECK_INTERVAL', 5)
+# replication lag in seconds, 0 when the replica has replayed all it
+# received (or is not a standby at all)
+LAG_SQL = '''
+SELECT COALESCE(
+ CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+ ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+ END, 0)
+'''
+
+logger = logging.getLogger(__name__)
+
+_checked = {}  # alias -> (time checked, healthy)
+_lock = threading.Lock()
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        return read_alias()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == DEFAULT_DB_ALIAS
+
+
+def read_alias():
+    """Return the alias of a random healthy replica, or the primary."""
+    healthy = [alias for alias in REPLICAS if _healthy(alias)]
+    if not healthy:
+        return DEFAULT_DB_ALIAS
+    return random.choice(healthy)
+
+
+def available(alias):
+    """True if the alias is the primary, or a healthy replica."""
+    if alias == DEFAULT_DB_ALIAS:
+        return True
+    return alias in REPLICAS and _healthy(alias)
+
+
+def _healthy(alias):
+    """True if the replica answered the lag query, with a lag under
+    MAX_LAG, within the last LAG_CHECK_INTERVAL seconds.
+    """
+    now = time.time()
+    with _lock:
+        checked = _checked.get(alias, None)
+    if checked is not None and now - checked[0] < LAG_CHECK_INTERVAL:
+        return checked[1]
+    try:
+        cursor = connections[alias].cursor()
+        cursor.execute(LAG_SQL)
+        lag = float(cursor.fetchone()[0])
+        healthy = lag <= MAX_LAG
+        if not healthy:
+            logger.warning('replica %s lags by %.1f seconds', alias, lag)
+    except DatabaseError as e:
+        logger.warning('replica %s unavailable: %s', alias, e)
+        connections[alias].close()
+        healthy = False
+    with _lock:
+        _checked[alias] = (now, healthy)
+    return healthy
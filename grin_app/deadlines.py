@@ -0,0 +1,182 @@
+"""
+Bound the SQL time of the views with a per view postgres
+statement_timeout, and cancel a view's queries when a newer request for
+the same view arrives from the same browser (e.g. the user panned the
+map again before the previous search finished).
+
+usage as decorator, inside sql_metrics.instrumented:
+
+@sql_metrics.instrumented
+@deadlines.bounded(fallback=cheaper_view)
+def viewname(request):
+    ...
+
+The timeouts are in settings.STATEMENT_TIMEOUTS, in milliseconds by
+view name, with a 'default' (0 is none). When a query hits the timeout,
+the view's fallback is called instead (it runs under the same timeout),
+e.g. for a truncated result flagged as partial. Without a fallback, or if the
+fallback times out too, the response is a 503. A superseded request
+gets a 409 (superseded() tells the two apart inside the view, see
+single_flight).
+
+The timeout is only set on the request's connection when it differs
+from the one last set there, and is left set after the request, so
+requests on persistent connections (settings CONN_MAX_AGE) don't pay
+round trips for it. So all the views querying the database must be
+bounded.
+
+Browsers are identified by their CSRF cookie. The running requests are
+tracked per worker process, so only a newer request handled by the same
+process cancels a superseded one. The cancel is sent to the database the
+superseded request runs on (see db_router), which may not be the newer
+request's; it's skipped if that database is unavailable.
+"""
+
+import logging
+import threading
+import weakref
+
+import simplejson as json
+from django.conf import settings
+from django.db import DatabaseError, connections
+from django.db.utils import OperationalError
+from django.http import HttpResponse
+
+from grin_app import db_router, sql_metrics
+
+TIMEOUTS = getattr(settings, 'STATEMENT_TIMEOUTS', {})
+DEFAULT_TIMEOUT = TIMEOUTS.get('default', 0)  # milliseconds, 0 is none
+QUERY_CANCELED = '57014'  # postgres error code
+
+logger = logging.getLogger(__name__)
+
+_running = {}
+# the statement_timeout last set on each (DB-API) connection
+_timeouts = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+_current = threading.local()
+
+
+class _Request(object):
+    """A running request, with the database alias and postgres backend
+    executing its queries.
+    """
+
+    def __init__(self, alias, backend_pid):
+        self.alias = alias
+        self.backend_pid = backend_pid
+        self.superseded = False
+
+
+def bounded(fallback=None):
+    def decorator(view):
+        timeout = TIMEOUTS.get(view.__name__, DEFAULT_TIMEOUT)
+
+        def wrapper(request, *args, **kwargs):
+            running = _Request(sql_metrics.alias(), _set_timeout(timeout))
+            client = request.COOKIES.get(settings.CSRF_COOKIE_NAME, None)
+            key = (view.__name__, client) if client else None
+            if key:
+                _supersede(key, running)
+            outer = getattr(_current, 'request', None)
+            _current.request = running
+            try:
+                return view(request, *args, **kwargs)
+            except OperationalError as e:
+                if not canceled(e):
+                    raise
+                if running.superseded:
+                    return _error_response('superseded by a newer request',
+                                           409)
+                return _fallback_response(fallback, request, args, kwargs)
+            finally:
+                _current.request = outer
+                if key:
+                    with _lock:
+                        if _running.get(key, None) is running:
+                            del _running[key]
+        wrapper.__name__ = view.__name__
+        wrapper.__doc__ = view.__doc__
+        return wrapper
+    return decorator
+
+
+def _set_timeout(timeout):
+    """Set the statement_timeout of the current request's connection,
+    unless it's already set, and return the connection's backend pid.
+    """
+    connection = connections[sql_metrics.alias()]
+    connection.ensure_connection()
+    dbapi_connection = connection.connection
+    with _lock:
+        current = _timeouts.get(dbapi_connection, None)
+    if current != timeout:
+        sql_metrics.cursor().execute(
+            "SELECT set_config('statement_timeout', %s, false)",
+            [str(timeout)])
+        with _lock:
+            _timeouts[dbapi_connection] = timeout
+    return dbapi_connection.get_backend_pid()
+
+
+def _supersede(key, running):
+    """Register the running request for the key, cancelling the query
+    of the previous one, if it's still running. The lock is held while
+    cancelling, so the previous request can't finish and reuse its
+    backend for another request meanwhile.
+    """
+    with _lock:
+        previous = _running.get(key, None)
+        _running[key] = running
+        if previous is not None:
+            previous.superseded = True
+            _cancel(previous)
+
+
+def _cancel(request):
+    """Cancel the request's query, on the database it runs on."""
+    if not db_router.available(request.alias):
+        logger.warning('not cancelling backend %s: %s is unavailable',
+                       request.backend_pid, request.alias)
+        return
+    try:
+        cursor = connections[request.alias].cursor()
+        cursor.execute('SELECT pg_cancel_backend(%s)', [request.backend_pid])
+    except DatabaseError as e:
+        logger.warning('cancelling backend %s on %s failed: %s',
+                       request.backend_pid, request.alias, e)
+
+
+def _fallback_response(fallback, request, args, kwargs):
+    """Return the fallback's response, flagged as degraded, or a 503."""
+    if fallback is None:
+        return _error_response('query timed out', 503)
+    try:
+        response = fallback(request, *args, **kwargs)
+    except OperationalError as e:
+        if not canceled(e):
+            raise
+        return _error_response('query timed out', 503)
+    response['X-Degraded'] = 'statement timeout'
+    return response
+
+
+def superseded():
+    """True if the current request was superseded by a newer one (as
+    opposed to timing out), e.g. after its query was canceled.
+    """
+    running = getattr(_current, 'request', None)
+    return running is not None and running.superseded
+
+
+def canceled(error):
+    """True if the database error is a canceled query (timeout or
+    pg_cancel_backend).
+    """
+    return getattr(error.__cause__, 'pgcode', None) == QUERY_CANCELED
+
+
+def _error_response(message, status):
+    content = json.dumps({'error': message})
+    return HttpResponse(content, status=status,
+                        content_type='application/json')
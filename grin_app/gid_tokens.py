@@ -0,0 +1,67 @@
+"""
+Compact tokens for a set of accession gids, so a client can send back
+the result of its previous search, and get only the differences (see
+the delta param of the search view).
+
+usage:
+
+token = gid_tokens.encode([3, 17, 12])
+gids = gid_tokens.decode(token)  # {3, 12, 17}, or None if invalid
+
+The token is the sorted gids, delta encoded as varints, zlib compressed
+and urlsafe base64 encoded, so it holds the full set, without any
+server side state, in a few hundred bytes for a typical result.
+
+Tokens come from clients, so decoding is bounded: tokens of more than
+MAX_GIDS gids (settings.MAX_LIST_LENGTH), or decompressing to more than
+MAX_TOKEN_BYTES, are invalid.
+"""
+
+import base64
+import zlib
+
+from django.conf import settings
+
+MAX_GIDS = getattr(settings, 'MAX_LIST_LENGTH', 5000)
+MAX_TOKEN_BYTES = MAX_GIDS * 5  # a 32 bit varint is up to 5 bytes
+
+
+def encode(gids):
+    """Return the token for the gids."""
+    out = bytearray()
+    previous = 0
+    for gid in sorted(set(gids)):
+        delta = gid - previous
+        previous = gid
+        while delta >= 0x80:
+            out.append((delta & 0x7f) | 0x80)
+            delta >>= 7
+        out.append(delta)
+    data = zlib.compress(bytes(out), 9)
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode(token):
+    """Return the set of gids in the token, or None if it's invalid."""
+    try:
+        padding = '=' * (-len(token) % 4)
+        decompressor = zlib.decompressobj()
+        data = bytearray(decompressor.decompress(
+            base64.urlsafe_b64decode(str(token) + padding), MAX_TOKEN_BYTES))
+    except (TypeError, ValueError, zlib.error):
+        return None
+    if decompressor.unconsumed_tail or not decompressor.eof:
+        return None  # more than MAX_TOKEN_BYTES, or truncated
+    gids = set()
+    gid = delta = shift = 0
+    for byte in data:
+        delta |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+        else:
+            gid += delta
+            gids.add(gid)
+            if len(gids) > MAX_GIDS:
+                return None
+            delta = shift = 0
+    return gids
@@ -0,0 +1,25 @@
+"""
+Write the accessions and observations snapshot for the in-process
+search index (see grin_app/search_index.py). Should be done after all
+genera are loaded/updated, and after fts_index.py. The path is a symlink
+to the latest snapshot. The workers must be restarted to open the new
+snapshot.
+
+ ./manage.py build_search_index /path/to/snapshot
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from grin_app import search_index
+
+
+class Command(BaseCommand):
+    help = 'Write the snapshot for the in-process search index'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='snapshot directory')
+
+    def handle(self, *args, **options):
+        rows = search_index.build(connection.cursor(), options['path'])
+        self.stdout.write('wrote %d accessions to %s' % (rows, options['path']))
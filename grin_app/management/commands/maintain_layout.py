@@ -0,0 +1,71 @@
+"""
+Verify and maintain the physical layout of the tables the views query
+(see grin_app/table_layout.py): report the missing indexes, dead
+tuples, physical order and index usage, and optionally fix them.
+Should be done after all genera are loaded/updated.
+
+ ./manage.py maintain_layout                    # report only
+ ./manage.py maintain_layout --create-indexes   # build missing indexes
+                                                # (e.g. on older databases)
+ ./manage.py maintain_layout --cluster          # reorder, and analyze
+ ./manage.py maintain_layout --analyze
+
+--cluster locks the tables (reads included) while they are rewritten.
+"""
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from grin_app import table_layout
+
+
+class Command(BaseCommand):
+    help = 'Verify and maintain the indexes and row order of the tables'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--create-indexes', action='store_true',
+                            help='build the missing or invalid indexes')
+        parser.add_argument('--cluster', action='store_true',
+                            help='reorder the accessions by location and '
+                                 'the evaluation data by descriptor')
+        parser.add_argument('--analyze', action='store_true',
+                            help='update the planner statistics')
+
+    def handle(self, *args, **options):
+        cursor = connection.cursor()
+        missing = table_layout.missing_indexes(cursor)
+        for index in missing:
+            if options['create_indexes']:
+                self.stdout.write('creating index %s...' % index[1])
+                table_layout.create_index(cursor, index)
+            else:
+                self.stdout.write('MISSING index %s on %s' % (index[1],
+                                                             index[0]))
+        if options['cluster']:
+            for table in sorted(table_layout.CLUSTER_ORDER):
+                self.stdout.write('clustering %s...' % table)
+                table_layout.cluster(cursor, table)
+        if options['analyze']:
+            for table in table_layout.TABLES:
+                self.stdout.write('analyzing %s...' % table)
+                table_layout.analyze(cursor, table)
+        self.stdout.write('%-30s %10s %10s %6s %10s %11s' % (
+            'table', 'live', 'dead', 'dead%', 'MB', 'correlation'))
+        for row in table_layout.table_stats(cursor):
+            self.stdout.write('%-30s %10d %10d %6.1f %10.1f %11s' % (
+                row['tablename'], row['live'], row['dead'], row['dead_pct'],
+                row['bytes'] / 1048576.0,
+                '' if row['correlation'] is None
+                else '%.3f' % row['correlation']))
+        self.stdout.write('%-65s %10s %10s' % ('index', 'scans', 'MB'))
+        for row in table_layout.index_stats(cursor):
+            flags = []
+            if not row['valid']:
+                flags.append('INVALID')
+            if row['clustered']:
+                flags.append('clustered')
+            if row['scans'] == 0:
+                flags.append('unused')
+            self.stdout.write('%-65s %10d %10.1f %s' % (
+                row['indexname'], row['scans'], row['bytes'] / 1048576.0,
+                ' '.join(flags)))
@@ -0,0 +1,22 @@
+"""
+Purge the reverse proxy cached responses tagged with the surrogate keys
+(see grin_app/surrogate_keys.py). Called by the load scripts after
+loading/updating data.
+
+ ./manage.py purge_cache genus-Medicago summary
+"""
+
+from django.core.management.base import BaseCommand
+
+from grin_app import surrogate_keys
+
+
+class Command(BaseCommand):
+    help = 'Purge the cached responses tagged with the surrogate keys'
+
+    def add_arguments(self, parser):
+        parser.add_argument('keys', nargs='+', help='surrogate keys')
+
+    def handle(self, *args, **options):
+        surrogate_keys.purge(options['keys'])
+        self.stdout.write('purged %s' % ' '.join(options['keys']))
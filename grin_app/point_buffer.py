@@ -0,0 +1,93 @@
+"""
+Encode accession points as a compact binary buffer of typed arrays, for
+clients rendering large numbers of markers with WebGL.
+
+usage:
+
+content = point_buffer.encode(lng, lat, gids, labels, 'taxon')
+
+Buffer layout (little endian):
+
+uint32        length in bytes of the JSON header
+JSON header   utf-8, space padded to a multiple of 4 bytes
+float32[2n]   lng, lat pairs
+uint32[n]     gid
+uint16[n]     category code, an index into header['categories']
+
+The header has the count, the category name, the categories lookup
+table (label for each code) and the byte offset, type and length of
+each array, so they can be viewed in place with javascript typed
+arrays, e.g. new Float32Array(buffer, offset, length).
+"""
+
+import struct
+
+import numpy as np
+import simplejson as json
+
+ARRAYS = (
+    ('coords', '<f4', 'Float32Array'),
+    ('gid', '<u4', 'Uint32Array'),
+    ('category', '<u2', 'Uint16Array'),
+)
+MAX_CATEGORIES = 2 ** 16
+
+
+def encode(lng, lat, gids, labels, category):
+    """Return the binary buffer for the points. labels are the category
+    labels of each point (e.g. taxon, or a nominal trait value), coded
+    in order of first appearance.
+    """
+    coords = np.empty((len(gids), 2), dtype='<f4')
+    coords[:, 0] = lng
+    coords[:, 1] = lat
+    codes = {}
+    for label in labels:
+        codes.setdefault(label, len(codes))
+    assert len(codes) <= MAX_CATEGORIES, 'too many categories'
+    data = {
+        'coords': coords,
+        'gid': np.asarray(gids, dtype='<u4'),
+        'category': np.array([codes[label] for label in labels],
+                             dtype='<u2'),
+    }
+    header = {
+        'count': len(gids),
+        'category': category,
+        'categories': sorted(codes, key=codes.get),
+    }
+    sizes = [_padded(data[name].nbytes) for name, dtype, js_type in ARRAYS]
+    # the offsets depend on the header length, which depends on the
+    # offsets, so grow the header until they fit
+    header_len = 0
+    while True:
+        offset = 4 + header_len
+        header['arrays'] = []
+        for (name, dtype, js_type), size in zip(ARRAYS, sizes):
+            header['arrays'].append({
+                'name': name,
+                'type': js_type,
+                'offset': offset,
+                'length': data[name].size,
+            })
+            offset += size
+        needed = _padded(len(_header_bytes(header, 0)))
+        if needed <= header_len:
+            break
+        header_len = needed
+    chunks = [struct.pack('<I', header_len),
+              _header_bytes(header, header_len)]
+    for name, dtype, js_type in ARRAYS:
+        content = data[name].tobytes()
+        chunks.append(content + b'\0' * (_padded(len(content)) -
+                                         len(content)))
+    return b''.join(chunks)
+
+
+def _padded(nbytes):
+    return (nbytes + 3) // 4 * 4
+
+
+def _header_bytes(header, length):
+    content = json.dumps(header).encode('utf-8')
+    return content + b' ' * (length - len(content))
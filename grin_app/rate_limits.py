@@ -0,0 +1,194 @@
+"""
+Limit the request rate and concurrency of each client, so a script
+hammering the expensive views can't saturate the database for the
+interactive users.
+
+usage as decorator, outside sql_metrics.instrumented (a rejected request
+doesn't touch the database):
+
+@rate_limits.limited('expensive')
+@sql_metrics.instrumented
+def viewname(request):
+    ...
+
+Each client has a token bucket per budget in settings.RATE_LIMITS: it
+holds up to 'burst' tokens, refilled at 'rate' tokens per second, and
+each request takes one. A client may also have no more than
+'concurrency' requests of a budget running at once. Requests over
+either limit get a 429 response, with a Retry-After header. The views
+are split into a cheap and an expensive budget, so a bulk client
+exhausting its expensive budget can still open the accession popups.
+
+Clients are identified by their X-Api-Key header, if it's one of
+settings.RATE_LIMIT_API_KEYS (which may override the budgets of that
+client), or else by their IP address: REMOTE_ADDR, or behind reverse
+proxies (settings.RATE_LIMIT_FORWARDED_FOR), the X-Forwarded-For address
+appended by the outermost of the settings.RATE_LIMIT_TRUSTED_PROXIES
+proxies. The addresses left of it come from the client, which could
+rotate them for a fresh bucket on every request.
+
+The buckets are kept per worker process, unless settings.RATE_LIMIT_CACHE
+names a shared cache in CACHES (e.g. a local memcached), so all the
+processes take from the same bucket. The cache is read and written
+without a lock, so concurrent requests may overdraw a bucket slightly.
+The running requests are always counted per process, so the concurrency
+limit is per worker process: a client may have up to 'concurrency'
+requests running in each worker.
+"""
+
+import hashlib
+import math
+import threading
+import time
+
+import simplejson as json
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+BUDGETS = getattr(settings, 'RATE_LIMITS', {})
+API_KEYS = getattr(settings, 'RATE_LIMIT_API_KEYS', {})
+FORWARDED_FOR = getattr(settings, 'RATE_LIMIT_FORWARDED_FOR', False)
+TRUSTED_PROXIES = getattr(settings, 'RATE_LIMIT_TRUSTED_PROXIES', 1)
+SHARED_CACHE = getattr(settings, 'RATE_LIMIT_CACHE', None)
+API_KEY_HEADER = 'HTTP_X_API_KEY'
+# the in-process buckets untouched for this long (and so full again) are
+# dropped when there are more than MAX_BUCKETS
+MAX_BUCKETS = 10000
+BUCKET_IDLE = 3600  # seconds
+
+_buckets = {}
+_running = {}
+_lock = threading.Lock()
+
+
+def limited(budget):
+    def decorator(view):
+        def wrapper(request, *args, **kwargs):
+            client, limits = _client(request, budget)
+            if not limits:
+                return view(request, *args, **kwargs)
+            key = (budget, client)
+            with _lock:
+                running = _running.get(key, 0)
+                if running >= limits['concurrency']:
+                    return _too_many_requests(
+                        'too many concurrent requests', 1)
+                _running[key] = running + 1
+            wait = _take(key, limits['rate'], limits['burst'])
+            if wait:
+                _release(key)
+                return _too_many_requests('rate limit exceeded', wait)
+            try:
+                response = view(request, *args, **kwargs)
+            except Exception:
+                _release(key)
+                raise
+            if response.streaming:
+                # still running until the content is streamed
+                response.streaming_content = _Releasing(
+                    response.streaming_content, key)
+            else:
+                _release(key)
+            return response
+        wrapper.__name__ = view.__name__
+        wrapper.__doc__ = view.__doc__
+        return wrapper
+    return decorator
+
+
+def _release(key):
+    with _lock:
+        _running[key] -= 1
+        if not _running[key]:
+            del _running[key]
+
+
+class _Releasing(object):
+    """Streaming content, releasing the request's concurrency slot when
+    the response is closed (after streaming, or when the client went
+    away).
+    """
+
+    def __init__(self, content, key):
+        self.content = content
+        self.key = key
+        self.released = False
+
+    def __iter__(self):
+        return iter(self.content)
+
+    def close(self):
+        try:
+            if hasattr(self.content, 'close'):
+                self.content.close()
+        finally:
+            if not self.released:
+                self.released = True
+                _release(self.key)
+
+
+def _client(request, budget):
+    """Return the client's identity, and its limits for the budget (None
+    if unlimited).
+    """
+    api_key = request.META.get(API_KEY_HEADER, None)
+    if api_key and api_key in API_KEYS:
+        limits = API_KEYS[api_key].get(budget, BUDGETS.get(budget, None))
+        return 'key:' + api_key, limits
+    address = request.META.get('REMOTE_ADDR', '')
+    if FORWARDED_FOR:
+        forwarded = [a.strip() for a in
+                     request.META.get('HTTP_X_FORWARDED_FOR', '').split(',')]
+        # each trusted proxy appended one address, the last one its
+        # peer's
+        address = forwarded[max(len(forwarded) - TRUSTED_PROXIES, 0)] or \
+            address
+    return 'ip:' + address, BUDGETS.get(budget, None)
+
+
+def _take(key, rate, burst):
+    """Take a token from the key's bucket. Return 0 if there was one,
+    else the seconds until there will be.
+    """
+    now = time.time()
+    if SHARED_CACHE is None:
+        with _lock:
+            tokens, wait = _refill(_buckets.get(key, None), now, rate, burst)
+            _buckets[key] = (tokens - (0 if wait else 1), now)
+            if len(_buckets) > MAX_BUCKETS:
+                for idle in [k for k, (t, then) in _buckets.items()
+                             if now - then > BUCKET_IDLE]:
+                    del _buckets[idle]
+        return wait
+    cache = caches[SHARED_CACHE]
+    cache_key = 'rate_limits:' + hashlib.sha1(
+        json.dumps(key).encode('utf-8')).hexdigest()
+    tokens, wait = _refill(cache.get(cache_key), now, rate, burst)
+    # an unused bucket is full again after burst / rate seconds
+    cache.set(cache_key, (tokens - (0 if wait else 1), now),
+              int(math.ceil(float(burst) / rate)) + 1)
+    return wait
+
+
+def _refill(bucket, now, rate, burst):
+    """Return the tokens in the bucket (a tokens, time tuple, or None
+    for a new one) refilled up to now, and the seconds to wait for a
+    whole token, if there isn't one.
+    """
+    if bucket is None:
+        tokens = float(burst)
+    else:
+        tokens, then = bucket
+        tokens = min(float(burst), tokens + (now - then) * rate)
+    if tokens >= 1:
+        return tokens, 0
+    return tokens, (1 - tokens) / rate
+
+
+def _too_many_requests(message, wait):
+    content = json.dumps({'error': message})
+    response = HttpResponse(content, status=429,
+                            content_type='application/json')
+    response['Retry-After'] = str(int(math.ceil(wait)))
+    return response
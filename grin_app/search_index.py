@@ -0,0 +1,500 @@
+"""
+An in-process, read-only search index of the accessions and their
+evaluation observations, as an alternative to PostGIS for the search
+views.
+
+The ACC_SELECT_COLS projection of grin_accession and the evaluation
+observations are written to a snapshot directory of .npy arrays (see
+build(), the build_search_index management command, or the --snapshot
+option of the load scripts), which each worker opens memory-mapped, so
+the pages are shared by all the worker processes:
+
+* coordinates are float64 arrays, sorted by 1 degree grid cell, with an
+  offsets array per cell (a packed grid index) for bbox queries.
+* taxon, country and crop names are interned, as int32 codes into
+  lookup lists. The taxa are coded in sorted order, so ORDER BY taxon
+  is an integer sort.
+* accenumb and collsite are utf-8 buffers indexed by offsets arrays.
+* accenumb has an open addressing hash index (crc32, linear probing).
+* the observations are sorted by accession, with an offsets array per
+  accession, and have a descriptor code, the observation_value string,
+  and the value as float64 (NaN if it's not numeric).
+
+Each build writes a new <path>.<timestamp>.<suffix> directory and then
+atomically repoints the <path> symlink to it, so workers opening the
+snapshot never see a partial one, and workers which already have the
+previous one open keep using it until they are restarted.
+
+SearchIndex.search() answers the GRIN_ACC_WHERE_FRAGS filters with the
+ORDER_BY_FRAG ordering of the SQL path, with two approximations: the
+distance to the map center is great circle instead of spheroidal, and
+the english stemmer of the taxon FTS is approximated by suffix matching
+against the lexemes in taxon_fts. It returns None for queries it can't
+answer, and the caller must then fall back to SQL.
+
+Enable it with settings.SEARCH_INDEX_PATH.
+"""
+
+import glob
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+
+import numpy as np
+from django.conf import settings
+
+SNAPSHOT_VERSION = 2
+KEEP_SNAPSHOTS = 2
+EARTH_RADIUS_M = 6371008.8
+GRID_COLS = 360
+GRID_ROWS = 180
+NO_CELL = GRID_COLS * GRID_ROWS  # cell for accessions without coords
+NULL_INT = np.iinfo(np.int32).min
+EPOCH = date(1970, 1, 1)
+# suffixes which the english snowball stemmer strips from latin/english
+# taxon words, e.g. nootkatensis -> nootkatensi, species -> speci
+STEM_SUFFIXES = ('s', 'es', 'e', 'ed', 'ing', 'ly')
+TSQUERY_WORD_REGEX = re.compile(r'[^\W_]+')
+PLAIN_QUERY_REGEX = re.compile(r'^[\w\s.\-\']*$')
+SUPPORTED_FRAGS = {
+    'fts', 'fts_simple', 'country', 'geocoded_only', 'limit_geo_bounds',
+    'acqdate_range'
+}
+BUILD_SQL = '''
+SELECT gid, taxon, latdec, longdec, accenumb, elevation, cropname,
+       collsite, acqdate, origcty,
+       ST_Y(geographic_coord::geometry) AS coord_lat,
+       ST_X(geographic_coord::geometry) AS coord_lng,
+       accession_key
+FROM lis_germplasm.grin_accession
+'''
+LEXEMES_SQL = '''
+SELECT DISTINCT taxon, tsvector_to_array(taxon_fts)
+FROM lis_germplasm.grin_accession
+WHERE taxon IS NOT NULL
+'''
+OBSERVATIONS_SQL = '''
+SELECT accession_key, descriptor_name, observation_value
+FROM lis_germplasm.legumes_grin_evaluation_data
+WHERE accession_key IS NOT NULL
+AND descriptor_name IS NOT NULL
+AND observation_value IS NOT NULL
+'''
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index():
+    """Return the SearchIndex for settings.SEARCH_INDEX_PATH, opening it
+    on first use, or None if it's not configured.
+    """
+    global _index
+    path = getattr(settings, 'SEARCH_INDEX_PATH', None)
+    if not path:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = SearchIndex(path)
+    return _index
+
+
+def build(cursor, path):
+    """Write a new snapshot of the accessions and observations, and
+    point the path symlink to it. cursor may be a django or a psycopg2
+    cursor. Returns the number of accessions.
+    """
+    parent, name = os.path.split(os.path.abspath(path))
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    # build in a directory of its own, which the pruning of concurrent
+    # builds doesn't match, then give it its timestamped name (unique,
+    # with the temporary name's random suffix)
+    prefix = name + '.build'
+    build_path = tempfile.mkdtemp(prefix=prefix, dir=parent)
+    try:
+        n = _build_accessions(cursor, build_path)
+    except Exception:
+        shutil.rmtree(build_path)
+        raise
+    os.chmod(build_path, 0o755)
+    snapshot_path = '%s.%s.%s' % (path, time.strftime('%Y%m%d%H%M%S'),
+                                  os.path.basename(build_path)[len(prefix):])
+    os.rename(build_path, snapshot_path)
+    # point the path symlink at the new snapshot, atomically
+    tmp_link = build_path + '.link'
+    os.symlink(os.path.basename(snapshot_path), tmp_link)
+    os.replace(tmp_link, path)
+    # never prune the snapshot the symlink points to, which may be an
+    # older one, if a concurrent build finished after this one
+    current = os.path.realpath(path)
+    for old_path in sorted(glob.glob(path + '.2*'))[:-KEEP_SNAPSHOTS]:
+        if os.path.realpath(old_path) != current:
+            shutil.rmtree(old_path)
+    return n
+
+
+def _build_accessions(cursor, path):
+    cursor.execute(BUILD_SQL)
+    rows = cursor.fetchall()
+    cursor.execute(LEXEMES_SQL)
+    lexemes = dict((taxon, lex or []) for taxon, lex in cursor.fetchall())
+    n = len(rows)
+    cols = list(zip(*rows)) if n else [()] * 13
+    (gid, taxon, latdec, longdec, accenumb, elevation, cropname, collsite,
+     acqdate, origcty, coord_lat, coord_lng, accession_key) = cols
+    coord_lat = np.array([np.nan if v is None else v for v in coord_lat],
+                         dtype=np.float64)
+    coord_lng = np.array([np.nan if v is None else v for v in coord_lng],
+                         dtype=np.float64)
+    cell = _cells(coord_lat, coord_lng)
+    # stable sort by cell, so each cell's rows are contiguous
+    order = np.argsort(cell, kind='mergesort')
+    taxa, taxon_code = _intern(taxon)
+    countries, country_code = _intern(origcty)
+    cropnames, cropname_code = _intern(cropname)
+    arrays = {
+        'gid': np.array(gid, dtype=np.int32),
+        'latdec': np.array([v or 0.0 for v in latdec], dtype=np.float64),
+        'longdec': np.array([v or 0.0 for v in longdec], dtype=np.float64),
+        'coord_lat': coord_lat,
+        'coord_lng': coord_lng,
+        'elevation': np.array([NULL_INT if v is None else v
+                               for v in elevation], dtype=np.int32),
+        'acqdate': np.array([NULL_INT if v is None else (v - EPOCH).days
+                             for v in acqdate], dtype=np.int32),
+        'taxon': taxon_code,
+        'origcty': country_code,
+        'cropname': cropname_code,
+        'cell': cell,
+    }
+    for name, arr in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), arr[order])
+    accenumb = [accenumb[i] for i in order]
+    _save_strings(path, 'accenumb', accenumb)
+    _save_strings(path, 'collsite', [collsite[i] for i in order])
+    np.save(os.path.join(path, 'accenumb_hash.npy'), _hash_table(accenumb))
+    sorted_cells = arrays['cell'][order]
+    cell_offsets = np.searchsorted(sorted_cells,
+                                   np.arange(NO_CELL + 2)).astype(np.int64)
+    np.save(os.path.join(path, 'cell_offsets.npy'), cell_offsets)
+    descriptors = _build_observations(cursor, path,
+                                      [accession_key[i] for i in order])
+    lookups = {
+        'version': SNAPSHOT_VERSION,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'rows': n,
+        'taxa': taxa,
+        'taxon_lexemes': [lexemes.get(t, []) for t in taxa],
+        'countries': countries,
+        'cropnames': cropnames,
+        'descriptors': descriptors,
+    }
+    with open(os.path.join(path, 'lookups.json'), 'w') as f:
+        json.dump(lookups, f)
+    return n
+
+
+def _build_observations(cursor, path, accession_keys):
+    """Write the observation arrays, sorted by accession row (in the
+    order of the accession_keys list). Returns the descriptors lookup
+    list.
+    """
+    rows_by_key = dict((k, i) for i, k in enumerate(accession_keys)
+                       if k is not None)
+    cursor.execute(OBSERVATIONS_SQL)
+    obs = [(rows_by_key[k], d, v) for k, d, v in cursor.fetchall()
+           if k in rows_by_key]
+    obs.sort(key=lambda o: o[0])
+    acc_rows = np.array([o[0] for o in obs], dtype=np.int32)
+    descriptors, descriptor_code = _intern([o[1] for o in obs])
+    values = [o[2] for o in obs]
+    np.save(os.path.join(path, 'obs_descriptor.npy'), descriptor_code)
+    np.save(os.path.join(path, 'obs_numeric.npy'),
+            np.array([_float_or_nan(v) for v in values], dtype=np.float64))
+    _save_strings(path, 'obs_value', values)
+    obs_offsets = np.searchsorted(acc_rows,
+                                  np.arange(len(accession_keys) + 1))
+    np.save(os.path.join(path, 'obs_offsets.npy'),
+            obs_offsets.astype(np.int64))
+    return descriptors
+
+
+class SearchIndex(object):
+    """Memory-mapped accessions snapshot, see module docstring."""
+
+    def __init__(self, path):
+        # resolve the symlink once, so a build repointing it meanwhile
+        # can't mix arrays of two snapshots
+        path = os.path.realpath(path)
+        self.path = path
+        with open(os.path.join(path, 'lookups.json')) as f:
+            lookups = json.load(f)
+        assert lookups['version'] == SNAPSHOT_VERSION, \
+            'search index snapshot version mismatch, rebuild it'
+        self.rows = lookups['rows']
+        self.taxa = lookups['taxa']
+        self.taxon_lexemes = [set(lex) for lex in lookups['taxon_lexemes']]
+        self.countries = lookups['countries']
+        self.country_codes = dict((c, i) for i, c in enumerate(self.countries))
+        self.cropnames = lookups['cropnames']
+        self._taxon_query_cache = {}
+
+        def load(name):
+            return np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+
+        for name in ('gid', 'latdec', 'longdec', 'coord_lat', 'coord_lng',
+                     'elevation', 'acqdate', 'taxon', 'origcty', 'cropname',
+                     'cell_offsets'):
+            setattr(self, name, load(name))
+        self.accenumb = (load('accenumb.data'), load('accenumb.offsets'),
+                         load('accenumb.null'))
+        self.collsite = (load('collsite.data'), load('collsite.offsets'),
+                         load('collsite.null'))
+        self.accenumb_hash = load('accenumb_hash')
+        self.descriptors = lookups['descriptors']
+        self.descriptor_codes = dict(
+            (d, i) for i, d in enumerate(self.descriptors))
+        self.obs_offsets = load('obs_offsets')
+        self.obs_descriptor = load('obs_descriptor')
+        self.obs_numeric = load('obs_numeric')
+        self.obs_value = (load('obs_value.data'), load('obs_value.offsets'),
+                          load('obs_value.null'))
+
+    def lookup_accenumb(self, accenumb):
+        """Return the row index of the accession, or None."""
+        mask = len(self.accenumb_hash) - 1
+        slot = zlib.crc32(accenumb.encode('utf-8')) & mask
+        while self.accenumb_hash[slot] != -1:
+            i = self.accenumb_hash[slot]
+            if _string_at(self.accenumb, i) == accenumb:
+                return int(i)
+            slot = (slot + 1) & mask
+        return None
+
+    def observation_values(self, accenumb, descriptor_name):
+        """Return the list of observation_value strings of the accession
+        for the descriptor, or None if there are none (like array_agg).
+        """
+        i = self.lookup_accenumb(accenumb)
+        code = self.descriptor_codes.get(descriptor_name, None)
+        if i is None or code is None:
+            return None
+        start, end = self.obs_offsets[i], self.obs_offsets[i + 1]
+        values = [_string_at(self.obs_value, j)
+                  for j in range(start, end)
+                  if self.obs_descriptor[j] == code]
+        return values or None
+
+    def search(self, frags, sql_params):
+        """Return the accession records for the GRIN_ACC_WHERE_FRAGS keys
+        in frags, with the search view's sql_params, ordered and limited
+        like the SQL path. Returns None if the query is not supported.
+        """
+        if not set(frags) <= SUPPORTED_FRAGS:
+            return None
+        if 'limit_geo_bounds' in frags:
+            idx = self._bbox_candidates(sql_params)
+            lat = self.coord_lat[idx]
+            lng = self.coord_lng[idx]
+            # ST_Contains excludes the envelope boundary
+            idx = idx[(lng > sql_params['minx']) & (lng < sql_params['maxx'])
+                      & (lat > sql_params['miny']) & (lat < sql_params['maxy'])]
+        else:
+            idx = np.arange(self.rows)
+        if 'fts' in frags or 'fts_simple' in frags:
+            codes = self._taxon_codes(sql_params['taxon_query'],
+                                      boolean='fts' in frags)
+            if codes is None:
+                return None
+            idx = idx[np.isin(self.taxon[idx], codes)]
+        if 'country' in frags:
+            code = self.country_codes.get(sql_params['country'], None)
+            if code is None:
+                return []
+            idx = idx[self.origcty[idx] == code]
+        if 'geocoded_only' in frags or 'limit_geo_bounds' in frags:
+            idx = idx[(self.latdec[idx] != 0) & (self.longdec[idx] != 0)]
+        if 'acqdate_range' in frags:
+            acqdate = self.acqdate[idx]
+            keep = acqdate != NULL_INT
+            if sql_params['acqdate_min'] is not None:
+                keep &= acqdate >= (sql_params['acqdate_min'] - EPOCH).days
+            if sql_params['acqdate_max'] is not None:
+                keep &= acqdate <= (sql_params['acqdate_max'] - EPOCH).days
+            idx = idx[keep]
+        idx = self._order(idx, sql_params)
+        return [self._record(i) for i in idx[:sql_params['limit']]]
+
+    def _bbox_candidates(self, sql_params):
+        """Return the row indexes in the grid cells overlapping the bbox.
+        The rows of each band of cells with the same latitude are
+        contiguous, so this is one slice per band.
+        """
+        x0 = _clamp(np.floor(sql_params['minx']) + 180, 0, GRID_COLS - 1)
+        x1 = _clamp(np.floor(sql_params['maxx']) + 180, 0, GRID_COLS - 1)
+        y0 = _clamp(np.floor(sql_params['miny']) + 90, 0, GRID_ROWS - 1)
+        y1 = _clamp(np.floor(sql_params['maxy']) + 90, 0, GRID_ROWS - 1)
+        if x0 > x1 or y0 > y1:
+            return np.arange(0)
+        bands = np.arange(y0, y1 + 1) * GRID_COLS
+        starts = self.cell_offsets[bands + x0]
+        ends = self.cell_offsets[bands + x1 + 1]
+        return np.concatenate(
+            [np.arange(s, e) for s, e in zip(starts, ends)] or [np.arange(0)])
+
+    def _order(self, idx, sql_params):
+        """Sort the row indexes by distance to the center of the bbox,
+        taxon, gid (like ORDER_BY_FRAG), keeping at least limit rows.
+        """
+        if len(idx) == 0:
+            return idx
+        center_lng = np.radians((sql_params['minx'] + sql_params['maxx']) / 2)
+        center_lat = np.radians((sql_params['miny'] + sql_params['maxy']) / 2)
+        lat = np.radians(self.coord_lat[idx])
+        lng = np.radians(self.coord_lng[idx])
+        a = (np.sin((lat - center_lat) / 2) ** 2 +
+             np.cos(lat) * np.cos(center_lat) *
+             np.sin((lng - center_lng) / 2) ** 2)
+        dist = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+        # null coordinates sort last, like NULL distances in postgres
+        dist = np.where(np.isnan(dist), np.inf, dist)
+        limit = sql_params['limit']
+        if len(idx) > limit:
+            # only the rows up to the limit'th distance (and ties) matter
+            kth = np.partition(dist, limit - 1)[limit - 1]
+            keep = dist <= kth
+            idx, dist = idx[keep], dist[keep]
+        order = np.lexsort((self.gid[idx], self.taxon[idx], dist))
+        return idx[order]
+
+    def _taxon_codes(self, taxon_query, boolean):
+        """Return an array of taxon codes matching the FTS query, parsed
+        like to_tsquery (boolean) or plainto_tsquery. Returns None for a
+        query syntax which isn't supported.
+        """
+        key = (taxon_query, boolean)
+        if key in self._taxon_query_cache:
+            return self._taxon_query_cache[key]
+        if boolean:
+            # & binds tighter than |
+            terms = [TSQUERY_WORD_REGEX.findall(term.lower())
+                     for term in taxon_query.split('|')]
+        elif PLAIN_QUERY_REGEX.match(taxon_query):
+            terms = [TSQUERY_WORD_REGEX.findall(taxon_query.lower())]
+        else:
+            return None
+        codes = np.array([
+            code for code, lexemes in enumerate(self.taxon_lexemes)
+            if any(all(_word_matches(w, lexemes) for w in words)
+                   for words in terms if words)
+        ], dtype=np.int32)
+        if len(self._taxon_query_cache) > 1000:
+            self._taxon_query_cache.clear()
+        self._taxon_query_cache[key] = codes
+        return codes
+
+    def _record(self, i):
+        """Return the ACC_SELECT_COLS dict for row index i."""
+        elevation = int(self.elevation[i])
+        acqdate = int(self.acqdate[i])
+        return {
+            'gid': int(self.gid[i]),
+            'taxon': self.taxa[self.taxon[i]],
+            'latdec': float(self.latdec[i]),
+            'longdec': float(self.longdec[i]),
+            'accenumb': _string_at(self.accenumb, i),
+            'elevation': None if elevation == NULL_INT else elevation,
+            'cropname': self.cropnames[self.cropname[i]],
+            'collsite': _string_at(self.collsite, i),
+            'acqdate': None if acqdate == NULL_INT else
+            EPOCH + timedelta(days=acqdate),
+            'origcty': self.countries[self.origcty[i]],
+        }
+
+
+def _word_matches(word, lexemes):
+    """True if the query word stems to one of the taxon's lexemes."""
+    if word in lexemes:
+        return True
+    for suffix in STEM_SUFFIXES:
+        if word.endswith(suffix) and word[:-len(suffix)] in lexemes:
+            return True
+    return word.endswith('y') and word[:-1] + 'i' in lexemes
+
+
+def _hash_table(keys):
+    """Return an open addressing hash table of the keys' indexes, with
+    a power of two size of at least twice the number of keys, and -1
+    for empty slots.
+    """
+    size = 1
+    while size < 2 * len(keys):
+        size *= 2
+    table = np.full(size, -1, dtype=np.int32)
+    mask = size - 1
+    for i, key in enumerate(keys):
+        if key is None:
+            continue
+        slot = zlib.crc32(key.encode('utf-8')) & mask
+        while table[slot] != -1:
+            slot = (slot + 1) & mask
+        table[slot] = i
+    return table
+
+
+def _float_or_nan(s):
+    try:
+        return float(s)
+    except ValueError:
+        return np.nan
+
+
+def _cells(lat, lng):
+    """Return the grid cell number of each coordinate, NO_CELL if null."""
+    with np.errstate(invalid='ignore'):
+        x = np.clip(np.floor(lng) + 180, 0, GRID_COLS - 1)
+        y = np.clip(np.floor(lat) + 90, 0, GRID_ROWS - 1)
+        cell = y * GRID_COLS + x
+    return np.where(np.isnan(cell), NO_CELL, cell).astype(np.int32)
+
+
+def _intern(values):
+    """Return the lookup list and an int32 code array for the values.
+    The codes are in sorted order of the values, None last.
+    """
+    uniq = set(values)
+    lookup = sorted(v for v in uniq if v is not None)
+    if None in uniq:
+        lookup.append(None)
+    codes = dict((v, i) for i, v in enumerate(lookup))
+    return lookup, np.array([codes[v] for v in values], dtype=np.int32)
+
+
+def _save_strings(path, name, values):
+    """Save the strings as utf-8 data, offsets and null arrays."""
+    encoded = [(v or '').encode('utf-8') for v in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in encoded])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    null = np.array([v is None for v in values], dtype=np.bool_)
+    np.save(os.path.join(path, name + '.data.npy'), data)
+    np.save(os.path.join(path, name + '.offsets.npy'), offsets)
+    np.save(os.path.join(path, name + '.null.npy'), null)
+
+
+def _string_at(strings, i):
+    data, offsets, null = strings
+    if null[i]:
+        return None
+    return bytes(data[offsets[i]:offsets[i + 1]]).decode('utf-8')
+
+
+def _clamp(val, lo, hi):
+    return int(min(max(val, lo), hi))
@@ -0,0 +1,43 @@
+"""
+A decorator for the safe, read-only GET views, marking their responses
+cacheable by shared caches (e.g. a varnish or nginx reverse proxy) as
+well as browsers. These views don't use the CSRF cookie, the session
+or request.user (which would make SessionMiddleware add "Vary: Cookie"),
+so the responses neither set cookies nor vary on them. A response of a
+view which did access the session is not marked cacheable. The
+responses are tagged with the dataset surrogate key, for purging them
+after data reloads (see surrogate_keys.py).
+
+usage as decorator:
+
+@shared_cache
+def viewname(request):
+    ...
+"""
+
+from django.conf import settings
+from django.utils.http import http_date
+import time
+
+from grin_app import surrogate_keys
+
+MAX_AGE = getattr(settings, 'API_CACHE_MAX_AGE', 3600)  # seconds
+SHARED_MAX_AGE = getattr(settings, 'API_CACHE_SHARED_MAX_AGE', 86400)
+
+
+def shared_cache(view):
+    def wrapper(request, *args, **kwargs):
+        response = view(request, *args, **kwargs)
+        session = getattr(request, 'session', None)
+        if response.status_code == 200 and not (
+                session is not None and session.accessed):
+            response['Cache-Control'] = 'public, max-age=%d, s-maxage=%d' % (
+                MAX_AGE, SHARED_MAX_AGE)
+            response['Expires'] = http_date(time.time() + MAX_AGE)
+            surrogate_keys.tag(response, [surrogate_keys.DATASET_KEY])
+        else:
+            response['Cache-Control'] = 'no-cache'
+        return response
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
@@ -0,0 +1,149 @@
+"""
+Coalesce concurrent identical requests, so a stampede of the same
+search (e.g. a room full of people panning to the same region) runs
+the query once, and the other requests share its response.
+
+usage as decorator, inside sql_metrics.instrumented:
+
+@sql_metrics.instrumented
+@single_flight.coalesced
+def viewname(request):
+    ...
+
+Requests are identical when the view, method, query string and JSON
+body (with keys sorted) are the same. Within a worker process, the
+followers wait for the leader's response. If settings.SINGLE_FLIGHT_CACHE
+names a shared cache (e.g. memcached), leaders in other processes are
+also coalesced: the first one takes a lock in the cache and stores its
+response there for SINGLE_FLIGHT_RESULT_TTL seconds, and the others
+poll for it. Responses with a process local accession_sets handle are
+not shared across processes. Followers waiting longer than
+SINGLE_FLIGHT_WAIT seconds give up and run the view themselves, as do
+the followers of a leader which was superseded by a newer request of
+the leader's browser (see deadlines), so they don't get its 409. When
+the leader's query timed out, the followers get the same error, and so
+the view's deadline fallback or 503, instead of all running the slow
+query again.
+"""
+
+import hashlib
+import threading
+import time
+
+import simplejson as json
+from django.conf import settings
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from grin_app import deadlines
+
+SHARED_CACHE = getattr(settings, 'SINGLE_FLIGHT_CACHE', None)
+WAIT = getattr(settings, 'SINGLE_FLIGHT_WAIT', 30)  # seconds
+RESULT_TTL = getattr(settings, 'SINGLE_FLIGHT_RESULT_TTL', 2)  # seconds
+POLL_INTERVAL = 0.05  # seconds
+# headers of responses which are only valid in this process
+LOCAL_HEADERS = ('X-Accession-Set',)
+
+_flights = {}
+_lock = threading.Lock()
+
+
+class _Flight(object):
+    """An in progress view execution, and its result when done."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.superseded = False
+
+
+def coalesced(view):
+    def wrapper(request, *args, **kwargs):
+        key = _key(view.__name__, request)
+        with _lock:
+            flight = _flights.get(key, None)
+            leader = flight is None
+            if leader:
+                flight = _flights[key] = _Flight()
+        if leader:
+            try:
+                flight.result = _shared_result(key, view, request, args,
+                                               kwargs)
+            except Exception as e:
+                flight.error = e
+                flight.superseded = deadlines.superseded()
+                raise
+            finally:
+                with _lock:
+                    del _flights[key]
+                flight.done.set()
+        else:
+            if not flight.done.wait(WAIT):
+                return view(request, *args, **kwargs)
+            if flight.error is not None:
+                if flight.superseded:
+                    return view(request, *args, **kwargs)
+                raise flight.error
+        return _response(flight.result)
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+def _key(view_name, request):
+    """Return the normalized request params, identifying requests which
+    have the same response.
+    """
+    body = request.body
+    if body:
+        try:
+            body = json.dumps(json.loads(body), sort_keys=True)
+        except ValueError:
+            body = repr(body)
+    return json.dumps([view_name, request.method,
+                       sorted(request.GET.lists()), body or ''])
+
+
+def _shared_result(key, view, request, args, kwargs):
+    """Run the view, or share the result of another process running it
+    with the same key, when there's a SHARED_CACHE.
+    """
+    if SHARED_CACHE is None:
+        return _result(view(request, *args, **kwargs))
+    cache = caches[SHARED_CACHE]
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    lock_key = 'single_flight:lock:' + digest
+    result_key = 'single_flight:result:' + digest
+    if cache.add(lock_key, 1, WAIT):
+        try:
+            result = _result(view(request, *args, **kwargs))
+            if result[0] == 200 and not any(
+                    header in LOCAL_HEADERS for header, value in result[2]):
+                cache.set(result_key, result, RESULT_TTL)
+            return result
+        finally:
+            cache.delete(lock_key)
+    deadline = time.time() + WAIT
+    while time.time() < deadline:
+        result = cache.get(result_key)
+        if result is not None:
+            return result
+        if cache.get(lock_key) is None:
+            break  # the leader finished without a result to share
+        time.sleep(POLL_INTERVAL)
+    return _result(view(request, *args, **kwargs))
+
+
+def _result(response):
+    """Return the shareable (picklable) parts of the response."""
+    return (response.status_code, response.content, list(response.items()))
+
+
+def _response(result):
+    """Return a new response from a result, for each request sharing it."""
+    status, content, headers = result
+    response = HttpResponse(content, status=status)
+    for header, value in headers:
+        response[header] = value
+    return response
@@ -0,0 +1,179 @@
+"""
+Per-request SQL timing and query counts for the views.
+
+usage as decorator, with the timed cursor and serialization:
+
+@sql_metrics.instrumented
+def viewname(request):
+    cursor = sql_metrics.cursor()
+    cursor.execute(...)
+    with sql_metrics.serializing():
+        result = json.dumps(...)
+    ...
+
+The response gets a Server-Timing header with the SQL and serialization
+time, and the totals per view are kept for the metrics view, in
+prometheus text format. The totals are per worker process.
+
+If settings.SQL_SLOW_QUERY_MS is set, queries slower than that are
+logged along with their EXPLAIN plan.
+
+Each request's queries go to the database chosen by db_router (a
+replica, or the primary), or to the primary outside of requests.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from grin_app import db_router
+
+SLOW_QUERY_MS = getattr(settings, 'SQL_SLOW_QUERY_MS', None)
+METRICS = (
+    ('requests', 'total requests'),
+    ('request_seconds', 'total time in the view'),
+    ('sql_queries', 'total SQL queries executed'),
+    ('sql_seconds', 'total time executing SQL queries'),
+    ('sql_rows', 'total rows returned by SQL queries'),
+    ('serialize_seconds', 'total time serializing responses'),
+    ('response_bytes', 'total bytes of response content'),
+)
+
+logger = logging.getLogger(__name__)
+
+_current = threading.local()
+_totals = defaultdict(lambda: defaultdict(float))
+_totals_lock = threading.Lock()
+
+
+def instrumented(view):
+    def wrapper(request, *args, **kwargs):
+        stats = defaultdict(float)
+        _current.stats = stats
+        _current.alias = db_router.read_alias()
+        start = time.time()
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _current.stats = None
+            _current.alias = None
+        stats['requests'] = 1
+        stats['request_seconds'] = time.time() - start
+        if not response.streaming:
+            stats['response_bytes'] = len(response.content)
+        response['Server-Timing'] = ', '.join((
+            'sql;dur=%.1f;desc="%d queries, %d rows"' % (
+                stats['sql_seconds'] * 1000, stats['sql_queries'],
+                stats['sql_rows']),
+            'serialize;dur=%.1f' % (stats['serialize_seconds'] * 1000),
+            'total;dur=%.1f' % (stats['request_seconds'] * 1000),
+        ))
+        with _totals_lock:
+            totals = _totals[view.__name__]
+            for key, val in stats.items():
+                totals[key] += val
+        return response
+    wrapper.__name__ = view.__name__
+    wrapper.__doc__ = view.__doc__
+    return wrapper
+
+
+def cursor():
+    """Return a cursor on the current request's connection which times
+    its queries for the request.
+    """
+    return TimedCursor(_connection().cursor())
+
+
+def chunked_cursor():
+    """Return a server side cursor on the current request's connection,
+    for streaming large results with fetchmany(), which times its
+    queries like cursor().
+    """
+    return TimedCursor(_connection().chunked_cursor())
+
+
+@contextmanager
+def serializing():
+    """Time the enclosed block as serialization for the current request."""
+    start = time.time()
+    try:
+        yield
+    finally:
+        _record('serialize_seconds', time.time() - start)
+
+
+def prometheus_text():
+    """Return the totals per view in prometheus text format."""
+    with _totals_lock:
+        totals = {view: dict(stats) for view, stats in _totals.items()}
+    lines = []
+    for key, help_text in METRICS:
+        name = 'grin_app_%s_total' % key
+        lines.append('# HELP %s %s' % (name, help_text))
+        lines.append('# TYPE %s counter' % name)
+        for view in sorted(totals):
+            lines.append('%s{view="%s"} %s' % (
+                name, view, repr(totals[view].get(key, 0.0))))
+    return '\n'.join(lines) + '\n'
+
+
+def alias():
+    """Return the alias of the current request's database."""
+    return getattr(_current, 'alias', None) or DEFAULT_DB_ALIAS
+
+
+def _connection():
+    return connections[alias()]
+
+
+def _record(key, val):
+    stats = getattr(_current, 'stats', None)
+    if stats is not None:
+        stats[key] += val
+
+
+class TimedCursor(object):
+    """Wraps a database cursor, recording the time and rows of each
+    query in the current request's stats.
+    """
+
+    def __init__(self, wrapped):
+        self.wrapped = wrapped
+
+    def __getattr__(self, attr):
+        return getattr(self.wrapped, attr)
+
+    def __iter__(self):
+        return iter(self.wrapped)
+
+    def execute(self, sql, params=None):
+        start = time.time()
+        try:
+            return self.wrapped.execute(sql, params)
+        finally:
+            elapsed = time.time() - start
+            _record('sql_queries', 1)
+            _record('sql_seconds', elapsed)
+            _record('sql_rows', max(self.wrapped.rowcount, 0))
+            if SLOW_QUERY_MS is not None and elapsed * 1000 > SLOW_QUERY_MS:
+                _log_slow_query(sql, params, elapsed)
+
+
+def _log_slow_query(sql, params, elapsed):
+    """Log the slow query with its EXPLAIN plan (for SELECTs only)."""
+    plan = ''
+    if sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+        try:
+            explain_cursor = _connection().cursor()
+            explain_cursor.execute('EXPLAIN ' + sql, params)
+            plan = '\n'.join(row[0] for row in explain_cursor.fetchall())
+        except Exception as e:
+            plan = 'EXPLAIN failed: %s' % e
+    logger.warning('slow query (%.1f ms):\n%s\nparams: %r\n%s',
+                   elapsed * 1000, sql, params, plan)
@@ -22,21 +22,17 @@ app.controller('accessionDetailController',
 
         $scope.init = function () {
             $http({
-                url: API_PATH + '/accession_detail',
+                url: API_PATH + '/accession_popup',
                 method: 'GET',
-                params: { accenumb: $scope.accId, v: new Date().getTime() }
+                params: { accenumb: $scope.accId }
             }).then(function (resp) {
                 // success callback
-                $scope.model.acc = resp.data[0];
-                checkLISSpeciesPage();
-            });
-            $http({
-                url: API_PATH + '/evaluation_detail',
-                method: 'GET',
-                params: {accenumb: $scope.accId, v: new Date().getTime() }
-            }).then(function (resp) {
-                // success callback
-                $scope.model.evaluation = resp.data;
+                var detail = resp.data[$scope.accId.trim().split(/\s+/).join(' ')];
+                $scope.model.evaluation = detail.evaluation;
+                if (detail.accession) {
+                    $scope.model.acc = detail.accession;
+                    checkLISSpeciesPage();
+                }
             });
         };
 
@@ -238,29 +238,47 @@ app.service('geoJsonService',
                     'recommended length (2k): ' + window.location.href.length);
             }
 
+            var searchData = {
+                taxon_query: s.params.taxonQuery,
+                ne_lat: s.bounds._northEast.lat,
+                ne_lng: s.bounds._northEast.lng,
+                sw_lat: s.bounds._southWest.lat,
+                sw_lng: s.bounds._southWest.lng,
+                limit_geo_bounds: parseBool(s.params.limitToMapExtent),
+                geocoded_only: s.params.geocodedOnly,
+                country: s.params.country,
+                accession_ids: s.params.accessionIds,
+                accession_ids_inclusive: parseBool(s.params.accessionIdsInclusive),
+                trait_overlay: s.params.traitOverlay,
+                limit: s.params.maxRecs,
+            };
+            var withTraits = (! _.isEmpty(s.params.taxonQuery) &&
+                              ! _.isEmpty(s.params.traitOverlay));
+            var url = API_PATH + '/search';
+            if (withTraits) {
+                // the trait values and legend are joined to the search
+                // results on the server, in the same request.
+                url = API_PATH + '/trait_overlay_search';
+                searchData.descriptor_name = s.params.traitOverlay;
+                searchData.trait_scale = s.params.traitScale;
+            }
             $http({
                 // POST should never be cached, but append a unique query 
                 // string to the url anyways.
-                url: API_PATH + '/search?v=' + new Date().getTime(),
+                url: url + '?v=' + new Date().getTime(),
                 method: 'POST',
-                data: {
-                    taxon_query: s.params.taxonQuery,
-                    ne_lat: s.bounds._northEast.lat,
-                    ne_lng: s.bounds._northEast.lng,
-                    sw_lat: s.bounds._southWest.lat,
-                    sw_lng: s.bounds._southWest.lng,
-                    limit_geo_bounds: parseBool(s.params.limitToMapExtent),
-                    geocoded_only: s.params.geocodedOnly,
-                    country: s.params.country,
-                    accession_ids: s.params.accessionIds,
-                    accession_ids_inclusive: parseBool(s.params.accessionIdsInclusive),
-                    trait_overlay: s.params.traitOverlay,
-                    limit: s.params.maxRecs,
-                }
+                data: searchData
             }).then(
                 function (resp) {
                     // success handler;
-                    s.data = resp.data;
+                    if (withTraits) {
+                        s.data = resp.data.features;
+                        s.traitData = resp.data.trait_data;
+                        s.traitMetadata = resp.data.trait_metadata || {};
+                    }
+                    else {
+                        s.data = resp.data;
+                    }
                     if (s.data.length === 0 && s.params.geocodedOnly) {
                         /* retry search with geocodedOnly off (to support edge case
                          e.g. when searching by some countries which only have
@@ -268,52 +286,7 @@ app.service('geoJsonService',
                         s.setGeocodedAccessionsOnly(false, true);
                         return;
                     }
-                    if (! _.isEmpty(s.params.taxonQuery) &&
-                        ! _.isEmpty(s.params.traitOverlay) &&
-                        ! _.isEmpty(s.data)) {
-                        var promise1 = $http({
-                            // POST should never be cached, but append a 
-                            // unique query string to the url anyways.
-                            url: API_PATH + '/evaluation_search?v=' + new Date().getTime(),
-                            method: 'POST',
-                            data: {
-                                accession_ids: s.getAccessionIds(),
-                                descriptor_name: s.params.traitOverlay,
-                            }
-                        }).then(
-                            function (resp) {
-                                // success handler
-                                s.traitData = resp.data;
-                            },
-                            function (resp) {
-                                // error handler
-                                console.log(resp);
-                            }
-                        );
-                        var promise2 = $http({
-                            url: API_PATH + '/evaluation_metadata',
-                            method: 'POST',
-                            data: {
-                                taxon: s.params.taxonQuery,
-                                descriptor_name: s.params.traitOverlay,
-                                accession_ids: (s.params.traitScale === 'local') ? s.getAccessionIds() : [],
-                                trait_scale: s.params.traitScale,                                
-                            }
-                        }).then(
-                            function (resp) {
-                                // success handler
-                                s.traitMetadata = resp.data || {};
-                            },
-                            function (resp) {
-                                // error handler
-                                console.log(resp);
-                            }
-                        );
-                        $q.all([promise1, promise2]).then(postProcessSearch);
-                    }
-                    else {
-                        postProcessSearch();
-                    }
+                    postProcessSearch();
                 },
                 function (resp) {
                     // error handler
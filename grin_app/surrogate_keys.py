@@ -0,0 +1,126 @@
+"""
+Surrogate keys for the responses cached by a shared cache (see
+shared_cache.py), and purging them after data reloads, so the cache can
+keep responses for days and still serve fresh data right after a load.
+
+usage:
+
+surrogate_keys.tag(response, [surrogate_keys.genus_key('Medicago sativa'),
+                              surrogate_keys.accession_key('PI 123')])
+...
+surrogate_keys.purge(['genus-Medicago'])
+
+or from the load scripts: ../manage.py purge_cache genus-Medicago
+
+The keys are:
+
+dataset             every cached response
+summary             responses aggregating all of the data (countries,
+                    facets, descriptor names), and the responses for
+                    accessions which weren't found, as any reload may
+                    add them
+genus-<genus>       responses with accessions of the genus
+country-<origcty>   responses with accessions from the country
+acc-<accenumb>      responses for the accession (spaces as _)
+
+The keys are sent in the settings.SURROGATE_KEY_HEADER response header
+(Surrogate-Key for fastly or varnish-modules, xkey for varnish xkey).
+purge() sends an HTTP request with settings.SURROGATE_PURGE_METHOD to
+each of settings.SURROGATE_PURGE_URLS, with the keys in the
+settings.SURROGATE_PURGE_HEADER header. Without purge urls the purged
+keys are only recorded in the purged list, as a local stand-in for
+tests and development.
+"""
+
+import logging
+import re
+
+from django.conf import settings
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+KEY_HEADER = getattr(settings, 'SURROGATE_KEY_HEADER', 'Surrogate-Key')
+PURGE_URLS = getattr(settings, 'SURROGATE_PURGE_URLS', [])
+PURGE_METHOD = getattr(settings, 'SURROGATE_PURGE_METHOD', 'PURGE')
+PURGE_HEADER = getattr(settings, 'SURROGATE_PURGE_HEADER', KEY_HEADER)
+PURGE_TIMEOUT = 10  # seconds
+# responses with more accessions than this are tagged by genus and
+# country only, to keep the header small
+MAX_ACCESSION_KEYS = 50
+DATASET_KEY = 'dataset'
+SUMMARY_KEY = 'summary'
+UNSAFE_REGEX = re.compile(r'[^\w.-]+')
+
+logger = logging.getLogger(__name__)
+
+purged = []  # keys purged without PURGE_URLS
+
+
+def tag(response, keys):
+    """Add the keys to the response's surrogate key header."""
+    existing = response.get(KEY_HEADER, '').split()
+    for key in keys:
+        if key not in existing:
+            existing.append(key)
+    response[KEY_HEADER] = ' '.join(existing)
+
+
+def genus_key(taxon):
+    return 'genus-' + _safe(taxon.split()[0]) if taxon else None
+
+
+def country_key(origcty):
+    return 'country-' + _safe(origcty) if origcty else None
+
+
+def accession_key(accenumb):
+    return 'acc-' + _safe(accenumb) if accenumb else None
+
+
+def row_keys(rows):
+    """Return the keys for the accession records (dicts with any of
+    taxon, origcty and accenumb).
+    """
+    keys = set()
+    for row in rows:
+        keys.add(genus_key(row.get('taxon', None)))
+        keys.add(country_key(row.get('origcty', None)))
+        if len(rows) <= MAX_ACCESSION_KEYS:
+            keys.add(accession_key(row.get('accenumb', None)))
+    keys.discard(None)
+    return sorted(keys)
+
+
+def lookup_keys(accenumbs, rows, found):
+    """Return the keys for a response about the requested accessions,
+    with the rows of those which were found. The load scripts purge the
+    genus and summary keys, not the acc- ones, so unless all of them
+    were found, the response is tagged summary too.
+    """
+    keys = [accession_key(accenumb)
+            for accenumb in accenumbs[:MAX_ACCESSION_KEYS]]
+    keys += row_keys(rows)
+    if not found:
+        keys.append(SUMMARY_KEY)
+    return [key for key in keys if key]
+
+
+def purge(keys):
+    """Invalidate the cached responses tagged with any of the keys."""
+    keys = list(keys)
+    if not PURGE_URLS:
+        purged.extend(keys)
+        logger.info('purged (locally) %s', ' '.join(keys))
+        return
+    for url in PURGE_URLS:
+        request = Request(url, headers={PURGE_HEADER: ' '.join(keys)})
+        request.get_method = lambda: PURGE_METHOD
+        urlopen(request, timeout=PURGE_TIMEOUT).close()
+        logger.info('purged %s at %s', ' '.join(keys), url)
+
+
+def _safe(val):
+    return UNSAFE_REGEX.sub('_', val.strip())
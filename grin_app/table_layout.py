@@ -0,0 +1,165 @@
+"""
+Physical layout of the tables the views query: the indexes they need,
+the order of the rows on disk, and reports of dead tuples and index
+usage. Used by the maintain_layout management command.
+
+The accessions are clustered along a Z-order (space filling) curve, by
+the geohash of geographic_coord, so the accessions in a map viewport
+are on few, mostly contiguous pages. The evaluation data are clustered
+by descriptor_name (and observation_numeric), so the observations of a
+trait are contiguous, which is what partitioning by descriptor would
+give the trait queries, without changing the tables the loads write.
+CLUSTER rewrites the table, also removing the dead tuples of the loads'
+updates, but it locks out readers while it runs.
+
+The correlation reported for the cluster keys is postgres' estimate of
+how well the physical row order follows them (1 is perfectly ordered).
+It decays as rows are added or updated, until the next CLUSTER.
+"""
+
+SCHEMA = 'lis_germplasm'
+# table, index name, unique, method and key: the indexes the views
+# depend on (see the views' SQL and schema.sql)
+REQUIRED_INDEXES = [
+    ('grin_accession', 'grin_accession_accenumb_idx', True,
+     'btree (accenumb)'),
+    ('grin_accession', 'grin_accession_accession_key_idx', False,
+     'btree (accession_key)'),
+    ('grin_accession', 'grin_accession_acqdate_idx', False,
+     'btree (acqdate) WHERE (acqdate IS NOT NULL)'),
+    ('grin_accession', 'grin_accession_colldate_idx', False,
+     'btree (colldate) WHERE (colldate IS NOT NULL)'),
+    ('grin_accession', 'grin_accession_geographic_coord_idx', False,
+     'gist (geographic_coord)'),
+    ('grin_accession', 'grin_accession_geohash_idx', False,
+     'btree (public.st_geohash((geographic_coord)::public.geometry, 10))'),
+    ('grin_accession', 'grin_accession_taxon_fts_idx', False,
+     'gin (taxon_fts)'),
+    ('grin_accession_facet', 'grin_accession_facet_cell_idx', False,
+     'btree (cell_x, cell_y)'),
+    ('grin_accession_timeline', 'grin_accession_timeline_genus_idx', False,
+     'btree (date_field, lower(genus))'),
+    ('grin_evaluation_metadata',
+     'grin_evaluation_metadata_descriptor_name_idx', False,
+     'btree (descriptor_name)'),
+    ('grin_evaluation_metadata', 'grin_evaluation_metadata_taxon_idx',
+     False, 'btree (taxon)'),
+    ('legumes_grin_evaluation_data',
+     'legumes_grin_evaluation_data_accession_key_descriptor_name_idx',
+     False, 'btree (accession_key, descriptor_name)'),
+    ('legumes_grin_evaluation_data',
+     'legumes_grin_evaluation_data_descr_name_numeric_idx', False,
+     'btree (descriptor_name, observation_numeric)'),
+    ('legumes_grin_evaluation_data',
+     'legumes_grin_evaluation_data_descr_name_value_idx', False,
+     'btree (descriptor_name, observation_value)'),
+]
+# table: the index to cluster it by, and the pg_stats relation and
+# column with the correlation of its key
+CLUSTER_ORDER = {
+    'grin_accession': ('grin_accession_geohash_idx',
+                       'grin_accession_geohash_idx', 'st_geohash'),
+    'legumes_grin_evaluation_data': (
+        'legumes_grin_evaluation_data_descr_name_numeric_idx',
+        'legumes_grin_evaluation_data', 'descriptor_name'),
+}
+TABLES = sorted(set(index[0] for index in REQUIRED_INDEXES))
+TABLE_STATS_SQL = '''
+SELECT relname AS tablename, n_live_tup AS live, n_dead_tup AS dead,
+       pg_total_relation_size(relid) AS bytes,
+       GREATEST(last_vacuum, last_autovacuum) AS vacuumed,
+       GREATEST(last_analyze, last_autoanalyze) AS analyzed
+FROM pg_stat_user_tables
+WHERE schemaname = %(schema)s
+ORDER BY relname
+'''
+INDEX_STATS_SQL = '''
+SELECT s.relname AS tablename, s.indexrelname AS indexname,
+       s.idx_scan AS scans, pg_relation_size(s.indexrelid) AS bytes,
+       i.indisvalid AS valid, i.indisclustered AS clustered
+FROM pg_stat_user_indexes s
+JOIN pg_index i ON i.indexrelid = s.indexrelid
+WHERE s.schemaname = %(schema)s
+ORDER BY s.relname, s.indexrelname
+'''
+CORRELATION_SQL = '''
+SELECT correlation FROM pg_stats
+WHERE schemaname = %(schema)s AND tablename = %(tablename)s
+AND attname = %(attname)s
+'''
+
+
+def missing_indexes(cursor):
+    """Return the REQUIRED_INDEXES which don't exist, or are invalid
+    (e.g. left by a failed concurrent build).
+    """
+    cursor.execute('''
+    SELECT c.relname FROM pg_index i
+    JOIN pg_class c ON c.oid = i.indexrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %(schema)s AND i.indisvalid
+    ''', {'schema': SCHEMA})
+    valid = set(row[0] for row in cursor.fetchall())
+    return [index for index in REQUIRED_INDEXES if index[1] not in valid]
+
+
+def create_index(cursor, index):
+    """(Re)build the index, without blocking writes to the table.
+    Must not be called in a transaction.
+    """
+    table, name, unique, key = index
+    cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS %s.%s' % (SCHEMA, name))
+    cursor.execute('CREATE %sINDEX CONCURRENTLY %s ON %s.%s USING %s' % (
+        'UNIQUE ' if unique else '', name, SCHEMA, table, key))
+
+
+def cluster(cursor, table):
+    """Rewrite the table in its CLUSTER_ORDER, and update its stats."""
+    cursor.execute('CLUSTER %s.%s USING %s' % (
+        SCHEMA, table, CLUSTER_ORDER[table][0]))
+    analyze(cursor, table)
+
+
+def analyze(cursor, table):
+    cursor.execute('ANALYZE %s.%s' % (SCHEMA, table))
+
+
+def table_stats(cursor):
+    """Return the row counts, dead tuples (and their percentage), size,
+    and last vacuum and analyze times of the schema's tables, with the
+    correlation of the clustered tables' physical order.
+    """
+    cursor.execute(TABLE_STATS_SQL, {'schema': SCHEMA})
+    rows = _dictfetchall(cursor)
+    for row in rows:
+        total = row['live'] + row['dead']
+        row['dead_pct'] = round(100.0 * row['dead'] / total, 1) if total \
+            else 0.0
+        row['correlation'] = None
+        if row['tablename'] in CLUSTER_ORDER:
+            index, tablename, attname = CLUSTER_ORDER[row['tablename']]
+            cursor.execute(CORRELATION_SQL, {
+                'schema': SCHEMA,
+                'tablename': tablename,
+                'attname': attname,
+            })
+            found = cursor.fetchone()
+            row['correlation'] = found[0] if found else None
+    return rows
+
+
+def index_stats(cursor):
+    """Return the scan counts (since the stats were reset), size, and
+    validity of the schema's indexes.
+    """
+    cursor.execute(INDEX_STATS_SQL, {'schema': SCHEMA})
+    return _dictfetchall(cursor)
+
+
+def _dictfetchall(cursor):
+    """Return all rows from a cursor as a dict"""
+    columns = [col[0] for col in cursor.description]
+    return [
+        dict(zip(columns, row))
+        for row in cursor.fetchall()
+    ]
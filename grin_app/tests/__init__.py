@@ -19,6 +19,7 @@ def setup():
     _create_postgis()
     _load_schema()
     _load_test_data()
+    _refresh_facets()
 
 
 def teardown():
@@ -50,6 +51,17 @@ def _load_test_data():
     subprocess.check_call(args)
 
 
+def _refresh_facets():
+    args = [
+        'psql',
+        '-d', test_db['NAME'],
+        '-U', test_db['USER'],
+        '-c', 'SELECT lis_germplasm.grin_accession_facet_refresh()',
+        '-c', 'SELECT lis_germplasm.grin_accession_timeline_refresh()'
+    ]
+    subprocess.check_call(args)
+
+
 def _create_postgis():
     for cmd in ('CREATE EXTENSION postgis',
                 'CREATE EXTENSION postgis_topology',):
@@ -1,9 +1,11 @@
+import io
 import logging
+import struct
 import simplejson as json
 
 from lis_germplasm import settings
 from django_nose.tools import assert_ok
-from django.test import Client
+from django.test import Client, override_settings
 
 logger = logging.getLogger(__name__)
 
@@ -42,6 +44,253 @@ def test_search():
     pass
 
 
+def test_metrics():
+    res = c.get('/countries')
+    assert_ok(res)
+    assert 'sql;dur=' in res['Server-Timing']
+    res = c.get('/metrics')
+    assert_ok(res)
+    assert b'grin_app_sql_queries_total{view="countries"}' in res.content
+    pass
+
+
+def test_search_index():
+    """the in-process search index gives the same results, in the same
+    order, as the SQL search.
+    """
+    import os
+    import tempfile
+    from django.db import connection
+    from grin_app import search_index
+    path = os.path.join(tempfile.mkdtemp(), 'snapshot')
+    search_index.build(connection.cursor(), path)
+    index = search_index.SearchIndex(path)
+    # the arrays are loaded from the snapshot the symlink pointed to
+    assert os.path.islink(path)
+    assert index.path == os.path.realpath(path)
+    # a build in the same second gets a snapshot of its own, and the
+    # open one is kept
+    search_index.build(connection.cursor(), path)
+    assert os.path.realpath(path) != index.path
+    assert os.path.exists(os.path.join(index.path, 'lookups.json'))
+    assert index.lookup_accenumb('Ames 22714') is not None
+    assert index.lookup_accenumb('Ames 0') is None
+    assert index.observation_values('Ames 22714', 'SEEDWGT') == ['0.15']
+    bounds = {"ne_lat": 38.9, "ne_lng": -97.2, "sw_lat": 32.6, "sw_lng": -121.6}
+    for query in ({},
+                  {"taxon_query": "Medicago"},
+                  {"taxon_query": "lotus | lupinus"},
+                  {"country": "USA", "geocoded_only": True},
+                  {"limit_geo_bounds": True, "sw_lat": 20, "sw_lng": 60,
+                   "ne_lat": 40, "ne_lng": 80}):
+        query = dict(bounds, **query)
+        res = c.post('/search',
+                     content_type='application/json',
+                     data=json.dumps(query))
+        assert_ok(res)
+        expected = [f['properties']['gid'] for f in json.loads(res.content)]
+        search_index._index = index
+        try:
+            with override_settings(SEARCH_INDEX_PATH=path):
+                res = c.post('/search',
+                             content_type='application/json',
+                             data=json.dumps(query))
+        finally:
+            search_index._index = None
+        assert_ok(res)
+        assert expected == [f['properties']['gid']
+                            for f in json.loads(res.content)]
+    pass
+
+
+def test_search_delta():
+    query = {'taxon_query': 'Medicago', 'limit': 20, 'delta': True}
+    res = c.post('/search',
+                 content_type='application/json',
+                 data=json.dumps(query))
+    assert_ok(res)
+    first = json.loads(res.content)
+    assert first['reset']
+    assert len(first['add']) > 1
+    assert first['remove'] == []
+    # a smaller result drops some of the previous gids, adds nothing
+    query.update(limit=1, delta_token=first['token'])
+    res = c.post('/search',
+                 content_type='application/json',
+                 data=json.dumps(query))
+    assert_ok(res)
+    second = json.loads(res.content)
+    assert not second['reset']
+    assert second['add'] == []
+    assert len(second['remove']) == len(first['add']) - 1
+    pass
+
+
+def test_gid_tokens_bounded():
+    import base64
+    import zlib
+    from grin_app import gid_tokens
+    assert gid_tokens.decode(gid_tokens.encode([3, 17, 12])) == {3, 12, 17}
+    # a small token decompressing to far more than MAX_TOKEN_BYTES
+    bomb = zlib.compress(b'\x01' * (50 * 1024 * 1024), 9)
+    assert len(bomb) < 64 * 1024
+    token = base64.urlsafe_b64encode(bomb).decode('ascii')
+    assert gid_tokens.decode(token) is None
+    # within MAX_TOKEN_BYTES, but more than MAX_GIDS gids
+    token = gid_tokens.encode(range(1, gid_tokens.MAX_GIDS + 2))
+    assert gid_tokens.decode(token) is None
+    token = gid_tokens.encode(range(1, gid_tokens.MAX_GIDS + 1))
+    assert len(gid_tokens.decode(token)) == gid_tokens.MAX_GIDS
+    pass
+
+
+def test_search_region():
+    # Ames 22714 (Medicago lupulina) is at 68.55 E 30.32 N in test.sql
+    region = {
+        'type': 'MultiPolygon',
+        'coordinates': [
+            [[[68, 30], [69, 30], [69, 31], [68, 31], [68, 30]]],
+            [[[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]],
+        ],
+    }
+    query = {'taxon_query': 'Medicago', 'limit': 200,
+             'region': region, 'region_counts': True}
+    res = c.post('/search',
+                 content_type='application/json',
+                 data=json.dumps(query))
+    assert_ok(res)
+    results = json.loads(res.content)
+    accenumbs = [r['properties']['accenumb'] for r in results]
+    assert 'Ames 22714' in accenumbs
+    assert all(r['geometry']['coordinates'] for r in results)
+    counts = res['X-Region-Counts'].split(',')
+    assert int(counts[0]) == len(results)
+    assert counts[1] == '0'
+    pass
+
+
+def test_search_trait_filter():
+    # these accessions and trait evaluation data come from test.sql
+    query = '''
+    {"taxon_query":"Medicago","trait_filter":"SEEDWGT","trait_min":0.14}
+    '''
+    res = c.post('/search',
+                 content_type='application/json',
+                 data=query)
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert ['Ames 22714'] == [r['properties']['accenumb'] for r in results]
+    # Grif 12197 has PODPLACE 2, Grif 12200 PODPLACE 1
+    query = '''
+    {"taxon_query":"Vigna","trait_filter":"PODPLACE","trait_values":["2"]}
+    '''
+    res = c.post('/search',
+                 content_type='application/json',
+                 data=query)
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert ['Grif 12197'] == [r['properties']['accenumb'] for r in results]
+    pass
+
+
+def test_search_partial():
+    # the fallback when search hits its statement timeout
+    from django.test import RequestFactory
+    from grin_app.views import _search_partial
+    query = '{"taxon_query":"Medicago","limit":100000}'
+    req = RequestFactory().post('/search', content_type='application/json',
+                                data=query)
+    res = _search_partial(req)
+    assert_ok(res)
+    assert res['X-Partial-Result'] == 'true'
+    results = json.loads(res.content)
+    assert 0 < len(results) <= 200
+    pass
+
+
+def test_search_points():
+    # these accessions and trait evaluation data come from test.sql
+    query = '{"taxon_query":"Medicago","limit":200}'
+    res = c.post('/search_points',
+                 content_type='application/json',
+                 data=query)
+    assert_ok(res)
+    header_len = struct.unpack('<I', res.content[:4])[0]
+    header = json.loads(res.content[4:4 + header_len].decode('utf-8'))
+    assert header['count'] > 0
+    assert header['category'] == 'taxon'
+    assert 'Medicago lupulina' in header['categories']
+    for array in header['arrays']:
+        assert array['offset'] % 4 == 0
+    coords = header['arrays'][0]
+    assert coords['length'] == header['count'] * 2
+    pass
+
+
+def test_search_points_limit():
+    # the binary point buffer isn't capped at search's SEARCH_MAX_LIMIT
+    from django.db import connection
+    from grin_app import views
+    count = views.MAX_LIMIT + 1000
+    cursor = connection.cursor()
+    cursor.execute('''
+    INSERT INTO lis_germplasm.grin_accession
+      (gid, taxon, taxon_fts, genus, accenumb, latdec, longdec,
+       geographic_coord)
+    SELECT 9000000 + i, 'Testgenus pointus',
+           to_tsvector('english', 'Testgenus pointus'), 'Testgenus',
+           'TESTPOINT ' || i, 10 + i / 1000.0, 20 + i / 1000.0,
+           ST_SetSRID(ST_MakePoint(20 + i / 1000.0, 10 + i / 1000.0), 4326)
+    FROM generate_series(1, %s) AS i
+    ''', [count])
+    try:
+        query = json.dumps({'taxon_query': 'Testgenus', 'limit': count})
+        res = c.post('/search_points',
+                     content_type='application/json',
+                     data=query)
+        assert_ok(res)
+        header_len = struct.unpack('<I', res.content[:4])[0]
+        header = json.loads(res.content[4:4 + header_len].decode('utf-8'))
+        assert header['count'] == count
+        # while search is capped
+        res = c.post('/search',
+                     content_type='application/json',
+                     data=query)
+        assert_ok(res)
+        assert len(json.loads(res.content)) == views.MAX_LIMIT
+    finally:
+        cursor.execute('''
+        DELETE FROM lis_germplasm.grin_accession WHERE gid > 9000000
+        ''')
+    pass
+
+
+def test_export():
+    from django.db import connection
+    # these accessions and trait evaluation data come from test.sql
+    res = c.get('/export', {'taxon_query': 'Medicago',
+                            'descriptor_name': 'SEEDWGT'})
+    assert_ok(res)
+    assert 'no-store' in res['Cache-Control']
+    # the cursor's transaction is held while streaming, so it isn't
+    # declared WITH HOLD
+    assert connection.in_atomic_block
+    lines = b''.join(res.streaming_content).decode('utf-8').splitlines()
+    assert not connection.in_atomic_block
+    assert lines[0].startswith('gid,taxon,')
+    assert lines[0].endswith(',observation_values')
+    assert len(lines) > 1
+    assert any('Ames 22714' in line and '0.15' in line for line in lines)
+    # resuming after the last gid returns nothing more
+    last_gid = lines[-1].split(',')[0]
+    res = c.get('/export', {'taxon_query': 'Medicago',
+                            'format': 'geojsonseq',
+                            'after_gid': last_gid})
+    assert_ok(res)
+    assert b''.join(res.streaming_content) == b''
+    pass
+
+
 def test_countries():
     res = c.get('/countries')
     assert_ok(res)
@@ -51,6 +300,63 @@ def test_countries():
     pass
 
 
+def test_countries_shared_cache():
+    # read-only GET responses are cacheable by a shared cache
+    res = c.get('/countries')
+    assert_ok(res)
+    assert 'public' in res['Cache-Control']
+    assert 's-maxage' in res['Cache-Control']
+    assert 'Cookie' not in res.get('Vary', '')
+    assert len(res.cookies) == 0
+    pass
+
+
+def test_facets():
+    res = c.get('/facets')
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert len(results['country']) > 0
+    assert len(results['taxon']) > 0
+    assert results['taxon']['Medicago lupulina'] > 0
+    assert sum(results['geocoded'].values()) > 0
+    res = c.get('/facets', {'limit_geo_bounds': 'true',
+                            'sw_lat': 29, 'sw_lng': 67,
+                            'ne_lat': 31, 'ne_lng': 69})
+    assert_ok(res)
+    results = json.loads(res.content)
+    # only the geocoded Ames 22714, from test.sql is near Loralai
+    assert results['country'] == {'PAK': 1}
+    assert results['geocoded'] == {'true': 1}
+    pass
+
+
+def test_timeline():
+    # Ames 22714 was collected 1993-05-23 and acquired 1995-10-16
+    query = json.dumps({'taxon_query': 'Medicago lupulina',
+                        'acqdate_min': '1995-10-16', 'acqdate_max': 1995,
+                        'colldate_min': 1993})
+    res = c.post('/search', content_type='application/json', data=query)
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert 'Ames 22714' in [r['properties']['accenumb'] for r in results]
+    assert all(r['properties']['acqdate'].startswith('1995')
+               for r in results)
+    # precomputed per genus and country
+    res = c.get('/timeline', {'taxon_query': 'Medicago', 'country': 'PAK'})
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert results['date_field'] == 'acqdate'
+    assert dict(results['years'])[1995] > 0
+    # live, and ignoring the date_field's own range
+    res = c.get('/timeline', {'taxon_query': 'Medicago lupulina',
+                              'date_field': 'colldate', 'country': 'PAK',
+                              'colldate_min': 2000})
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert dict(results['years'])[1993] > 0
+    pass
+
+
 def test_accession_detail():
     # this accession number exists in test.sql (or should)
     accession = 'Ames 22714'
@@ -63,6 +369,98 @@ def test_accession_detail():
     pass
 
 
+def test_accession_popup():
+    # these accessions and trait evaluation data come from test.sql
+    res = c.get('/accession_popup', {'accenumb': 'Ames  22714,Ames 2672'})
+    assert_ok(res)
+    results = json.loads(res.content)
+    detail = results['Ames 22714']
+    assert detail['accession']['properties']['taxon'] == 'Medicago lupulina'
+    assert 'taxon_fts' not in detail['accession']['properties']
+    assert any(rec['descriptor_name'] == 'SEEDWGT'
+               for rec in detail['evaluation'])
+    assert len(results['Ames 2672']['evaluation']) > 0
+    pass
+
+
+def test_accession_key():
+    # case and whitespace variants resolve to the same accession_key
+    res = c.get('/accession_detail', {'accenumb': ' ames   22714 '})
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert results[0]['properties']['accenumb'] == 'Ames 22714'
+    res = c.get('/evaluation_detail', {'accenumb': 'GRIF 12202'})
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert 'Nigeria' == results[0]['origin']
+    query = '''
+    {"accession_ids":["grif  12197"],"descriptor_name":"PODPLACE"}
+    '''
+    res = c.post('/evaluation_search',
+                 content_type='application/json',
+                 data=query)
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert [('Grif 12197', '2')] == [(r['accenumb'], r['observation_value'])
+                                     for r in results]
+    pass
+
+
+def test_accession_key_suffix():
+    # test.sql has SEEDWGT data for Ames 22714, Ames 22714 A (suffixed)
+    # and 99001 (no prefix), which all get their own accession_key
+    res = c.get('/evaluation_detail', {'accenumb': 'Ames 22714'})
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert ['0.15'] == [r['observation_value'] for r in results
+                        if r['descriptor_name'] == 'SEEDWGT']
+    res = c.get('/evaluation_detail', {'accenumb': 'ames 22714  a'})
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert ['0.21'] == [r['observation_value'] for r in results]
+    assert 'A' == results[0]['accession_surfix']
+    res = c.get('/evaluation_detail', {'accenumb': '99001'})
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert ['0.3'] == [r['observation_value'] for r in results]
+    pass
+
+
+def test_surrogate_keys():
+    from django.core.management import call_command
+    from grin_app import surrogate_keys
+    res = c.get('/accession_detail', {'accenumb': 'Ames 22714'})
+    assert_ok(res)
+    keys = res['Surrogate-Key'].split()
+    for key in ('dataset', 'acc-Ames_22714', 'genus-Medicago',
+                'country-PAK'):
+        assert key in keys
+    assert 'summary' not in keys
+    # responses for unknown accessions are purged by any reload
+    for url, accenumb in (('/accession_detail', 'Ames 0'),
+                          ('/evaluation_detail', 'Ames 0'),
+                          ('/accession_popup', 'Ames 22714,Ames 0')):
+        res = c.get(url, {'accenumb': accenumb})
+        assert_ok(res)
+        assert 'summary' in res['Surrogate-Key'].split()
+    # without SURROGATE_PURGE_URLS the purge is only recorded
+    call_command('purge_cache', 'genus-Medicago', 'summary')
+    assert surrogate_keys.purged[-2:] == ['genus-Medicago', 'summary']
+    pass
+
+
+def test_maintain_layout():
+    from django.core.management import call_command
+    out = io.StringIO()
+    call_command('maintain_layout', '--cluster', stdout=out)
+    report = out.getvalue()
+    # schema.sql has all the indexes the views need
+    assert 'MISSING' not in report
+    assert 'clustering grin_accession...' in report
+    assert 'grin_accession_geohash_idx' in report
+    pass
+
+
 def test_evaluation_descr_names():
     """it's OK if results is empty json, because the test.sql is
     necesarily incomplete, and the query involves a join between
@@ -72,6 +470,13 @@ def test_evaluation_descr_names():
     assert_ok(res)
     assert len(res.content) > 0
     results = json.loads(res.content)
+    # other params, e.g. cache busters or the search's, are ignored
+    res = c.get('/evaluation_descr_names', {'taxon': 'Medicago',
+                                            'country': 'PAK',
+                                            'trait_filter': 'SEEDWGT',
+                                            'limit_geo_bounds': 'true'})
+    assert_ok(res)
+    assert 'SEEDWGT' in json.loads(res.content)
     pass
 
 
@@ -120,6 +525,357 @@ def test_evaluation_metadata():
     pass
 
 
+def test_evaluation_search_accession_set():
+    # these accessions and trait evaluation data come from test.sql
+    query = '''
+    {"taxon_query":"Medicago","limit":200,"register_accession_set":true}
+    '''
+    res = c.post('/search',
+                 content_type='application/json',
+                 data=query)
+    assert_ok(res)
+    handle = res['X-Accession-Set']
+    assert len(handle) > 0
+    query = json.dumps({'accession_set': handle, 'descriptor_name': 'SEEDWGT'})
+    res = c.post('/evaluation_search',
+                 content_type='application/json',
+                 data=query)
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert len(results) > 0
+    assert 'SEEDWGT' == results[0]['descriptor_name']
+    # unknown handles are reported as gone, so the client resends the ids
+    query = json.dumps({'accession_set': 'bogus', 'descriptor_name': 'SEEDWGT'})
+    res = c.post('/evaluation_search',
+                 content_type='application/json',
+                 data=query)
+    assert res.status_code == 410
+    pass
+
+
+def test_evaluation_grid():
+    # only Ames 22714 is geocoded and has SEEDWGT data in test.sql
+    query = '''
+    {"taxon_query":"Medicago","descriptor_name":"SEEDWGT",
+     "shape":"hex","cell_size":2}
+    '''
+    res = c.post('/evaluation_grid',
+                 content_type='application/json',
+                 data=query)
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert len(results['cells']) == 1
+    cell = results['cells'][0]
+    assert 'Polygon' == cell['geometry']['type']
+    assert cell['properties']['count'] == 1
+    pass
+
+
+def test_trait_overlay_search():
+    # these accessions and trait evaluation data come from test.sql
+    query = '''
+    {"taxon_query":"Medicago","ne_lat":38.92522904714054,"ne_lng":-97.2509765625,"sw_lat":32.694865977875075,"sw_lng":-121.6845703125,"limit_geo_bounds":false,"geocoded_only":false,"country":"","accession_ids_inclusive":false,"limit":200,
+     "descriptor_name":"SEEDWGT","trait_scale":"local"}
+    '''
+    res = c.post('/trait_overlay_search',
+                 content_type='application/json',
+                 data=query)
+    assert_ok(res)
+    results = json.loads(res.content)
+    assert len(results['features']) > 0
+    assert 'geometry' in results['features'][0]
+    assert 'observation_values' not in results['features'][0]['properties']
+    assert len(results['trait_data']) > 0
+    assert 'SEEDWGT' == results['trait_data'][0]['descriptor_name']
+    pass
+
+
+def test_single_flight():
+    import threading
+    import time
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from grin_app import single_flight
+    calls = []
+
+    @single_flight.coalesced
+    def slow_view(req):
+        calls.append(1)
+        time.sleep(0.2)
+        return HttpResponse('{"a":1}', content_type='application/json')
+
+    factory = RequestFactory()
+    responses = []
+
+    def request(body):
+        req = factory.post('/slow', content_type='application/json',
+                           data=body)
+        responses.append(slow_view(req))
+
+    # key order differs, but the normalized params are identical
+    threads = [threading.Thread(target=request, args=(body,))
+               for body in ['{"x":1,"y":2}', '{"y":2,"x":1}'] * 4]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert len(responses) == 8
+    assert all(r.content == b'{"a":1}' for r in responses)
+    pass
+
+
+def test_rate_limits():
+    import threading
+    import time
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from grin_app import rate_limits
+
+    @rate_limits.limited('test')
+    def slow_view(req):
+        time.sleep(0.2)
+        return HttpResponse('{"a":1}', content_type='application/json')
+
+    factory = RequestFactory()
+    forwarded_for = rate_limits.FORWARDED_FOR
+    rate_limits.BUDGETS['test'] = {'rate': 0.5, 'burst': 2,
+                                   'concurrency': 1}
+    try:
+        # the burst, then the bucket is empty for this client only
+        codes = [slow_view(factory.get('/slow', REMOTE_ADDR='10.0.0.1'))
+                 for i in range(3)]
+        assert [r.status_code for r in codes] == [200, 200, 429]
+        assert codes[2]['Retry-After'] == '2'
+        res = slow_view(factory.get('/slow', REMOTE_ADDR='10.0.0.2'))
+        assert_ok(res)
+        # a second concurrent request of the same client is rejected
+        responses = []
+
+        def request():
+            req = factory.get('/slow', REMOTE_ADDR='10.0.0.3')
+            responses.append(slow_view(req))
+
+        threads = [threading.Thread(target=request) for i in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert sorted(r.status_code for r in responses) == [200, 429]
+        # behind a proxy, the client is the address the proxy appended,
+        # whatever the client sent
+        rate_limits.FORWARDED_FOR = True
+        for spoofed in ('', '1.1.1.1', '2.2.2.2, 3.3.3.3'):
+            req = factory.get('/slow', REMOTE_ADDR='10.0.0.9',
+                              HTTP_X_FORWARDED_FOR=', '.join(
+                                  filter(None, [spoofed, '10.0.0.4'])))
+            assert rate_limits._client(req, 'test')[0] == 'ip:10.0.0.4'
+        codes = [slow_view(factory.get(
+            '/slow', REMOTE_ADDR='10.0.0.9',
+            HTTP_X_FORWARDED_FOR='%d.1.1.1, 10.0.0.5' % i))
+            for i in range(3)]
+        assert [r.status_code for r in codes] == [200, 200, 429]
+    finally:
+        rate_limits.FORWARDED_FOR = forwarded_for
+        del rate_limits.BUDGETS['test']
+    pass
+
+
+def test_deadlines_timeout():
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from grin_app import deadlines, sql_metrics
+
+    def cheap_view(req):
+        return HttpResponse('partial')
+
+    def slow_view(req):
+        sql_metrics.cursor().execute('SELECT pg_sleep(2)')
+        return HttpResponse('full')
+
+    deadlines.TIMEOUTS['slow_view'] = 100
+    try:
+        with_fallback = deadlines.bounded(fallback=cheap_view)(slow_view)
+        without_fallback = deadlines.bounded()(slow_view)
+    finally:
+        del deadlines.TIMEOUTS['slow_view']
+    factory = RequestFactory()
+    res = with_fallback(factory.get('/slow'))
+    assert_ok(res)
+    assert res.content == b'partial'
+    assert res['X-Degraded'] == 'statement timeout'
+    res = without_fallback(factory.get('/slow'))
+    assert res.status_code == 503
+    pass
+
+
+def test_deadlines_supersede():
+    import threading
+    import time
+    from django.conf import settings as django_settings
+    from django.db import connection
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from grin_app import deadlines, sql_metrics
+
+    @deadlines.bounded()
+    def slow_view(req):
+        sql_metrics.cursor().execute('SELECT pg_sleep(%s)',
+                                     [float(req.GET['sleep'])])
+        return HttpResponse('full')
+
+    factory = RequestFactory()
+    responses = {}
+
+    def request(sleep):
+        req = factory.get('/slow', {'sleep': sleep})
+        req.COOKIES[django_settings.CSRF_COOKIE_NAME] = 'same browser'
+        try:
+            responses[sleep] = slow_view(req)
+        finally:
+            connection.close()
+
+    first = threading.Thread(target=request, args=(3,))
+    first.start()
+    time.sleep(0.5)
+    second = threading.Thread(target=request, args=(0,))
+    second.start()
+    first.join()
+    second.join()
+    assert responses[3].status_code == 409
+    assert_ok(responses[0])
+    pass
+
+
+def test_single_flight_superseded_leader():
+    # followers of a leader which was superseded run the view
+    # themselves, instead of getting the leader's 409
+    import threading
+    import time
+    from django.db.utils import OperationalError
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from grin_app import deadlines, single_flight
+    calls = []
+
+    class QueryCanceled(Exception):
+        pgcode = '57014'
+
+    @single_flight.coalesced
+    def slow_view(req):
+        calls.append(1)
+        time.sleep(0.2)
+        if len(calls) == 1:
+            running = deadlines._Request('default', 0)
+            running.superseded = True
+            deadlines._current.request = running
+            error = OperationalError('canceling statement')
+            error.__cause__ = QueryCanceled()
+            raise error
+        return HttpResponse('full')
+
+    factory = RequestFactory()
+    responses = []
+    errors = []
+
+    def request():
+        try:
+            responses.append(slow_view(factory.get('/slow')))
+        except OperationalError as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=request) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(errors) == 1
+    assert [r.content for r in responses] == [b'full', b'full']
+    pass
+
+
+def test_single_flight_timed_out_leader():
+    # followers of a leader which timed out get the fallback too, and
+    # don't run the slow query again
+    import threading
+    import time
+    from django.db import connection
+    from django.http import HttpResponse
+    from django.test import RequestFactory
+    from grin_app import deadlines, single_flight, sql_metrics
+    calls = []
+    fallback_calls = []
+
+    @single_flight.coalesced
+    def cheap_view(req):
+        fallback_calls.append(1)
+        time.sleep(0.2)
+        return HttpResponse('partial')
+
+    @single_flight.coalesced
+    def slow_view(req):
+        calls.append(1)
+        sql_metrics.cursor().execute('SELECT pg_sleep(2)')
+        return HttpResponse('full')
+
+    deadlines.TIMEOUTS['slow_view'] = 300
+    try:
+        view = deadlines.bounded(fallback=cheap_view)(slow_view)
+    finally:
+        del deadlines.TIMEOUTS['slow_view']
+    factory = RequestFactory()
+    responses = []
+
+    def request():
+        try:
+            responses.append(view(factory.get('/slow')))
+        finally:
+            connection.close()
+
+    threads = [threading.Thread(target=request) for i in range(3)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(calls) == 1
+    assert len(fallback_calls) == 1
+    assert [r.content for r in responses] == [b'partial'] * 3
+    assert all(r['X-Degraded'] == 'statement timeout' for r in responses)
+    pass
+
+
+def test_supersede_other_alias():
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from grin_app import deadlines
+    key = ('test_view', 'test_browser')
+    try:
+        # the previous request is on the primary, the newer one on a
+        # replica: the cancel goes to the primary
+        deadlines._running[key] = deadlines._Request('default', 99999)
+        with CaptureQueriesContext(connection) as queries:
+            deadlines._supersede(key, deadlines._Request('replica0', 1))
+        assert [q for q in queries if 'pg_cancel_backend' in q['sql']]
+        # the previous request is on a replica which is unavailable: no
+        # cancel is sent, and no other backend with its pid is hit
+        deadlines._running[key] = deadlines._Request('replica0', 99999)
+        with CaptureQueriesContext(connection) as queries:
+            deadlines._supersede(key, deadlines._Request('default', 1))
+        assert not [q for q in queries if 'pg_cancel_backend' in q['sql']]
+        assert deadlines._running[key].alias == 'default'
+    finally:
+        deadlines._running.pop(key, None)
+    pass
+
+
+def test_replica_lag():
+    # the test db is a primary, which counts as caught up
+    from grin_app import db_router
+    assert db_router._healthy('default')
+    assert db_router.read_alias() == 'default'
+    pass
+
+
 def test_string2num():
     from grin_app.views import _string2num as _fn
     assert isinstance(_fn('3.14'), type(3.14))
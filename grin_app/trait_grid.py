@@ -0,0 +1,139 @@
+"""
+Aggregate trait observations into square or hexagonal grid cells, for
+choropleth trait overlays. The binning and the per cell statistics are
+vectorized with NumPy.
+
+usage:
+
+features = trait_grid.numeric_cells(lng, lat, values, 'hex', 2.0)
+features = trait_grid.nominal_cells(lng, lat, values, 'square', 1.0,
+                                    categories)
+
+The results are GeoJSON Features, with the cell Polygon geometry and
+the statistics as properties.
+"""
+
+import math
+
+import numpy as np
+
+SHAPES = ('square', 'hex')
+QUANTILES = (0.25, 0.5, 0.75)
+SQRT3 = math.sqrt(3)
+
+
+def numeric_cells(lng, lat, values, shape, size):
+    """Return a Feature per cell with count, mean, min, max and the
+    QUANTILES of the values in the cell.
+    """
+    lng, lat = np.asarray(lng, float), np.asarray(lat, float)
+    values = np.asarray(values, float)
+    cells, inverse = _bin(lng, lat, shape, size)
+    # sort by cell, then value, so each cell's values are a sorted slice
+    order = np.lexsort((values, inverse))
+    sorted_values = values[order]
+    counts = np.bincount(inverse, minlength=len(cells))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sums = np.bincount(inverse, weights=values, minlength=len(cells))
+    quantiles = [_sorted_quantile(sorted_values, starts, counts, q)
+                 for q in QUANTILES]
+    features = []
+    for i, cell in enumerate(cells):
+        features.append(_feature(cell, shape, size, {
+            'count': int(counts[i]),
+            'mean': float(sums[i] / counts[i]),
+            'min': float(sorted_values[starts[i]]),
+            'max': float(sorted_values[starts[i] + counts[i] - 1]),
+            'quantiles': [float(q[i]) for q in quantiles],
+        }))
+    return features
+
+
+def nominal_cells(lng, lat, values, shape, size, categories):
+    """Return a Feature per cell with the count of the values in the
+    cell for each of the categories (values not in categories are
+    counted as 'other').
+    """
+    lng, lat = np.asarray(lng, float), np.asarray(lat, float)
+    cells, inverse = _bin(lng, lat, shape, size)
+    labels = list(categories) + ['other']
+    codes = dict((str(c), i) for i, c in enumerate(categories))
+    value_codes = np.array([codes.get(str(v), len(categories))
+                            for v in values], dtype=np.int64)
+    counts = np.bincount(inverse * len(labels) + value_codes,
+                         minlength=len(cells) * len(labels))
+    counts = counts.reshape(len(cells), len(labels))
+    features = []
+    for i, cell in enumerate(cells):
+        features.append(_feature(cell, shape, size, {
+            'count': int(counts[i].sum()),
+            'categories': dict((labels[j], int(counts[i, j]))
+                               for j in np.nonzero(counts[i])[0]),
+        }))
+    return features
+
+
+def _bin(lng, lat, shape, size):
+    """Return the unique (x, y) cell indexes, and the index into them of
+    each point. Hexagons are pointy-topped, in axial coordinates, with
+    size as the distance between the centers of neighbouring cells.
+    """
+    if shape == 'square':
+        x = np.floor(lng / size)
+        y = np.floor(lat / size)
+    else:
+        radius = size / SQRT3
+        q = (SQRT3 / 3 * lng - lat / 3) / radius
+        r = (2.0 / 3 * lat) / radius
+        x, y = _hex_round(q, r)
+    xy = np.stack((x, y), axis=1).astype(np.int64)
+    if len(xy) == 0:
+        return xy, np.zeros(0, dtype=np.int64)
+    cells, inverse = np.unique(xy, axis=0, return_inverse=True)
+    return cells, inverse.reshape(-1)
+
+
+def _hex_round(q, r):
+    """Round fractional axial hex coordinates to the nearest hexagon."""
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq, rr
+
+
+def _sorted_quantile(sorted_values, starts, counts, q):
+    """Linearly interpolated quantile of each sorted slice."""
+    pos = starts + q * (counts - 1)
+    lo = np.floor(pos).astype(np.int64)
+    hi = np.ceil(pos).astype(np.int64)
+    frac = pos - lo
+    return sorted_values[lo] * (1 - frac) + sorted_values[hi] * frac
+
+
+def _feature(cell, shape, size, properties):
+    x, y = int(cell[0]), int(cell[1])
+    if shape == 'square':
+        x0, y0 = x * size, y * size
+        ring = [[x0, y0], [x0 + size, y0], [x0 + size, y0 + size],
+                [x0, y0 + size], [x0, y0]]
+        center = [x0 + size / 2, y0 + size / 2]
+    else:
+        radius = size / SQRT3
+        cx = radius * SQRT3 * (x + y / 2.0)
+        cy = radius * 1.5 * y
+        ring = []
+        for k in range(7):
+            angle = math.radians(60 * (k % 6) - 30)
+            ring.append([cx + radius * math.cos(angle),
+                         cy + radius * math.sin(angle)])
+        center = [cx, cy]
+    properties['center'] = center
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Polygon', 'coordinates': [ring]},
+        'properties': properties,
+    }
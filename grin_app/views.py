@@ -1,25 +1,63 @@
+import csv
 import logging
+import math
 import simplejson as json
 import re
+import sys
 from functools import reduce
+from datetime import date, datetime
 from decimal import Decimal
 from django.conf import settings
-from django.db import connection
+from django.db import transaction
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
+from django.views.decorators.cache import never_cache
 from django.views.decorators.csrf import ensure_csrf_cookie
 from grin_app.ensure_nocache import ensure_nocache
+from grin_app.shared_cache import shared_cache
+from grin_app import (accession_sets, deadlines, gid_tokens, point_buffer,
+                      rate_limits, search_index, single_flight, sql_metrics,
+                      surrogate_keys, trait_grid)
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None  # parquet export is disabled
 
 # SRID 4326 is WGS 84 long lat unit=degrees, also the specification of the
 # geoometric_coord field in the grin_accessions table.
 SRID = 4326
 DEFAULT_LIMIT = 200
+# server side caps on the search limit param (higher for the binary
+# point buffer of search_points), and on the length of the list params
+# (accession ids, trait values)
+MAX_LIMIT = getattr(settings, 'SEARCH_MAX_LIMIT', 5000)
+MAX_POINTS_LIMIT = getattr(settings, 'SEARCH_POINTS_MAX_LIMIT', 250000)
+MAX_LIST_LENGTH = getattr(settings, 'MAX_LIST_LENGTH', 5000)
 TWO_PLACES = Decimal('0.01')
 ACCESSION_TAB = 'lis_germplasm.grin_accession'
 ACC_SELECT_COLS = (
     'gid', 'taxon', 'latdec', 'longdec', 'accenumb', 'elevation', 'cropname',
     'collsite', 'acqdate', 'origcty'
 )
+# passport data for the accession popup
+ACC_DETAIL_COLS = (
+    'gid', 'taxon', 'is_legume', 'genus', 'species', 'spauthor', 'subtaxa',
+    'subtauthor', 'cropname', 'avail', 'instcode', 'accenumb', 'acckey',
+    'collnumb', 'collcode', 'taxno', 'accename', 'acqdate', 'origcty',
+    'collsite', 'latitude', 'longitude', 'elevation', 'colldate', 'bredcode',
+    'sampstat', 'ancest', 'collsrc', 'donorcode', 'donornumb', 'othernumb',
+    'duplsite', 'storage', 'latdec', 'longdec', 'remarks', 'history',
+    'released'
+)
+EVAL_DETAIL_COLS = (
+    'accession_prefix', 'accession_number', 'accession_surfix',
+    'observation_value', 'descriptor_name', 'method_name', 'plant_name',
+    'taxon', 'origin', 'original_value', 'frequency', 'low', 'hign', 'mean',
+    'sdev', 'ssize', 'inventory_prefix', 'inventory_number',
+    'inventory_suffix', 'accession_comment'
+)
 # Brewer nominal category colors from chroma.js set1,2,3 concatenated:
 NOMINAL_COLORS = [
     "#e41a1c", "#377eb8", "#4daf4a", "#984ea3", "#ff7f00", "#ffff33",
@@ -39,6 +77,60 @@ ORDER_BY_FRAG = '''
  ) ASC, taxon, gid
 '''
 LIMIT_FRAG = 'LIMIT %(limit)s'
+# the region param (a GeoJSON Polygon or MultiPolygon) simplified by
+# region_tolerance degrees. it's compared as geography, to use the gist
+# index on geographic_coord, so the region's edges are geodesics.
+REGION_SQL = '''
+ ST_SimplifyPreserveTopology(
+  ST_SetSRID(ST_GeomFromGeoJSON(%(region)s), %(srid)s),
+  %(region_tolerance)s
+ )
+'''
+REGION_TYPES = ('Polygon', 'MultiPolygon')
+REGION_TOLERANCE = 0.01
+# resolve the accession_ids param (accenumb strings, in any case and
+# spacing) to the integer accession_key, which both the accession and
+# the evaluation tables are indexed on. see grin_accession_key() in
+# schema.sql
+ACCESSION_KEYS_FRAG = '''
+ accession_key IN (
+  SELECT accession_key FROM lis_germplasm.grin_accession_key
+  WHERE accenumb_norm IN (
+   SELECT lis_germplasm.grin_accession_norm(accession_id)
+   FROM unnest(%(accession_ids)s::text[]) AS accession_id
+  )
+ )'''
+# correlated subquery for joining search results with their trait
+# observations. postgres evaluates it only for rows surviving the LIMIT.
+TRAIT_VALUES_COL = '''
+ (SELECT array_agg(observation_value)
+  FROM lis_germplasm.legumes_grin_evaluation_data ev
+  WHERE ev.accession_key = grin_accession.accession_key
+  AND ev.descriptor_name = %(descriptor_name)s
+ ) AS observation_values
+'''
+# size of the grid cells in grin_accession_facet, must match
+# grin_accession_facet_refresh() in schema.sql
+FACET_GRID_DEGREES = 1
+FACET_CELL_WHERE_FRAG = '''
+ WHERE cell_x BETWEEN %(min_x)s AND %(max_x)s
+ AND cell_y BETWEEN %(min_y)s AND %(max_y)s
+'''
+# smallest evaluation_grid cell, in degrees
+MIN_GRID_CELL_SIZE = 0.1
+# export formats and content types. the export is streamed from a
+# server side cursor, EXPORT_BATCH_SIZE rows (a parquet row group) at a
+# time.
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'geojsonseq': 'application/geo+json-seq',
+    'parquet': 'application/vnd.apache.parquet',
+}
+EXPORT_BATCH_SIZE = 5000
+# the date columns of the search view's date range filters (a YYYY-MM-DD
+# date or a year, for its first or last day) and of the timeline view
+DATE_FIELDS = ('acqdate', 'colldate')
+YEAR_REGEX = re.compile(r'^\d{4}$')
 COUNTRY_REGEX = re.compile(r'[a-z]{3}', re.I)
 TAXON_FTS_BOOLEAN_REGEX = re.compile(r'^(\w+\s*[\||&]\s*\w+)+$')
 
@@ -73,6 +165,50 @@ GRIN_ACC_WHERE_FRAGS = {
             geographic_coord::geometry
            )''',
     },
+    'region': {
+        'include': lambda p: p.get('region', None),
+        'sql': 'ST_Intersects(geographic_coord, (%s)::geography)' % (
+            REGION_SQL),
+    },
+    'trait_range': {
+        'include': lambda p: p.get('trait_filter', None) and (
+            p.get('trait_min', None) is not None or
+            p.get('trait_max', None) is not None),
+        'sql': '''
+           accession_key IN (
+            SELECT accession_key
+            FROM lis_germplasm.legumes_grin_evaluation_data
+            WHERE descriptor_name = %(trait_filter)s
+            AND observation_numeric BETWEEN
+             COALESCE(%(trait_min)s::float8, '-Infinity') AND
+             COALESCE(%(trait_max)s::float8, 'Infinity')
+           )''',
+    },
+    'trait_values': {
+        'include': lambda p: p.get('trait_filter', None) and
+                                p.get('trait_values', None),
+        'sql': '''
+           accession_key IN (
+            SELECT accession_key
+            FROM lis_germplasm.legumes_grin_evaluation_data
+            WHERE descriptor_name = %(trait_filter)s
+            AND observation_value = ANY( %(trait_values)s )
+           )''',
+    },
+    'acqdate_range': {
+        'include': lambda p: p.get('acqdate_min', None) or
+                                p.get('acqdate_max', None),
+        'sql': '''
+           acqdate BETWEEN COALESCE(%(acqdate_min)s::date, '-infinity') AND
+           COALESCE(%(acqdate_max)s::date, 'infinity')''',
+    },
+    'colldate_range': {
+        'include': lambda p: p.get('colldate_min', None) or
+                                p.get('colldate_max', None),
+        'sql': '''
+           colldate BETWEEN COALESCE(%(colldate_min)s::date, '-infinity')
+           AND COALESCE(%(colldate_max)s::date, 'infinity')''',
+    },
 }
 
 GRIN_EVAL_WHERE_FRAGS = {
@@ -80,17 +216,9 @@ GRIN_EVAL_WHERE_FRAGS = {
         'include': lambda p: p.get('descriptor_name', None),
         'sql': 'descriptor_name = %(descriptor_name)s',
     },
-    'accession prefix': {
-        'include': lambda p: p.get('prefix', None),
-        'sql': 'accession_prefix = %(prefix)s',
-    },
-    'accession number': {
-        'include': lambda p: p.get('acc_num', None),
-        'sql': 'accession_number = %(acc_num)s',
-    },
-    'accession surfix': {
-        'include': lambda p: p.get('suffix', None),
-        'sql': 'accession_surfix = %(suffix)s',
+    'accession_ids': {
+        'include': lambda p: p.get('accession_ids', None),
+        'sql': ACCESSION_KEYS_FRAG,
     },
 }
 
@@ -103,8 +231,10 @@ def index(req):
     return render(req, 'grin_app/index.html', context=settings.BRANDING)
 
 
-@ensure_csrf_cookie
-@ensure_nocache
+@shared_cache
+@rate_limits.limited('cheap')
+@sql_metrics.instrumented
+@deadlines.bounded()
 def evaluation_descr_names(req):
     """Return JSON for all distinct trait descriptor names matching the
     given taxon. (the trait overlay choice is only available after a
@@ -115,10 +245,11 @@ def evaluation_descr_names(req):
     params = req.GET.dict()
     assert 'taxon' in params, 'missing taxon param'
     assert params['taxon'], 'empty taxon param'
-    params['taxon_query'] = params['taxon']
+    # only the taxon filters the names, any other params are ignored
+    sql_params = {'taxon_query': params['taxon']}
     where_clauses = [
         val['sql'] for key, val in GRIN_ACC_WHERE_FRAGS.items()
-        if val['include'](params)
+        if val['include'](sql_params)
         ]
     if len(where_clauses) == 0:
         where_sql = ''
@@ -128,43 +259,48 @@ def evaluation_descr_names(req):
     SELECT DISTINCT descriptor_name
     FROM lis_germplasm.legumes_grin_evaluation_data
     JOIN lis_germplasm.grin_accession
-    USING (accenumb)
+    USING (accession_key)
     %s
     ORDER BY descriptor_name
     ''' % where_sql
-    sql_params = {'taxon_query': params['taxon']}
-    cursor = connection.cursor()
+    cursor = sql_metrics.cursor()
     # logger.info(cursor.mogrify(sql, sql_params))
     cursor.execute(sql, sql_params)
     names = [row[0] for row in cursor.fetchall()]
-    result = json.dumps(names)
-    response = HttpResponse(result, content_type='application/json')
+    response = _json_response(names)
+    surrogate_keys.tag(response, [surrogate_keys.SUMMARY_KEY])
     return response
 
 
 @ensure_csrf_cookie
 @ensure_nocache
+@rate_limits.limited('cheap')
+@sql_metrics.instrumented
+@deadlines.bounded()
 def evaluation_search(req):
     """Return JSON array of observation_value for all trait records
     matching a set of accession ids, and matching the descriptor_name
     field. Used for creating map markers or map overlays with specific
-    accesions' trait data.
+    accesions' trait data. The accession ids may be given by the
+    accession_ids param, or by an accession_set handle from search.
     """
     assert req.method == 'POST', 'POST request method required'
     params = json.loads(req.body)
-    assert 'accession_ids' in params, 'missing accession_ids param'
     assert 'descriptor_name' in params, 'missing descriptor_name param'
+    accession_ids = _accession_ids(params)
+    if accession_ids is None:
+        return _accession_set_gone(params)
     sql = '''
     SELECT accenumb, descriptor_name, observation_value
      FROM lis_germplasm.legumes_grin_evaluation_data
-     WHERE descriptor_name = %(descriptor_name)s 
-     AND accenumb IN %(accession_ids)s
-    '''
+     WHERE descriptor_name = %%(descriptor_name)s
+     AND %s
+    ''' % ACCESSION_KEYS_FRAG
     sql_params = {
         'descriptor_name': params['descriptor_name'],
-        'accession_ids': tuple(params['accession_ids'])
+        'accession_ids': accession_ids
     }
-    cursor = connection.cursor()
+    cursor = sql_metrics.cursor()
     # logger.info(cursor.mogrify(sql, sql_params))
     cursor.execute(sql, sql_params)
     rows = _dictfetchall(cursor)
@@ -173,9 +309,7 @@ def evaluation_search(req):
     for row in rows:
         row['observation_value'] = _string2num(row['observation_value'])
         rows_clean.append(row)
-    result = json.dumps(rows_clean, use_decimal=True)
-    response = HttpResponse(result, content_type='application/json')
-    return response
+    return _json_response(rows_clean)
 
 
 def _string2num(s):
@@ -193,24 +327,83 @@ def _string2num(s):
     return s
 
 
+def _accession_ids(params):
+    """Return the list of accession ids for the accession_ids param, or
+    for the accession_set param (a handle registered by search). Returns
+    None if the accession_set handle has expired.
+    """
+    if params.get('accession_set', None):
+        return accession_sets.lookup(params['accession_set'])
+    assert 'accession_ids' in params, 'missing accession_ids param'
+    return _capped(list(params['accession_ids']), 'accession_ids')
+
+
+def _accession_set_gone(params):
+    """Return a 410 response for an expired accession_set handle, so the
+    client knows to send the accession_ids instead.
+    """
+    result = {
+        'error': 'accession_set expired, resend accession_ids',
+        'accession_set': params['accession_set'],
+    }
+    return _json_response(result, status=410)
+
+
 @ensure_csrf_cookie
 @ensure_nocache
+@rate_limits.limited('cheap')
+@sql_metrics.instrumented
+@deadlines.bounded()
+@single_flight.coalesced
 def evaluation_metadata(req):
     """Return JSON with trait metadata for the given taxon and trait
     descriptor_name. This enables the client to display a legend, and
-    colorize accessions by either numeric or category traits.
+    colorize accessions by either numeric or category traits. The
+    accession ids for the local trait scale may be given by the
+    accession_ids param, or by an accession_set handle from search.
     """
     assert req.method == 'POST', 'POST request method required'
     params = json.loads(req.body)
     assert 'taxon' in params, 'missing taxon param'
     assert 'descriptor_name' in params, 'missing descriptor_name param'
     assert 'trait_scale' in params, 'missing trait_scale param'
-    assert 'accession_ids' in params, 'missing accession_ids param'
     assert params['taxon'], 'empty taxon param'
-    result = None
-    cursor = connection.cursor()
-    # full text search on the taxon field in accessions table, also
-    # joining on taxon to get relevant evaluation metadata.
+    accession_ids = _accession_ids(params)
+    if accession_ids is None:
+        return _accession_set_gone(params)
+    cursor = sql_metrics.cursor()
+    trait_metadata = _trait_metadata(cursor, params)
+    if len(trait_metadata) == 0:
+        # early out if there were no matching metadata records
+        return HttpResponse({}, content_type='application/json')
+    obs_values = []
+    if trait_metadata[0]['obs_type'] == 'numeric' and \
+            params['trait_scale'] == 'local':
+        # must perform another query to restrict observations to this
+        # set of accessions (local, not global)
+        sql = '''
+        SELECT observation_value
+        FROM lis_germplasm.legumes_grin_evaluation_data
+        WHERE %s
+        AND descriptor_name = %%(descriptor_name)s
+        ''' % ACCESSION_KEYS_FRAG
+        sql_params = {
+            'descriptor_name': params['descriptor_name'],
+            'accession_ids': accession_ids
+        }
+        # logger.info(cursor.mogrify(sql, sql_params))
+        cursor.execute(sql, sql_params)
+        obs_values = [_string2num(row[0]) for row in cursor.fetchall()]
+    result = _trait_legend(params, trait_metadata, obs_values)
+    return _json_response(result)
+
+
+def _trait_metadata(cursor, params):
+    """Return the grin_evaluation_metadata records for the taxon and
+    descriptor_name params. Full text search on the taxon field in
+    accessions table, also joining on taxon to get relevant evaluation
+    metadata.
+    """
     sql_params = {
         'taxon_query': params['taxon'],
         'descriptor_name': params['descriptor_name']
@@ -234,29 +427,18 @@ def evaluation_metadata(req):
     ''' % where_sql
     # logger.info(cursor.mogrify(sql, sql_params))
     cursor.execute(sql, sql_params)
-    trait_metadata = _dictfetchall(cursor)
-    if len(trait_metadata) == 0:
-        # early out if there were no matching metadata records
-        return HttpResponse({}, content_type='application/json')
+    return _dictfetchall(cursor)
 
+
+def _trait_legend(params, trait_metadata, obs_values):
+    """Return the legend dict for the client, from the trait metadata
+    records. obs_values are the observations for the local trait scale
+    (they are ignored for the global scale, and for nominal traits).
+    """
+    result = None
     obs_type = trait_metadata[0]['obs_type']
     if obs_type == 'numeric':
         if params['trait_scale'] == 'local':
-            # must perform another query to restrict observations to this
-            # set of accessions (local, not global)
-            sql = '''
-            SELECT observation_value 
-            FROM lis_germplasm.legumes_grin_evaluation_data
-            WHERE accenumb IN %(accession_ids)s
-            AND descriptor_name = %(descriptor_name)s
-            '''
-            sql_params = {
-                'descriptor_name': params['descriptor_name'],
-                'accession_ids': tuple(params['accession_ids'])
-            }
-            # logger.info(cursor.mogrify(sql, sql_params))
-            cursor.execute(sql, sql_params)
-            obs_values = [_string2num(row[0]) for row in cursor.fetchall()]
             result = {
                 'taxon_query': params['taxon'],
                 'descriptor_name': params['descriptor_name'],
@@ -292,79 +474,45 @@ def evaluation_metadata(req):
             'obs_nominal_values': sorted(vals),
             'colors': colors,
         }
-    response = HttpResponse(json.dumps(result, use_decimal=True),
-                            content_type='application/json')
-    return response
+    return result
 
 
-@ensure_csrf_cookie
-@ensure_nocache
+@shared_cache
+@rate_limits.limited('cheap')
+@sql_metrics.instrumented
+@deadlines.bounded()
 def evaluation_detail(req):
     """Return JSON for all evalation/trait records matching this accession id.
     """
     assert req.method == 'GET', 'GET request method required'
     params = req.GET.dict()
-    assert 'accenumb' in params, 'missing accenumb param'
-    prefix = ''
-    acc_num = ''
-    suffix = ''
-    parts = params['accenumb'].split()
-    parts_len = len(parts)
-    if parts_len > 2:
-        prefix, acc_num, rest = parts[0], parts[1], parts[2:]  # suffix optional
-        suffix = ' '.join(rest)
-    elif parts_len == 2:
-        prefix, acc_num = parts[0], parts[1]
-    elif parts_len == 1:
-        acc_num = parts[0]
-    else:
-        acc_num = params['accenumb']
-    cursor = connection.cursor()
-    sql_params = {
-        'prefix': prefix,
-        'acc_num': acc_num,
-        'suffix': suffix,
-    }
+    assert params.get('accenumb', None), 'missing accenumb param'
+    cursor = sql_metrics.cursor()
+    sql_params = {'accession_ids': [params['accenumb']]}
     where_clauses = [
         val['sql'] for key, val in GRIN_EVAL_WHERE_FRAGS.items()
         if val['include'](sql_params)
         ]
     where_sql = ' AND '.join(where_clauses)
     sql = '''
-    SELECT accession_prefix,
-           accession_number,
-           accession_surfix,
-           observation_value,
-           descriptor_name,
-           method_name,
-           plant_name,
-           taxon,
-           origin,
-           original_value,
-           frequency,
-           low,
-           hign,
-           mean,
-           sdev,
-           ssize,
-           inventory_prefix,
-           inventory_number,
-           inventory_suffix,
-           accession_comment
+    SELECT %s
     FROM lis_germplasm.legumes_grin_evaluation_data
     WHERE %s
     ORDER BY descriptor_name
-    ''' % where_sql
+    ''' % (' , '.join(EVAL_DETAIL_COLS), where_sql)
     # logger.info(cursor.mogrify(sql, sql_params))
     cursor.execute(sql, sql_params)
     rows = _dictfetchall(cursor)
-    result = json.dumps(rows, use_decimal=True)
-    response = HttpResponse(result, content_type='application/json')
+    response = _json_response(rows)
+    surrogate_keys.tag(response, surrogate_keys.lookup_keys(
+        [params['accenumb']], rows, found=bool(rows)))
     return response
 
 
-@ensure_csrf_cookie
-@ensure_nocache
+@shared_cache
+@rate_limits.limited('cheap')
+@sql_metrics.instrumented
+@deadlines.bounded()
 def accession_detail(req):
     """Return JSON for all columns for a accession id."""
     assert req.method == 'GET', 'GET request method required'
@@ -372,21 +520,83 @@ def accession_detail(req):
     assert 'accenumb' in params, 'missing accenumb param'
     # fix me: name the columns dont select *!
     sql = '''
-    SELECT * FROM lis_germplasm.grin_accession WHERE accenumb = %(accenumb)s
-    '''
-    cursor = connection.cursor()
-    # logger.info(cursor.mogrify(sql, params))
-    cursor.execute(sql, params)
+    SELECT * FROM lis_germplasm.grin_accession WHERE %s
+    ''' % ACCESSION_KEYS_FRAG
+    sql_params = {'accession_ids': [params['accenumb']]}
+    cursor = sql_metrics.cursor()
+    # logger.info(cursor.mogrify(sql, sql_params))
+    cursor.execute(sql, sql_params)
     rows = _dictfetchall(cursor)
-    return _acc_search_response(rows)
+    keys = surrogate_keys.lookup_keys([params['accenumb']], rows,
+                                      found=bool(rows))
+    response = _acc_search_response(rows)
+    surrogate_keys.tag(response, keys)
+    return response
 
 
-@ensure_csrf_cookie
-@ensure_nocache
+@shared_cache
+@rate_limits.limited('cheap')
+@sql_metrics.instrumented
+@deadlines.bounded()
+def accession_popup(req):
+    """Return JSON with the passport data (as a GeoJSON Feature, or null
+    if unknown) and all the evaluation records of each of the accessions
+    in the accenumb param (comma separated), by accenumb. Replaces the
+    accession_detail and evaluation_detail calls for the accession
+    popup. The accessions are matched by the normalized accession_key,
+    and returned by accenumb as requested (with its whitespace
+    collapsed).
+    """
+    assert req.method == 'GET', 'GET request method required'
+    params = req.GET.dict()
+    assert params.get('accenumb', None), 'missing accenumb param'
+    accession_ids = _capped([' '.join(accenumb.split())
+                             for accenumb in params['accenumb'].split(',')],
+                            'accenumb')
+    sql_params = {'accession_ids': accession_ids}
+    cursor = sql_metrics.cursor()
+    requested_sql = '''
+    FROM unnest(%(accession_ids)s::text[]) AS requested
+    JOIN lis_germplasm.grin_accession_key
+    ON accenumb_norm = lis_germplasm.grin_accession_norm(requested)
+    '''
+    sql = '''
+    SELECT requested , %s %s
+    JOIN %s USING (accession_key)
+    ''' % (' , '.join(ACC_DETAIL_COLS), requested_sql, ACCESSION_TAB)
+    # logger.info(cursor.mogrify(sql, sql_params))
+    cursor.execute(sql, sql_params)
+    acc_rows = _dictfetchall(cursor)
+    sql = '''
+    SELECT requested , %s %s
+    JOIN lis_germplasm.legumes_grin_evaluation_data USING (accession_key)
+    ORDER BY descriptor_name
+    ''' % (' , '.join(EVAL_DETAIL_COLS), requested_sql)
+    # logger.info(cursor.mogrify(sql, sql_params))
+    cursor.execute(sql, sql_params)
+    eval_rows = _dictfetchall(cursor)
+    result = dict((accenumb, {'accession': None, 'evaluation': []})
+                  for accenumb in accession_ids)
+    requested = [row.pop('requested') for row in acc_rows]
+    keys = surrogate_keys.lookup_keys(
+        accession_ids, acc_rows, found=set(requested) == set(accession_ids))
+    for accenumb, feature in zip(requested, _acc_features(acc_rows)):
+        result[accenumb]['accession'] = feature
+    for row in eval_rows:
+        result[row.pop('requested')]['evaluation'].append(row)
+    response = _json_response(result)
+    surrogate_keys.tag(response, keys)
+    return response
+
+
+@shared_cache
+@rate_limits.limited('cheap')
+@sql_metrics.instrumented
+@deadlines.bounded()
 def countries(req):
     """Return a json array of countries for search filtering ui.
     """
-    cursor = connection.cursor()
+    cursor = sql_metrics.cursor()
     sql = '''
     SELECT DISTINCT origcty FROM lis_germplasm.grin_accession ORDER by origcty
     '''
@@ -394,60 +604,686 @@ def countries(req):
     # flatten into array, filter out bogus records like '' or 3 number codes
     results = [row[0] for row in cursor.fetchall()
                if row[0] and COUNTRY_REGEX.match(row[0])]
-    return HttpResponse(json.dumps(results), content_type='application/json')
+    response = _json_response(results)
+    surrogate_keys.tag(response, [surrogate_keys.SUMMARY_KEY])
+    return response
+
+
+@shared_cache
+@rate_limits.limited('cheap')
+@sql_metrics.instrumented
+@deadlines.bounded()
+def facets(req):
+    """Return JSON with the number of accessions per country, per taxon
+    and per geocoded status, for the search filtering ui. The counts are
+    precomputed by scripts/facet_counts.py. If limit_geo_bounds is true,
+    only the geocoded accessions in the grid cells overlapping the map
+    bounds are counted (so the counts are approximate at the edges).
+    """
+    assert req.method == 'GET', 'GET request method required'
+    params = req.GET.dict()
+    sql_params = {}
+    where_sql = ''
+    if params.get('limit_geo_bounds', None) == 'true':
+        sql_params = {
+            'min_x': _facet_cell(params.get('sw_lng', 0)),
+            'min_y': _facet_cell(params.get('sw_lat', 0)),
+            'max_x': _facet_cell(params.get('ne_lng', 0)),
+            'max_y': _facet_cell(params.get('ne_lat', 0)),
+        }
+        where_sql = FACET_CELL_WHERE_FRAG
+    sql = '''
+    SELECT GROUPING(origcty) = 0 AS by_country,
+           GROUPING(taxon) = 0 AS by_taxon,
+           origcty, taxon, geocoded, sum(accessions) AS accessions
+    FROM lis_germplasm.grin_accession_facet
+    %s
+    GROUP BY GROUPING SETS ((origcty), (taxon), (geocoded))
+    ''' % where_sql
+    cursor = sql_metrics.cursor()
+    # logger.info(cursor.mogrify(sql, sql_params))
+    cursor.execute(sql, sql_params)
+    result = {'country': {}, 'taxon': {}, 'geocoded': {}}
+    for row in _dictfetchall(cursor):
+        count = int(row['accessions'])
+        if row['by_country']:
+            # filter out bogus records like '' or 3 number codes
+            if row['origcty'] and COUNTRY_REGEX.match(row['origcty']):
+                result['country'][row['origcty']] = count
+        elif row['by_taxon']:
+            if row['taxon']:
+                result['taxon'][row['taxon']] = count
+        else:
+            result['geocoded'][str(row['geocoded']).lower()] = count
+    response = _json_response(result)
+    surrogate_keys.tag(response, [surrogate_keys.SUMMARY_KEY])
+    return response
+
+
+@shared_cache
+@rate_limits.limited('cheap')
+@sql_metrics.instrumented
+@deadlines.bounded()
+def timeline(req):
+    """Return JSON with the number of accessions per year of the
+    date_field param (acqdate or colldate), for a timeline slider, of
+    the accessions matching the search params (as for export): years is
+    a list of [year, count], and undated the count without a date. The
+    date_field's own range filter is ignored, so the slider shows the
+    whole timeline. Filtered by no more than a country and a genus (as
+    the taxon_query), the counts are precomputed by
+    scripts/facet_counts.py.
+    """
+    assert req.method == 'GET', 'GET request method required'
+    params = req.GET.dict()
+    date_field = params.get('date_field', 'acqdate')
+    assert date_field in DATE_FIELDS, 'invalid date_field param'
+    if params.get('trait_values', None):
+        params['trait_values'] = params['trait_values'].split(',')
+    frags = [
+        key for key, val in GRIN_ACC_WHERE_FRAGS.items()
+        if key != date_field + '_range' and val['include'](params)
+        ]
+    sql_params = _acc_sql_params(params)
+    sql_params['date_field'] = date_field
+    cursor = sql_metrics.cursor()
+    rows = None
+    if set(frags) <= {'country', 'fts_simple'}:
+        where_clauses = ['date_field = %(date_field)s']
+        if 'fts_simple' in frags:
+            where_clauses.append('lower(genus) = lower(%(genus)s)')
+            sql_params['genus'] = params['taxon_query'].strip()
+        if 'country' in frags:
+            where_clauses.append('origcty = %(country)s')
+        sql = '''
+        SELECT year, sum(accessions) AS accessions
+        FROM lis_germplasm.grin_accession_timeline
+        WHERE %s
+        GROUP BY year ORDER BY year
+        ''' % ' AND '.join(where_clauses)
+        # logger.info(cursor.mogrify(sql, sql_params))
+        cursor.execute(sql, sql_params)
+        rows = cursor.fetchall()
+        if not rows and 'fts_simple' in frags:
+            rows = None  # the taxon_query isn't a genus name
+    if rows is None:
+        where_clauses = [GRIN_ACC_WHERE_FRAGS[key]['sql'] for key in frags]
+        sql = '''
+        SELECT date_part('year', %s)::integer AS year, count(*) AS accessions
+        FROM %s
+        WHERE (%s)
+        GROUP BY year ORDER BY year
+        ''' % (date_field, ACCESSION_TAB, ' AND '.join(where_clauses))
+        # logger.info(cursor.mogrify(sql, sql_params))
+        cursor.execute(sql, sql_params)
+        rows = cursor.fetchall()
+    result = {
+        'date_field': date_field,
+        'years': [[year, int(count)] for year, count in rows
+                  if year is not None],
+        'undated': sum(int(count) for year, count in rows if year is None),
+    }
+    response = _json_response(result)
+    surrogate_keys.tag(response, [surrogate_keys.SUMMARY_KEY])
+    return response
+
+
+def _facet_cell(degrees):
+    """Return the facet grid cell index for the longitude or latitude."""
+    return int(math.floor(float(degrees) / FACET_GRID_DEGREES))
+
+
+@single_flight.coalesced
+def _search_partial(req):
+    """Cheaper fallback for search(), when it times out: the first
+    matches found, instead of the nearest to the map center, and no more
+    than DEFAULT_LIMIT, flagged as partial with the X-Partial-Result
+    header. Coalesced, as the coalesced followers of a search which
+    timed out all fall back at once.
+    """
+    params = json.loads(req.body)
+    params['limit'] = min(int(params.get('limit', DEFAULT_LIMIT)),
+                          DEFAULT_LIMIT)
+    cursor = sql_metrics.cursor()
+    rows = _acc_search_rows(cursor, params, ordered=False)
+    response = _search_response(params, rows)
+    response['X-Partial-Result'] = 'true'
+    return response
 
 
 @ensure_csrf_cookie
 @ensure_nocache
+@rate_limits.limited('expensive')
+@sql_metrics.instrumented
+@deadlines.bounded(fallback=_search_partial)
+@single_flight.coalesced
 def search(req):
-    """Search by map bounds and return GeoJSON results."""
+    """Search by map bounds and return GeoJSON results. The results can
+    be filtered by a trait: trait_filter is a descriptor_name, with
+    either a trait_min and/or trait_max numeric range, or a list of
+    nominal trait_values. If the register_accession_set param is true,
+    the accession ids of the results are kept on the server, and the
+    X-Accession-Set response header has a handle for them, for the
+    evaluation views. The results can be limited to a region (a GeoJSON
+    Polygon or MultiPolygon), and if the region_counts param is true,
+    the X-Region-Counts header has the comma separated counts of all
+    matching accessions (not limited) in each of the region's polygons.
+    The acqdate_min/acqdate_max and colldate_min/colldate_max params
+    (YYYY-MM-DD dates, or years) filter by acquisition and collection
+    date.
+
+    If the delta param is true, the result is JSON with only the changes
+    from the client's previous result, given by its delta_token param:
+    the gids to remove, the features to add, and the token for this
+    result. reset is true if there was no (valid) delta_token, and add
+    has all the features.
+    """
     assert req.method == 'POST', 'POST request method required'
     params = json.loads(req.body)
     # logger.info(params)
-    if 'limit' not in params:
-        params['limit'] = DEFAULT_LIMIT
+    cursor = sql_metrics.cursor()
+    rows = _acc_search_rows(cursor, params)
+    if params.get('register_accession_set', None) in (True, 'true'):
+        handle = accession_sets.register([row['accenumb'] for row in rows])
+    else:
+        handle = None
+    if params.get('region', None) and \
+            params.get('region_counts', None) in (True, 'true'):
+        counts = _region_counts(cursor, params)
+    else:
+        counts = None
+    response = _search_response(params, rows)
+    if handle:
+        response['X-Accession-Set'] = handle
+    if counts is not None:
+        response['X-Region-Counts'] = ','.join(str(n) for n in counts)
+    return response
+
+
+def _search_response(params, rows):
+    """Return the search response, with all the rows as GeoJSON, or with
+    the delta from the previous result.
+    """
+    if params.get('delta', None) not in (True, 'true'):
+        return _acc_search_response(rows)
+    previous = None
+    if params.get('delta_token', None):
+        previous = gid_tokens.decode(params['delta_token'])
+    reset = previous is None
+    if reset:
+        previous = set()
+    gids = [row['gid'] for row in rows]
+    result = {
+        'token': gid_tokens.encode(gids),
+        'reset': reset,
+        'remove': sorted(previous - set(gids)),
+        'add': _acc_features([row for row in rows
+                              if row['gid'] not in previous]),
+    }
+    return _json_response(result)
+
+
+def _region_counts(cursor, params):
+    """Return the count of accessions matching the search params in
+    each polygon of the region param, in order.
+    """
+    where_clauses = [
+        val['sql'] for key, val in GRIN_ACC_WHERE_FRAGS.items()
+        if key != 'region' and val['include'](params)
+        ]
+    where_clauses.append(
+        'ST_Intersects(geographic_coord, regions.geom::geography)')
+    sql = '''
+    SELECT count(gid)
+    FROM (SELECT (ST_Dump(%s)).*) regions
+    LEFT JOIN %s
+    ON %s
+    GROUP BY regions.path
+    ORDER BY regions.path
+    ''' % (REGION_SQL, ACCESSION_TAB, ' AND '.join(where_clauses))
+    sql_params = _acc_sql_params(params)
+    # logger.info(cursor.mogrify(sql, sql_params))
+    cursor.execute(sql, sql_params)
+    return [row[0] for row in cursor.fetchall()]
+
+
+@ensure_csrf_cookie
+@ensure_nocache
+@rate_limits.limited('expensive')
+@sql_metrics.instrumented
+@deadlines.bounded()
+def search_points(req):
+    """Search like search(), for geocoded accessions only, and return the
+    points as a binary buffer of typed arrays (see point_buffer) for
+    WebGL rendering. Points are categorized by taxon, or if the
+    descriptor_name param is given, by their (first) observation value
+    for it, e.g. a nominal trait.
+    """
+    assert req.method == 'POST', 'POST request method required'
+    params = json.loads(req.body)
+    params['geocoded_only'] = True
+    cursor = sql_metrics.cursor()
+    descriptor_name = params.get('descriptor_name', None)
+    index = search_index.get_index()
+    if not descriptor_name:
+        rows = _acc_search_rows(cursor, params, max_limit=MAX_POINTS_LIMIT)
+        labels = [row['taxon'] for row in rows]
     else:
-        params['limit'] = int(params['limit'])
+        if index is not None:
+            rows = _acc_search_rows(cursor, params,
+                                    max_limit=MAX_POINTS_LIMIT)
+            for row in rows:
+                row['observation_values'] = index.observation_values(
+                    row['accenumb'], descriptor_name)
+        else:
+            rows = _acc_search_rows(cursor, params,
+                                    extra_cols=(TRAIT_VALUES_COL,),
+                                    max_limit=MAX_POINTS_LIMIT)
+        labels = [row['observation_values'][0]
+                  if row['observation_values'] else None
+                  for row in rows]
+    with sql_metrics.serializing():
+        content = point_buffer.encode(
+            [float(row['longdec']) for row in rows],
+            [float(row['latdec']) for row in rows],
+            [row['gid'] for row in rows],
+            labels,
+            descriptor_name or 'taxon')
+    return HttpResponse(content, content_type='application/octet-stream')
+
+
+@never_cache
+@rate_limits.limited('expensive')
+@sql_metrics.instrumented
+@deadlines.bounded()
+def export(req):
+    """Stream all the accessions matching the search params (no limit)
+    as CSV, newline delimited GeoJSON features or Parquet, per the
+    format param. The search params are the same as search(), with
+    trait_values comma separated. If descriptor_name is given, the
+    accessions' observation values for it are included.
+
+    Rows are ordered by gid, so an interrupted export can be resumed
+    with the after_gid param: the gid of the last complete row (or of
+    the last row of the last complete row group, for parquet).
+
+    The server side cursor is declared in a transaction held until the
+    response is closed, as outside of one (in autocommit mode) it would
+    be declared WITH HOLD, and postgres would materialize the whole
+    result before the first row is streamed. Not cached, as the
+    responses may be hundreds of MB.
+    """
+    assert req.method == 'GET', 'GET request method required'
+    params = req.GET.dict()
+    fmt = params.get('format', 'csv')
+    assert fmt in EXPORT_FORMATS, 'invalid format param'
+    assert fmt != 'parquet' or pyarrow is not None, \
+        'parquet export requires pyarrow'
+    if params.get('trait_values', None):
+        params['trait_values'] = params['trait_values'].split(',')
     where_clauses = [
         val['sql'] for key, val in GRIN_ACC_WHERE_FRAGS.items()
         if val['include'](params)
         ]
+    sql_params = _acc_sql_params(params)
+    if params.get('after_gid', None):
+        where_clauses.append('gid > %(after_gid)s')
+        sql_params['after_gid'] = int(params['after_gid'])
     if len(where_clauses) == 0:
         where_sql = ''
     else:
         where_sql = 'WHERE (%s)' % ' AND '.join(where_clauses)
+    columns = list(ACC_SELECT_COLS)
     cols_sql = ' , '.join(ACC_SELECT_COLS)
-    sql = '''SELECT %s FROM %s %s %s %s''' % (
+    if params.get('descriptor_name', None):
+        columns.append('observation_values')
+        cols_sql += ' , ' + TRAIT_VALUES_COL
+    sql = 'SELECT %s FROM %s %s ORDER BY gid' % (
         cols_sql,
         ACCESSION_TAB,
-        where_sql,
-        ORDER_BY_FRAG,
-        LIMIT_FRAG
+        where_sql
     )
-    cursor = connection.cursor()
-    sql_params = {
-        'taxon_query': params.get('taxon_query', None),
-        'country': params.get('country', None),
-        'minx': float(params.get('sw_lng', 0)),
-        'miny': float(params.get('sw_lat', 0)),
-        'maxx': float(params.get('ne_lng', 0)),
-        'maxy': float(params.get('ne_lat', 0)),
-        'limit': params['limit'],
-        'srid': SRID,
+    atomic = transaction.atomic(using=sql_metrics.alias())
+    atomic.__enter__()
+    try:
+        cursor = sql_metrics.chunked_cursor()
+        # logger.info(cursor.mogrify(sql, sql_params))
+        cursor.execute(sql, sql_params)
+    except Exception:
+        atomic.__exit__(*sys.exc_info())
+        raise
+    writers = {
+        'csv': _export_csv,
+        'geojsonseq': _export_geojsonseq,
+        'parquet': _export_parquet,
+    }
+    batches = _export_batches(cursor, columns)
+    content = _ExportStream(writers[fmt](batches, columns), cursor, atomic)
+    response = StreamingHttpResponse(content,
+                                     content_type=EXPORT_FORMATS[fmt])
+    response['Content-Disposition'] = \
+        'attachment; filename="grin_accessions.%s"' % fmt
+    return response
+
+
+def _export_batches(cursor, columns):
+    """Yield lists of up to EXPORT_BATCH_SIZE row dicts from the cursor.
+    """
+    while True:
+        rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+        if not rows:
+            break
+        yield [dict(zip(columns, row)) for row in rows]
+
+
+class _ExportStream(object):
+    """An export's streamed content, closing its cursor and ending the
+    cursor's transaction when the response is closed (after streaming,
+    or when the client went away).
+    """
+
+    def __init__(self, content, cursor, atomic):
+        self.content = content
+        self.cursor = cursor
+        self.atomic = atomic
+        self.closed = False
+
+    def __iter__(self):
+        return iter(self.content)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self.content.close()
+            self.cursor.close()
+        finally:
+            self.atomic.__exit__(None, None, None)
+
+
+class _Echo(object):
+    """File-like object for csv.writer, returning the written line
+    instead of buffering it.
+    """
+
+    def write(self, value):
+        return value
+
+
+def _export_csv(batches, columns):
+    writer = csv.writer(_Echo())
+    yield writer.writerow(columns)
+    for rows in batches:
+        lines = []
+        for row in rows:
+            if row.get('observation_values', None) is not None:
+                row['observation_values'] = '|'.join(
+                    row['observation_values'])
+            lines.append(writer.writerow([row[col] for col in columns]))
+        yield ''.join(lines)
+
+
+def _export_geojsonseq(batches, columns):
+    for rows in batches:
+        yield ''.join(json.dumps(feature, use_decimal=True) + '\n'
+                      for feature in _acc_features(rows))
+
+
+class _ParquetSink(object):
+    """Write-only file-like object for the parquet writer, which keeps
+    the bytes written until they are taken for streaming.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _export_parquet(batches, columns):
+    types = {
+        'gid': pyarrow.int32(),
+        'latdec': pyarrow.float64(),
+        'longdec': pyarrow.float64(),
+        'elevation': pyarrow.int32(),
+        'acqdate': pyarrow.date32(),
+        'observation_values': pyarrow.list_(pyarrow.string()),
+    }
+    schema = pyarrow.schema([pyarrow.field(col, types.get(col,
+                                                          pyarrow.string()))
+                             for col in columns])
+    sink = _ParquetSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    for rows in batches:
+        for row in rows:
+            row['latdec'] = _float_or_none(row['latdec'])
+            row['longdec'] = _float_or_none(row['longdec'])
+        arrays = [pyarrow.array([row[field.name] for row in rows],
+                                type=field.type)
+                  for field in schema]
+        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+
+@ensure_csrf_cookie
+@ensure_nocache
+@rate_limits.limited('expensive')
+@sql_metrics.instrumented
+@deadlines.bounded()
+def trait_overlay_search(req):
+    """Search by map bounds, like search(), and join the matching
+    accessions with their observation values for the descriptor_name
+    param. Returns JSON with the GeoJSON features, the trait data (same
+    format as evaluation_search) and the trait legend (same format as
+    evaluation_metadata), so the client can draw a trait overlay in one
+    request, without posting the accession ids back to the server.
+    """
+    assert req.method == 'POST', 'POST request method required'
+    params = json.loads(req.body)
+    assert 'descriptor_name' in params, 'missing descriptor_name param'
+    assert 'trait_scale' in params, 'missing trait_scale param'
+    cursor = sql_metrics.cursor()
+    index = search_index.get_index()
+    if index is not None:
+        # the snapshot has the observations, no need to join them in SQL
+        rows = _acc_search_rows(cursor, params)
+        for row in rows:
+            row['observation_values'] = index.observation_values(
+                row['accenumb'], params['descriptor_name'])
+    else:
+        rows = _acc_search_rows(cursor, params,
+                                extra_cols=(TRAIT_VALUES_COL,))
+    trait_data = []
+    for row in rows:
+        for obs_value in row.pop('observation_values') or []:
+            trait_data.append({
+                'accenumb': row['accenumb'],
+                'descriptor_name': params['descriptor_name'],
+                'observation_value': _string2num(obs_value),
+            })
+    trait_legend = {}
+    if params.get('taxon_query', None):
+        legend_params = {
+            'taxon': params['taxon_query'],
+            'descriptor_name': params['descriptor_name'],
+            'trait_scale': params['trait_scale'],
+        }
+        trait_metadata = _trait_metadata(cursor, legend_params)
+        if len(trait_metadata) > 0:
+            obs_values = [d['observation_value'] for d in trait_data]
+            trait_legend = _trait_legend(legend_params, trait_metadata,
+                                         obs_values)
+    result = {
+        'features': _acc_features(rows),
+        'trait_data': trait_data,
+        'trait_metadata': trait_legend,
     }
+    return _json_response(result)
+
+
+@ensure_csrf_cookie
+@ensure_nocache
+@rate_limits.limited('expensive')
+@sql_metrics.instrumented
+@deadlines.bounded()
+def evaluation_grid(req):
+    """Return GeoJSON grid cells (square or hex, cell_size degrees
+    across) aggregating the observations for the descriptor_name of all
+    the geocoded accessions matching the search params (no limit). For
+    numeric traits each cell has count, mean, min, max and quartiles,
+    for nominal traits the count per obs_nominal_values category.
+    """
+    assert req.method == 'POST', 'POST request method required'
+    params = json.loads(req.body)
+    assert 'descriptor_name' in params, 'missing descriptor_name param'
+    shape = params.get('shape', 'square')
+    assert shape in trait_grid.SHAPES, 'invalid shape param'
+    cell_size = float(params.get('cell_size', 1))
+    assert cell_size >= MIN_GRID_CELL_SIZE, 'cell_size param too small'
+    params['geocoded_only'] = True
+    where_clauses = [
+        val['sql'] for key, val in GRIN_ACC_WHERE_FRAGS.items()
+        if val['include'](params)
+        ]
+    sql = '''
+    SELECT longdec, latdec, observation_value
+    FROM lis_germplasm.grin_accession
+    JOIN lis_germplasm.legumes_grin_evaluation_data
+    USING (accession_key)
+    WHERE descriptor_name = %%(descriptor_name)s
+    AND observation_value IS NOT NULL
+    AND %s
+    ''' % ' AND '.join(where_clauses)
+    sql_params = _acc_sql_params(params)
+    cursor = sql_metrics.cursor()
     # logger.info(cursor.mogrify(sql, sql_params))
     cursor.execute(sql, sql_params)
-    rows = _dictfetchall(cursor)
+    rows = cursor.fetchall()
+    lng = [row[0] for row in rows]
+    lat = [row[1] for row in rows]
+    values = [_string2num(row[2]) for row in rows]
+    trait_metadata = []
+    if params.get('taxon_query', None):
+        trait_metadata = _trait_metadata(cursor, {
+            'taxon': params['taxon_query'],
+            'descriptor_name': params['descriptor_name'],
+        })
+    if trait_metadata:
+        trait_type = trait_metadata[0]['obs_type']
+    elif all(isinstance(v, (int, float)) for v in values):
+        trait_type = 'numeric'
+    else:
+        trait_type = 'nominal'
+    result = {
+        'descriptor_name': params['descriptor_name'],
+        'trait_type': trait_type,
+        'shape': shape,
+        'cell_size': cell_size,
+    }
+    if trait_type == 'numeric':
+        numeric = [(x, y, v) for x, y, v in zip(lng, lat, values)
+                   if isinstance(v, (int, float))]
+        lng, lat, values = zip(*numeric) if numeric else ((), (), ())
+        result['cells'] = trait_grid.numeric_cells(lng, lat, values,
+                                                   shape, cell_size)
+    else:
+        categories = set()
+        for rec in trait_metadata:
+            categories |= set(rec['obs_nominal_values'])
+        if not categories:
+            categories = set(str(v) for v in values)
+        result['obs_nominal_values'] = sorted(categories)
+        result['cells'] = trait_grid.nominal_cells(
+            lng, lat, values, shape, cell_size, result['obs_nominal_values'])
+    return _json_response(result)
+
+
+def metrics(req):
+    """Return the SQL timing and query count totals per view, in
+    prometheus text format, for scraping.
+    """
+    assert req.method == 'GET', 'GET request method required'
+    return HttpResponse(sql_metrics.prometheus_text(),
+                        content_type='text/plain; version=0.0.4')
+
+
+def _acc_search_rows(cursor, params, extra_cols=(), ordered=True,
+                     max_limit=MAX_LIMIT):
+    """Return the accession records matching the search params: the
+    map bounds and the GRIN_ACC_WHERE_FRAGS filters, merged with or
+    replaced by any requested accession_ids. extra_cols are appended
+    to ACC_SELECT_COLS, and may use any of the search params. Uses the
+    in-process search_index when it's enabled, and there are no
+    extra_cols. Unless ordered, the SQL skips sorting by distance, and
+    returns any matching records up to the limit, which is capped at
+    max_limit.
+    """
+    if 'limit' not in params:
+        params['limit'] = DEFAULT_LIMIT
+    else:
+        params['limit'] = min(int(params['limit']), max_limit)
+    frags = [
+        key for key, val in GRIN_ACC_WHERE_FRAGS.items()
+        if val['include'](params)
+        ]
+    where_clauses = [GRIN_ACC_WHERE_FRAGS[key]['sql'] for key in frags]
+    if len(where_clauses) == 0:
+        where_sql = ''
+    else:
+        where_sql = 'WHERE (%s)' % ' AND '.join(where_clauses)
+    cols_sql = ' , '.join(ACC_SELECT_COLS + tuple(extra_cols))
+    sql = '''SELECT %s FROM %s %s %s %s''' % (
+        cols_sql,
+        ACCESSION_TAB,
+        where_sql,
+        ORDER_BY_FRAG if ordered else '',
+        LIMIT_FRAG
+    )
+    sql_params = _acc_sql_params(params)
+    rows = None
+    index = search_index.get_index()
+    if index is not None and not extra_cols:
+        # the in-process index answers the query, if it supports it
+        rows = index.search(frags, sql_params)
+    if rows is None:
+        # logger.info(cursor.mogrify(sql, sql_params))
+        cursor.execute(sql, sql_params)
+        rows = _dictfetchall(cursor)
 
     # when searching for a set of accessionIds, the result needs to
     # either get merged in addition to the SQL LIMIT results, or just
     # returned instead
     if params.get('accession_ids', None):
         if ',' in params['accession_ids']:
-            sql_params = {'accession_ids': params['accession_ids'].split(',')}
+            ids = params['accession_ids'].split(',')
         else:
-            sql_params = {'accession_ids': [params['accession_ids']]}
-        where_sql = 'WHERE accenumb = ANY( %(accession_ids)s )'
+            ids = [params['accession_ids']]
+        sql_params = {
+            'accession_ids': _capped(ids, 'accession_ids'),
+            'descriptor_name': params.get('descriptor_name', None),
+        }
+        where_sql = 'WHERE %s' % ACCESSION_KEYS_FRAG
         sql = 'SELECT %s FROM %s %s' % (
             cols_sql,
             ACCESSION_TAB,
@@ -471,10 +1307,81 @@ def search(req):
         else:
             # simple replace with these results
             rows = rows_with_requested_accessions
-    return _acc_search_response(rows)
+    return rows
+
+
+def _acc_sql_params(params):
+    """Return the SQL params for the GRIN_ACC_WHERE_FRAGS, ORDER_BY_FRAG
+    and LIMIT_FRAG from the search params.
+    """
+    return {
+        'taxon_query': params.get('taxon_query', None),
+        'country': params.get('country', None),
+        'descriptor_name': params.get('descriptor_name', None),
+        'trait_filter': params.get('trait_filter', None),
+        'trait_min': _float_or_none(params.get('trait_min', None)),
+        'trait_max': _float_or_none(params.get('trait_max', None)),
+        'trait_values': _capped([str(v) for v in
+                                 params.get('trait_values', None) or []],
+                                'trait_values'),
+        'minx': float(params.get('sw_lng', 0)),
+        'miny': float(params.get('sw_lat', 0)),
+        'maxx': float(params.get('ne_lng', 0)),
+        'maxy': float(params.get('ne_lat', 0)),
+        'limit': params.get('limit', DEFAULT_LIMIT),
+        'srid': SRID,
+        'region': _region_json(params.get('region', None)),
+        'region_tolerance': float(params.get('region_tolerance',
+                                             REGION_TOLERANCE)),
+        'acqdate_min': _date_or_none(params.get('acqdate_min', None)),
+        'acqdate_max': _date_or_none(params.get('acqdate_max', None),
+                                     end=True),
+        'colldate_min': _date_or_none(params.get('colldate_min', None)),
+        'colldate_max': _date_or_none(params.get('colldate_max', None),
+                                      end=True),
+    }
+
+
+def _region_json(region):
+    """Return the region param as GeoJSON text, for ST_GeomFromGeoJSON."""
+    if not region:
+        return None
+    if not isinstance(region, dict):
+        region = json.loads(region)
+    assert region.get('type', None) in REGION_TYPES, 'invalid region param'
+    return json.dumps(region)
+
+
+def _capped(values, name):
+    """Return the list param, asserting it's within MAX_LIST_LENGTH."""
+    assert len(values) <= MAX_LIST_LENGTH, 'too many %s' % name
+    return values
+
+
+def _float_or_none(val):
+    if val is None or val == '':
+        return None
+    return float(val)
+
+
+def _date_or_none(val, end=False):
+    """Return a date range param as a date: a YYYY-MM-DD date, or a year
+    for its first (or if end, last) day.
+    """
+    if val is None or val == '':
+        return None
+    val = str(val)
+    if YEAR_REGEX.match(val):
+        return date(int(val), 12, 31) if end else date(int(val), 1, 1)
+    return datetime.strptime(val, '%Y-%m-%d').date()
 
 
 def _acc_search_response(rows):
+    return _json_response(_acc_features(rows))
+
+
+def _acc_features(rows):
+    """Return a list of GeoJSON Features for the accession records."""
     geo_json = []
     # logger.info('results: %d' % len(rows))
     for rec in rows:
@@ -511,9 +1418,15 @@ def _acc_search_response(rows):
         geo_json_frag['properties']['from_api'] = True
 
         geo_json.append(geo_json_frag)
-    result = json.dumps(geo_json, use_decimal=True)
-    response = HttpResponse(result, content_type='application/json')
-    return response
+    return geo_json
+
+
+def _json_response(result, status=200):
+    """Return a JSON response, timing the serialization."""
+    with sql_metrics.serializing():
+        content = json.dumps(result, use_decimal=True)
+    return HttpResponse(content, status=status,
+                        content_type='application/json')
 
 
 def _dictfetchall(cursor):
@@ -35,7 +35,7 @@ else:
 # Application definition
 
 INSTALLED_APPS = (
-    'grin_app',
+    'grin_app.apps.GrinAppConfig',
     'django_extensions',
     'django.contrib.admin',
     'django.contrib.auth',
@@ -46,6 +46,9 @@ INSTALLED_APPS = (
     'django_nose',
 )
 
+# the read-only API views don't touch the session or request.user, so
+# their responses can be cached by a shared cache despite the session
+# middleware (see grin_app/shared_cache.py)
 MIDDLEWARE_CLASSES = (
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -89,9 +92,27 @@ DATABASES = {
         'PASSWORD': '',
         'HOST': '',
         'PORT': os.environ['PGPORT'],
+        # keep the connections, and their statement_timeout (see
+        # grin_app/deadlines.py), across requests
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# read-only replicas of the default database, for the views (see
+# grin_app/db_router.py), e.g. REPLICA_DB_HOSTS=replica1,replica2. The
+# load scripts always connect to the primary.
+REPLICA_DATABASES = []
+for i, host in enumerate(filter(None, os.getenv('REPLICA_DB_HOSTS',
+                                                '').split(','))):
+    alias = 'replica%d' % (i + 1)
+    DATABASES[alias] = dict(DATABASES['default'], HOST=host,
+                            TEST={'MIRROR': 'default'})
+    REPLICA_DATABASES.append(alias)
+DATABASE_ROUTERS = ['grin_app.db_router.ReplicaRouter']
+# use the primary when a replica lags by more than this many seconds
+REPLICA_MAX_LAG = 30
+REPLICA_LAG_CHECK_INTERVAL = 5  # seconds
+
 
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
@@ -147,6 +168,79 @@ BRANDING = {
     'site_abbrev': 'LIS',
 }
 
+# search result sets kept in each worker process, so the evaluation views
+# can accept an accession_set handle (see grin_app/accession_sets.py)
+ACCESSION_SET_MAX = 256
+ACCESSION_SET_TTL = 600  # seconds
+
+# Cache-Control max-age of the read-only GET views' responses, for
+# browsers, and s-maxage for shared caches, which are purged by the load
+# scripts (see grin_app/surrogate_keys.py)
+API_CACHE_MAX_AGE = 3600  # seconds
+API_CACHE_SHARED_MAX_AGE = 7 * 86400  # seconds
+
+# the reverse proxies' purge endpoints, e.g. http://localhost:6081/ for
+# varnish. Without them the purged keys are only recorded locally.
+SURROGATE_KEY_HEADER = 'Surrogate-Key'
+SURROGATE_PURGE_URLS = list(filter(None, os.getenv('SURROGATE_PURGE_URLS',
+                                                   '').split(',')))
+SURROGATE_PURGE_METHOD = 'PURGE'
+SURROGATE_PURGE_HEADER = 'Surrogate-Key'
+
+# log queries slower than this many milliseconds, with their EXPLAIN plan
+# (see grin_app/sql_metrics.py). None disables the slow query log.
+SQL_SLOW_QUERY_MS = os.getenv('SQL_SLOW_QUERY_MS', None)
+if SQL_SLOW_QUERY_MS is not None:
+    SQL_SLOW_QUERY_MS = float(SQL_SLOW_QUERY_MS)
+
+# symlink to the accessions snapshot for the in-process search index,
+# written by ./manage.py build_search_index or the --snapshot option of
+# the load scripts. None searches with PostGIS.
+SEARCH_INDEX_PATH = os.getenv('SEARCH_INDEX_PATH', None)
+
+# postgres statement_timeout for the views, in milliseconds by view name
+# (see grin_app/deadlines.py). search falls back to a partial result.
+# the export is streamed after the view returns, and its timeout bounds
+# each batch fetched from its cursor.
+STATEMENT_TIMEOUTS = {
+    'default': 10000,
+    'search': 5000,
+    'search_points': 15000,
+    'evaluation_grid': 15000,
+    'export': 30000,
+}
+
+# coalesce concurrent identical search and evaluation_metadata requests
+# (see grin_app/single_flight.py). Set SINGLE_FLIGHT_CACHE to the name of
+# a shared cache in CACHES to also coalesce them across worker processes.
+SINGLE_FLIGHT_CACHE = os.getenv('SINGLE_FLIGHT_CACHE', None)
+SINGLE_FLIGHT_WAIT = 30  # seconds
+SINGLE_FLIGHT_RESULT_TTL = 2  # seconds
+
+# token buckets (rate in requests per second, burst) and concurrent
+# requests per client and worker process, for the cheap and expensive
+# views (see grin_app/rate_limits.py). RATE_LIMIT_API_KEYS maps the
+# X-Api-Key of known clients to their own budgets (or {} for the
+# defaults).
+RATE_LIMITS = {
+    'cheap': {'rate': 20, 'burst': 100, 'concurrency': 8},
+    'expensive': {'rate': 2, 'burst': 30, 'concurrency': 3},
+}
+RATE_LIMIT_API_KEYS = dict((key, {}) for key in filter(
+    None, os.getenv('RATE_LIMIT_API_KEYS', '').split(',')))
+# identify clients by X-Forwarded-For, when behind reverse proxies, by
+# the address appended by the outermost of the trusted proxies
+RATE_LIMIT_FORWARDED_FOR = os.getenv('RATE_LIMIT_FORWARDED_FOR', '') == 'true'
+RATE_LIMIT_TRUSTED_PROXIES = int(os.getenv('RATE_LIMIT_TRUSTED_PROXIES', 1))
+# a shared cache in CACHES, to limit clients across worker processes
+RATE_LIMIT_CACHE = os.getenv('RATE_LIMIT_CACHE', None)
+# server side caps on the search limit param (search_points' binary
+# point buffer is meant for large map loads), and the length of the
+# accession id and trait value lists the views accept
+SEARCH_MAX_LIMIT = 5000
+SEARCH_POINTS_MAX_LIMIT = 250000
+MAX_LIST_LENGTH = 5000
+
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
 NOSE_ARGS = ['--nocapture',
              '--nologcapture']
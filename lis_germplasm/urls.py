@@ -21,12 +21,20 @@ urlpatterns = [
 
     url(r'^$', grin_views.index),
     url(r'^search$', grin_views.search),
+    url(r'^search_points$', grin_views.search_points),
+    url(r'^export$', grin_views.export),
     url(r'^countries$', grin_views.countries),
+    url(r'^facets$', grin_views.facets),
+    url(r'^timeline$', grin_views.timeline),
     url(r'^accession_detail$', grin_views.accession_detail),
+    url(r'^accession_popup$', grin_views.accession_popup),
     url(r'^evaluation_descr_names$', grin_views.evaluation_descr_names),
     url(r'^evaluation_detail$', grin_views.evaluation_detail),
     url(r'^evaluation_search$', grin_views.evaluation_search),
     url(r'^evaluation_metadata$', grin_views.evaluation_metadata),
+    url(r'^evaluation_grid$', grin_views.evaluation_grid),
+    url(r'^trait_overlay_search$', grin_views.trait_overlay_search),
+    url(r'^metrics$', grin_views.metrics),
 
     # disabling admin site until it's actually required/used --agr
     # url(r'^admin/', include(admin.site.urls)),
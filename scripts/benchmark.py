@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+
+"""
+Benchmark the grin_app views against a synthetic data set.
+
+1. Create a scratch database with the postgis extension and schema.sql,
+   then generate accessions and evaluation data into it (the tables are
+   truncated first!):
+
+ ./benchmark.py generate --db lis_gis_bench --accessions 100000
+
+2. Replay a mix of search and trait overlay requests through the views,
+   in process with the django test client (run from the repository
+   root, or with the repository root on PYTHONPATH), and report latency
+   percentiles, rows/sec and SQL query counts per endpoint:
+
+ ./benchmark.py run --db lis_gis_bench --requests 2000 --save baseline.json
+ ./benchmark.py run --db lis_gis_bench --requests 2000 --baseline baseline.json
+
+With --baseline the run exits non-zero if any endpoint's p95 latency
+regressed by more than --tolerance percent.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+import psycopg2
+
+PSQL_DSN = 'dbname=%s user=www'
+BATCH_SIZE = 50000
+
+GENERA = [
+    'Glycine', 'Phaseolus', 'Arachis', 'Pisum', 'Medicago', 'Trifolium',
+    'Vigna', 'Cicer', 'Lens', 'Vicia', 'Lupinus', 'Lotus', 'Cajanus',
+    'Chamaecrista', 'Apios',
+]
+EPITHETS = [
+    'vulgaris', 'max', 'hypogaea', 'sativum', 'sativa', 'repens',
+    'unguiculata', 'arietinum', 'culinaris', 'faba', 'albus',
+    'corniculatus', 'cajan', 'fasciculata', 'americana', 'lunatus',
+    'soja', 'radiata', 'pratense', 'lupulina', 'angustifolius',
+    'acutifolius', 'glabrata', 'villosa', 'ervilia',
+]
+# country code and approximate centroid (lat, lng), in rough order of
+# accessions held by GRIN, so the zipf weighting below is realistic.
+COUNTRIES = [
+    ('USA', 39.8, -98.6), ('CHN', 35.9, 104.2), ('IND', 21.1, 78.0),
+    ('TUR', 39.0, 35.2), ('MEX', 23.6, -102.5), ('IRN', 32.4, 53.7),
+    ('ETH', 9.1, 40.5), ('RUS', 55.8, 37.6), ('PER', -9.2, -75.0),
+    ('BRA', -14.2, -51.9), ('AFG', 33.9, 67.7), ('SYR', 34.8, 38.9),
+    ('ARG', -38.4, -63.6), ('ESP', 40.5, -3.7), ('KOR', 35.9, 127.8),
+    ('JPN', 36.2, 138.3), ('PAK', 30.4, 69.3), ('NGA', 9.1, 8.7),
+    ('GTM', 15.8, -90.2), ('COL', 4.6, -74.3), ('MAR', 31.8, -7.1),
+    ('GRC', 39.1, 21.8), ('ITA', 41.9, 12.6), ('KEN', -0.02, 37.9),
+    ('BOL', -16.3, -63.6), ('ECU', -1.8, -78.2), ('AUS', -25.3, 133.8),
+    ('ZAF', -30.6, 22.9), ('UKR', 48.4, 31.2), ('DZA', 28.0, 1.7),
+]
+NUMERIC_DESCRIPTORS = ['SEEDWEIGHT', 'PODLENGTH', 'PLANTHGT', 'MATURITY',
+                       'OIL', 'PROTEIN']
+NOMINAL_DESCRIPTORS = ['FLOWERCOL', 'SEEDSHAPE', 'PODPLACE', 'LEAFSHAPE',
+                       'PLANTHABIT', 'DRYPODCOL']
+NON_GEOCODED_FRACTION = 0.25
+EVALUATED_FRACTION = 0.3
+
+# request templates, with relative weights, shaped after the requests
+# the angular client makes (see ng-services/geoJson.js)
+TRAFFIC_MIX = [
+    ('search_pan', 40),
+    ('search_taxon', 20),
+    ('search_country', 5),
+    ('trait_overlay_search', 15),
+    ('evaluation_descr_names', 5),
+    ('accession_detail', 5),
+    ('evaluation_detail', 5),
+    ('countries', 2),
+    ('facets', 3),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='grin_app benchmark')
+    subparsers = parser.add_subparsers(dest='command')
+    gen = subparsers.add_parser('generate',
+                                help='generate a synthetic data set')
+    gen.add_argument('--db', required=True, help='scratch database name')
+    gen.add_argument('--accessions', type=int, default=100000)
+    gen.add_argument('--seed', type=int, default=1)
+    run = subparsers.add_parser('run', help='replay requests to the views')
+    run.add_argument('--db', required=True, help='scratch database name')
+    run.add_argument('--requests', type=int, default=1000)
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--save', help='write the results json to this file')
+    run.add_argument('--baseline', help='compare with this results json')
+    run.add_argument('--tolerance', type=float, default=20.0,
+                     help='allowed p95 regression in percent')
+    args = parser.parse_args()
+    if args.command == 'generate':
+        generate(args)
+    elif args.command == 'run':
+        results = replay(args)
+        print(json.dumps(results, indent=2, sort_keys=True))
+        if args.save:
+            with open(args.save, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        if args.baseline:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if _compare(baseline, results, args.tolerance):
+                sys.exit(1)
+    else:
+        parser.print_help()
+
+
+def generate(args):
+    """Truncate the accession and evaluation tables, and fill them with
+    args.accessions synthetic accessions, skewed like the real data: a
+    few genera, taxa and countries hold most of the accessions, and the
+    coordinates are clustered around the country centroids.
+    """
+    rnd = random.Random(args.seed)
+    conn = psycopg2.connect(PSQL_DSN % args.db)
+    cur = conn.cursor()
+    print('truncating tables...')
+    cur.execute('''TRUNCATE lis_germplasm.grin_accession,
+                   lis_germplasm.legumes_grin_evaluation_data,
+                   lis_germplasm.grin_evaluation_metadata''')
+    taxa = _zipf_choices(rnd, [
+        '%s %s' % (genus, rnd.choice(EPITHETS))
+        for genus in GENERA for _ in range(rnd.randint(3, 12))
+    ])
+    countries = _zipf_choices(rnd, COUNTRIES)
+    acc_buf = io.StringIO()
+    eval_buf = io.StringIO()
+    obs_ranges = defaultdict(lambda: [float('inf'), float('-inf')])
+    nominal = defaultdict(set)
+    for gid in range(1, args.accessions + 1):
+        taxon = rnd.choice(taxa)
+        genus, species = taxon.split(' ', 1)
+        country, lat, lng = rnd.choice(countries)
+        if rnd.random() < NON_GEOCODED_FRACTION:
+            lat = lng = 0.0
+            coord = '\\N'
+        else:
+            lat = max(-89.9, min(89.9, rnd.gauss(lat, 4)))
+            lng = max(-179.9, min(179.9, rnd.gauss(lng, 6)))
+            coord = 'SRID=4326;POINT(%s %s)' % (lng, lat)
+        acqdate = date(1920, 1, 1) + timedelta(days=rnd.randint(0, 36000))
+        prefix = 'PI' if gid % 3 else 'Ames'
+        accenumb = '%s %d' % (prefix, gid)
+        acc_buf.write('\t'.join(str(v) for v in (
+            gid, taxon, genus, species, genus.lower(), accenumb, acqdate,
+            country, 'synthetic site %d' % (gid % 997), rnd.randint(0, 3000),
+            lat, lng, coord, 't'
+        )) + '\n')
+        if rnd.random() < EVALUATED_FRACTION:
+            for name in rnd.sample(NUMERIC_DESCRIPTORS, 3):
+                value = round(abs(rnd.gauss(20, 8)), 2)
+                rng = obs_ranges[(taxon, name)]
+                rng[0], rng[1] = min(rng[0], value), max(rng[1], value)
+                eval_buf.write('\t'.join((
+                    prefix, str(gid), str(value), name, taxon, country
+                )) + '\n')
+            for name in rnd.sample(NOMINAL_DESCRIPTORS, 3):
+                value = str(rnd.randint(1, 6))
+                nominal[(taxon, name)].add(value)
+                eval_buf.write('\t'.join((
+                    prefix, str(gid), value, name, taxon, country
+                )) + '\n')
+        if gid % BATCH_SIZE == 0 or gid == args.accessions:
+            print('copying %d accessions...' % gid)
+            _copy(cur, acc_buf, 'grin_accession', (
+                'gid', 'taxon', 'genus', 'species', 'cropname', 'accenumb',
+                'acqdate', 'origcty', 'collsite', 'elevation', 'latdec',
+                'longdec', 'geographic_coord', 'is_legume'))
+            # the accenumb_trigger fills in accenumb
+            _copy(cur, eval_buf, 'legumes_grin_evaluation_data', (
+                'accession_prefix', 'accession_number', 'observation_value',
+                'descriptor_name', 'taxon', 'origin'))
+            acc_buf = io.StringIO()
+            eval_buf = io.StringIO()
+    print('updating evaluation metadata...')
+    for (taxon, name), (obs_min, obs_max) in obs_ranges.items():
+        cur.execute('''
+        INSERT INTO lis_germplasm.grin_evaluation_metadata
+          (taxon, descriptor_name, obs_type, obs_min, obs_max)
+        VALUES (%s, %s, 'numeric', %s, %s)''', (taxon, name, obs_min, obs_max))
+    for (taxon, name), values in nominal.items():
+        cur.execute('''
+        INSERT INTO lis_germplasm.grin_evaluation_metadata
+          (taxon, descriptor_name, obs_type, obs_nominal_values)
+        VALUES (%s, %s, 'nominal', %s)''', (taxon, name, sorted(values)))
+    print('updating full text search index...')
+    cur.execute('''UPDATE lis_germplasm.grin_accession
+                   SET taxon_fts = to_tsvector('english', coalesce(taxon,''))''')
+    print('updating facet counts...')
+    cur.execute('SELECT lis_germplasm.grin_accession_facet_refresh()')
+    cur.execute('SELECT lis_germplasm.grin_accession_timeline_refresh()')
+    conn.commit()
+    print('analyzing...')
+    conn.autocommit = True
+    cur.execute('ANALYZE')
+    print('done!')
+
+
+def replay(args):
+    """Replay args.requests requests drawn from TRAFFIC_MIX through the
+    views, and return the results dict per endpoint.
+    """
+    import django
+    from django.conf import settings
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lis_germplasm.settings')
+    settings.DATABASES['default']['NAME'] = args.db
+    settings.RATE_LIMITS = {}  # the replay is one client, at full speed
+    django.setup()
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext, \
+        setup_test_environment
+    setup_test_environment()
+
+    rnd = random.Random(args.seed)
+    sample = _sample_data(connection)
+    client = Client()
+    names = [name for name, weight in TRAFFIC_MIX]
+    weights = [weight for name, weight in TRAFFIC_MIX]
+    timings = defaultdict(list)
+    rows = defaultdict(int)
+    queries = defaultdict(int)
+    for i in range(args.requests):
+        name = rnd.choices(names, weights)[0]
+        method, path, data = _request(name, rnd, sample)
+        with CaptureQueriesContext(connection) as captured:
+            start = time.perf_counter()
+            if method == 'GET':
+                res = client.get(path, data)
+            else:
+                res = client.post(path, content_type='application/json',
+                                  data=json.dumps(data))
+            elapsed = time.perf_counter() - start
+        assert res.status_code == 200, '%s: %s' % (path, res.status_code)
+        timings[name].append(elapsed)
+        rows[name] += _count_rows(json.loads(res.content))
+        queries[name] += len(captured)
+    results = {}
+    for name, elapsed in timings.items():
+        elapsed.sort()
+        total = sum(elapsed)
+        results[name] = {
+            'requests': len(elapsed),
+            'p50_ms': round(_percentile(elapsed, 50) * 1000, 3),
+            'p95_ms': round(_percentile(elapsed, 95) * 1000, 3),
+            'p99_ms': round(_percentile(elapsed, 99) * 1000, 3),
+            'rows_per_sec': round(rows[name] / total, 1) if total else 0,
+            'queries_per_request': round(queries[name] / len(elapsed), 2),
+        }
+    return results
+
+
+def _sample_data(connection):
+    """Return values from the benchmark db to build requests with."""
+    cursor = connection.cursor()
+    cursor.execute('''SELECT DISTINCT genus, taxon, descriptor_name
+                      FROM lis_germplasm.grin_evaluation_metadata
+                      JOIN lis_germplasm.grin_accession USING (taxon)''')
+    taxa = cursor.fetchall()
+    cursor.execute('''SELECT accenumb FROM lis_germplasm.grin_accession
+                      ORDER BY random() LIMIT 1000''')
+    accenumbs = [row[0] for row in cursor.fetchall()]
+    return {'taxa': taxa, 'accenumbs': accenumbs}
+
+
+def _request(name, rnd, sample):
+    """Return the method, path and params for one request of the named
+    template.
+    """
+    genus, taxon, descriptor_name = rnd.choice(sample['taxa'])
+    country, lat, lng = rnd.choice(COUNTRIES)
+    zoom = rnd.choice((1, 2, 5, 10, 20, 40))  # degrees across the map
+    search = {
+        'taxon_query': '', 'country': '',
+        'ne_lat': lat + zoom / 2, 'ne_lng': lng + zoom,
+        'sw_lat': lat - zoom / 2, 'sw_lng': lng - zoom,
+        'limit_geo_bounds': True, 'geocoded_only': False,
+        'accession_ids_inclusive': False, 'trait_overlay': '',
+        'limit': rnd.choice((200, 200, 200, 500, 1000)),
+    }
+    if name == 'search_pan':
+        return 'POST', '/search', search
+    if name == 'search_taxon':
+        search['taxon_query'] = rnd.choice((genus, taxon))
+        search['limit_geo_bounds'] = rnd.random() < 0.5
+        return 'POST', '/search', search
+    if name == 'search_country':
+        search['country'] = country
+        search['limit_geo_bounds'] = False
+        return 'POST', '/search', search
+    if name == 'trait_overlay_search':
+        search['taxon_query'] = genus
+        search['descriptor_name'] = descriptor_name
+        search['trait_scale'] = rnd.choice(('local', 'global'))
+        return 'POST', '/trait_overlay_search', search
+    if name == 'evaluation_descr_names':
+        return 'GET', '/evaluation_descr_names', {'taxon': genus}
+    if name == 'accession_detail':
+        return 'GET', '/accession_detail', {
+            'accenumb': rnd.choice(sample['accenumbs'])}
+    if name == 'evaluation_detail':
+        return 'GET', '/evaluation_detail', {
+            'accenumb': rnd.choice(sample['accenumbs'])}
+    if name == 'countries':
+        return 'GET', '/countries', {}
+    if name == 'facets':
+        return 'GET', '/facets', {
+            'limit_geo_bounds': 'true', 'ne_lat': search['ne_lat'],
+            'ne_lng': search['ne_lng'], 'sw_lat': search['sw_lat'],
+            'sw_lng': search['sw_lng']}
+    raise ValueError(name)
+
+
+def _count_rows(result):
+    """Return the number of records in a view's json result."""
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, dict) and 'features' in result:
+        return len(result['features']) + len(result['trait_data'])
+    return 1
+
+
+def _compare(baseline, results, tolerance):
+    """Print the p95 change per endpoint vs. the baseline, and return
+    True if any endpoint regressed by more than tolerance percent.
+    """
+    regressed = False
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['p95_ms']
+        after = result['p95_ms']
+        change = (after - before) / before * 100 if before else 0
+        flag = ''
+        if change > tolerance:
+            flag = ' ** REGRESSION **'
+            regressed = True
+        print('%s: p95 %.1fms -> %.1fms (%+.1f%%)%s' % (
+            name, before, after, change, flag))
+    return regressed
+
+
+def _percentile(sorted_values, pct):
+    """Nearest rank percentile of an already sorted list."""
+    rank = max(0, int(round(pct / 100.0 * len(sorted_values))) - 1)
+    return sorted_values[rank]
+
+
+def _zipf_choices(rnd, items, s=1.1):
+    """Return a list to rnd.choice() from, in which the items are
+    repeated so their frequencies follow a zipf distribution, with the
+    first items the most frequent.
+    """
+    weights = [1.0 / (rank ** s) for rank in range(1, len(items) + 1)]
+    scale = 1000.0 / sum(weights)
+    choices = []
+    for item, weight in zip(items, weights):
+        choices.extend([item] * max(1, int(weight * scale)))
+    return choices
+
+
+def _copy(cur, buf, table, columns):
+    buf.seek(0)
+    sql = 'COPY lis_germplasm.%s (%s) FROM STDIN' % (table, ', '.join(columns))
+    cur.copy_expert(sql, buf)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,17 +3,38 @@
 """
 Update the evaluation metadata in
 lis_germplasm.grin_evaluation_metadata. Should be done after all
-genera evaluation data are loaded/updated.
+genera evaluation data are loaded/updated. Purges the reverse proxy
+cache of the evaluation data afterwards, unless --no-purge.
+
+Optionally write the search index snapshot, with the evaluation
+observations, afterwards (see grin_app/search_index.py):
+
+ ./evaluation_metadata.py --snapshot /path/to/snapshot
 """
+import argparse
 import psycopg2
 
-PSQL_DB = 'dbname=drupal user=www'
+from load import purge_cache, write_snapshot
+
+PSQL_DB = 'dbname=drupal user=www target_session_attrs=read-write'
 NOMINAL_THRESHOLD = 10
 
+try:
+    basestring
+except NameError:
+    # python3
+    basestring = str
+
 conn = psycopg2.connect(PSQL_DB)
 
 
 def main():
+    parser = argparse.ArgumentParser(description='update evaluation metadata')
+    parser.add_argument('--snapshot',
+                        help='write the search index snapshot to this path')
+    parser.add_argument('--no-purge', action='store_true',
+                        help="don't purge the reverse proxy cache")
+    args = parser.parse_args()
     cur = conn.cursor()
     print('deleting evaluation metadata...')
     cur.execute('DELETE FROM lis_germplasm.grin_evaluation_metadata')
@@ -44,6 +65,10 @@ def main():
                 obs_values=obs_values)
     print('committing...')
     conn.commit()
+    if args.snapshot:
+        write_snapshot(cur, args.snapshot)
+    if not args.no_purge:
+        purge_cache(['dataset'])
     print('done!')
 
 def _update_numeric_trait_metadata(**params):
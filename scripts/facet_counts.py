@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+"""
+Update the precomputed accession counts per country, taxon, geocoded
+status and 1 degree grid cell, for the facets view, and per genus,
+country and year, for the timeline view. Should be done after all
+genera are loaded/updated, and after latlng_consensus.py. Purges the
+reverse proxy cache of the summaries afterwards, unless --no-purge.
+"""
+
+import argparse
+
+import psycopg2
+
+from load import purge_cache
+
+PSQL_DB = 'dbname=drupal user=www target_session_attrs=read-write'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='update the facet counts')
+    parser.add_argument('--no-purge', action='store_true',
+                        help="don't purge the reverse proxy cache")
+    args = parser.parse_args()
+    print('updating facet counts...')
+    conn = psycopg2.connect(PSQL_DB)
+    cur = conn.cursor()
+    cur.execute('SELECT lis_germplasm.grin_accession_facet_refresh()')
+    cur.execute('SELECT lis_germplasm.grin_accession_timeline_refresh()')
+    conn.commit()
+    if not args.no_purge:
+        purge_cache(['summary'])
+
+
+if __name__ == '__main__':
+    main()
@@ -2,17 +2,26 @@
 
 """
 Update the FTS index for the taxon field. Should be done after all
-genera are loaded/updated.
+genera are loaded/updated. Purges the reverse proxy cache afterwards,
+unless --no-purge.
 """
 
+import argparse
+
 import psycopg2
 
-PSQL_DB = 'dbname=drupal user=www'
+from load import purge_cache
+
+PSQL_DB = 'dbname=drupal user=www target_session_attrs=read-write'
 DATE_FMT = '%Y%m%d'
 PNT_FMT = "ST_GeographyFromText('SRID=4326;POINT(%(longdec)s %(latdec)s)')"
 
 
 def main():
+    parser = argparse.ArgumentParser(description='update the taxon FTS index')
+    parser.add_argument('--no-purge', action='store_true',
+                        help="don't purge the reverse proxy cache")
+    args = parser.parse_args()
     print('updating full text search index...')
     conn = psycopg2.connect(PSQL_DB)
     cur = conn.cursor()
@@ -20,6 +29,8 @@ def main():
              SET taxon_fts = to_tsvector('english', coalesce(taxon,'')) '''
     cur.execute(sql)
     conn.commit()
+    if not args.no_purge:
+        purge_cache(['dataset'])
 
 
 if __name__ == '__main__':
@@ -0,0 +1,390 @@
+#!/usr/bin/env python
+
+"""
+Load/update the GRIN passport data of all legumes genera, in parallel,
+and swap the result in atomically. Replaces running load.py for each
+genus followed by latlng_consensus.py, fts_index.py and facet_counts.py.
+
+ ./ingest.py
+ ./ingest.py --genera Arachis Glycine --workers 4
+ ./ingest.py --resume  # after a failed run, rerun only the failed stages
+
+The refresh is a graph of stages, run in a process pool as soon as the
+stages they depend on are done:
+
+fetch:<genus>        download <genus>.csv to --csv-dir, unless it's there
+load:<genus>         load the csv into the genus staging table
+fts:<genus>          update the staging table's taxon_fts
+consensus            the lat/long sign consensus of each country, over
+                     the staging tables and the other genera's accessions
+coords:<genus>       apply the consensus to the staging table, and update
+                     geographic_coord
+swap                 in one transaction, replace the genera's accessions
+                     in grin_accession by the staging tables (keeping the
+                     gid of existing accessions), refresh the facet and
+                     timeline counts and drop the staging tables
+evaluation_metadata  run evaluation_metadata.py (independent of the
+                     passport data, so it runs alongside the loads)
+purge                purge the reverse proxy cache of the updated genera
+                     and of the summaries
+snapshot             with --snapshot, write the search index snapshot
+
+Each stage's status and timing (seconds) are recorded in the --state
+json file. With --resume the stages which are done are skipped. The
+staging tables are lis_germplasm.grin_accession_stage_<genus>, and are
+kept until the swap, so the stages can be resumed from another process.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import subprocess
+import sys
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from urllib.request import urlopen
+
+import petl as etl
+import psycopg2
+import psycopg2.extras
+
+from load import clean_row
+
+PSQL_DB = 'dbname=drupal user=www target_session_attrs=read-write'
+GENERA = [
+    'Apios', 'Arachis', 'Cajanus', 'Chamaecrista', 'Cicer', 'Glycine',
+    'Lens', 'Lotus', 'Lupinus', 'Medicago', 'Phaseolus', 'Pisum',
+    'Trifolium', 'Vicia', 'Vigna',
+]
+GRIN_CSV_URL = 'http://www.ars-grin.gov/~dbmuqs/cgi-bin/ex_mcpd.pl?genus=%s'
+GENUS_REGEX = re.compile(r'^[A-Za-z]+$')
+STAGE_TAB = 'lis_germplasm.grin_accession_stage_%s'
+CONSENSUS_TAB = 'lis_germplasm.grin_accession_stage_consensus'
+# passport columns loaded from the csv, in addition to the derived
+# taxon_fts and geographic_coord columns
+PASSPORT_COLS = (
+    'taxon', 'genus', 'species', 'spauthor', 'subtaxa', 'subtauthor',
+    'cropname', 'avail', 'instcode', 'accenumb', 'acckey', 'collnumb',
+    'collcode', 'taxno', 'accename', 'acqdate', 'origcty', 'collsite',
+    'latitude', 'longitude', 'elevation', 'colldate', 'bredcode',
+    'sampstat', 'ancest', 'collsrc', 'donorcode', 'donornumb', 'othernumb',
+    'duplsite', 'storage', 'latdec', 'longdec', 'remarks', 'history',
+    'released',
+)
+SWAP_COLS = PASSPORT_COLS + ('taxon_fts', 'geographic_coord')
+# coordinates closer to 0 than this have no sign (see latlng_consensus.py)
+SIGN_TOLERANCE = 0.00001
+BATCH_SIZE = 1000
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+MANAGE_PY = os.path.join(SCRIPTS_DIR, '..', 'manage.py')
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='load GRIN passport data of all genera in parallel')
+    parser.add_argument('--genera', nargs='+', default=GENERA,
+                        help='genera to load (default: all legumes)')
+    parser.add_argument('--csv-dir', default='.',
+                        help='directory of the <genus>.csv files')
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='number of stages to run at once')
+    parser.add_argument('--state', default='ingest-state.json',
+                        help='json file of the stages status and timings')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip the stages done by the previous run')
+    parser.add_argument('--snapshot',
+                        help='write the search index snapshot to this path')
+    args = parser.parse_args()
+    for genus in args.genera:
+        if not GENUS_REGEX.match(genus):
+            parser.error('invalid genus: %s' % genus)
+    state = {'genera': args.genera, 'stages': {}}
+    if args.resume and os.path.exists(args.state):
+        with open(args.state) as f:
+            state = json.load(f)
+        if state['genera'] != args.genera:
+            parser.error('--genera differs from the resumed run: %s' %
+                         ' '.join(state['genera']))
+    stages = build_stages(args)
+    started = time.time()
+    ok = run(stages, state, args)
+    print('%s in %.1f seconds' % ('done' if ok else 'FAILED',
+                                  time.time() - started))
+    sys.exit(0 if ok else 1)
+
+
+def build_stages(args):
+    """Return the stages of the refresh: a dict of stage name to
+    (names of the stages it depends on, function, argument).
+    """
+    options = {'csv_dir': args.csv_dir, 'snapshot': args.snapshot}
+    stages = {}
+    for genus in args.genera:
+        stages['fetch:' + genus] = ([], fetch, (options, genus))
+        stages['load:' + genus] = (['fetch:' + genus], load, (options, genus))
+        stages['fts:' + genus] = (['load:' + genus], fts, (options, genus))
+        stages['coords:' + genus] = (['consensus'], coords, (options, genus))
+    stages['consensus'] = (['fts:' + g for g in args.genera], consensus,
+                           (options, args.genera))
+    stages['swap'] = (['coords:' + g for g in args.genera], swap,
+                      (options, args.genera))
+    stages['evaluation_metadata'] = ([], evaluation_metadata, (options,))
+    stages['purge'] = (['swap', 'evaluation_metadata'], purge,
+                       (options, args.genera))
+    if args.snapshot:
+        stages['snapshot'] = (['swap', 'evaluation_metadata'], snapshot,
+                              (options,))
+    return stages
+
+
+def run(stages, state, args):
+    """Run the stages in a process pool, in dependency order, recording
+    their status in state and the --state file. After a stage fails no
+    new stages are started. Returns True if all stages are done.
+    """
+    done = set(name for name, rec in state['stages'].items()
+               if rec['status'] == 'done' and name in stages)
+    for name in sorted(done):
+        print('%s: done by the previous run' % name)
+    pending = set(stages) - done
+    running = {}
+    failed = False
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        while True:
+            ready = [name for name in pending
+                     if all(dep in done for dep in stages[name][0])]
+            for name in ([] if failed else sorted(ready)):
+                deps, func, arg = stages[name]
+                print('%s: started' % name)
+                running[pool.submit(_run_stage, func, arg)] = name
+                pending.remove(name)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                rec = future.result()
+                state['stages'][name] = rec
+                if rec['status'] == 'done':
+                    done.add(name)
+                    print('%s: done in %.1f seconds (%s)' % (
+                        name, rec['seconds'], rec['result']))
+                else:
+                    failed = True
+                    print('%s: FAILED in %.1f seconds\n%s' % (
+                        name, rec['seconds'], rec['error']))
+            _save_state(args.state, state)
+    return not failed and not pending
+
+
+def _run_stage(func, arg):
+    """Run a stage in a worker process. Returns its status record (the
+    error is returned as text, as database errors may not pickle).
+    """
+    started = time.time()
+    try:
+        result = func(*arg)
+        rec = {'status': 'done', 'result': result}
+    except Exception:
+        rec = {'status': 'failed', 'error': traceback.format_exc()}
+    rec['started'] = time.strftime('%Y-%m-%dT%H:%M:%S',
+                                   time.localtime(started))
+    rec['seconds'] = round(time.time() - started, 3)
+    return rec
+
+
+def _save_state(path, state):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def fetch(options, genus):
+    path = _csv_path(options, genus)
+    if os.path.exists(path):
+        return 'using %s' % path
+    tmp_path = path + '.tmp'
+    response = urlopen(GRIN_CSV_URL % genus)
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(response.read())
+    finally:
+        response.close()
+    os.replace(tmp_path, path)
+    return 'downloaded %s' % path
+
+
+def load(options, genus):
+    """Load the genus csv into a new staging table. Duplicate accenumbs
+    are skipped (load.py fails to insert them).
+    """
+    stage_tab = STAGE_TAB % genus.lower()
+    conn = psycopg2.connect(PSQL_DB)
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS %s' % stage_tab)
+    cur.execute('CREATE TABLE %s (LIKE lis_germplasm.grin_accession)' %
+                stage_tab)
+    cur.execute('ALTER TABLE %s ALTER COLUMN gid DROP NOT NULL' % stage_tab)
+    table = etl.fromcsv(_csv_path(options, genus), encoding='latin1')
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        stage_tab,
+        ', '.join(PASSPORT_COLS),
+        ', '.join('%%(%s)s' % col for col in PASSPORT_COLS))
+    seen = set()
+    rows = []
+    for n in etl.dicts(table):
+        clean_row(n)
+        if n['accenumb'] is not None:
+            if n['accenumb'] in seen:
+                continue
+            seen.add(n['accenumb'])
+        rows.append(n)
+    psycopg2.extras.execute_batch(cur, sql, rows, page_size=BATCH_SIZE)
+    conn.commit()
+    conn.close()
+    return 'loaded %d' % len(rows)
+
+
+def fts(options, genus):
+    conn = psycopg2.connect(PSQL_DB)
+    cur = conn.cursor()
+    cur.execute('''UPDATE %s
+    SET taxon_fts = to_tsvector('english', coalesce(taxon,''))
+    ''' % (STAGE_TAB % genus.lower()))
+    conn.commit()
+    conn.close()
+    return 'updated %d' % cur.rowcount
+
+
+def consensus(options, genera):
+    """Write the sign of the latitudes and longitudes of most accessions
+    of each country (0 if there's no consensus), like
+    latlng_consensus.py.
+    """
+    stages = ['SELECT genus, origcty, latdec, longdec FROM %s' %
+              (STAGE_TAB % genus.lower()) for genus in genera]
+    conn = psycopg2.connect(PSQL_DB)
+    cur = conn.cursor()
+    cur.execute('DROP TABLE IF EXISTS %s' % CONSENSUS_TAB)
+    cur.execute('''
+    CREATE TABLE %s AS
+    WITH stage AS (%s),
+    acc AS (
+     SELECT origcty, latdec, longdec FROM stage
+     UNION ALL
+     SELECT origcty, latdec, longdec FROM lis_germplasm.grin_accession
+     WHERE genus NOT IN (SELECT genus FROM stage WHERE genus IS NOT NULL)
+    )
+    SELECT origcty,
+     sign(count(*) FILTER (WHERE latdec > %%(tol)s) -
+          count(*) FILTER (WHERE latdec < -%%(tol)s))::integer AS lat_sign,
+     sign(count(*) FILTER (WHERE longdec > %%(tol)s) -
+          count(*) FILTER (WHERE longdec < -%%(tol)s))::integer AS lng_sign
+    FROM acc
+    WHERE origcty IS NOT NULL
+    GROUP BY origcty
+    ''' % (CONSENSUS_TAB, ' UNION ALL '.join(stages)),
+                {'tol': SIGN_TOLERANCE})
+    conn.commit()
+    conn.close()
+    return '%d countries' % cur.rowcount
+
+
+def coords(options, genus):
+    stage_tab = STAGE_TAB % genus.lower()
+    conn = psycopg2.connect(PSQL_DB)
+    cur = conn.cursor()
+    cur.execute('''
+    UPDATE %s acc
+    SET latdec = CASE WHEN acc.latdec * c.lat_sign < 0
+                 THEN -acc.latdec ELSE acc.latdec END,
+        longdec = CASE WHEN acc.longdec * c.lng_sign < 0
+                  THEN -acc.longdec ELSE acc.longdec END
+    FROM %s c
+    WHERE c.origcty = acc.origcty
+    AND (acc.latdec * c.lat_sign < 0 OR acc.longdec * c.lng_sign < 0)
+    ''' % (stage_tab, CONSENSUS_TAB))
+    flipped = cur.rowcount
+    cur.execute('''
+    UPDATE %s
+    SET geographic_coord = ST_SetSRID(ST_MakePoint(longdec, latdec), 4326)
+    ''' % stage_tab)
+    conn.commit()
+    conn.close()
+    return 'flipped %d' % flipped
+
+
+def swap(options, genera):
+    """Replace the genera's accessions by the staging tables, in one
+    transaction, so the views see either all the old or all the new
+    data. Existing accessions are updated in place, keeping their gid.
+    """
+    updates = ', '.join('%s = EXCLUDED.%s' % (col, col) for col in SWAP_COLS)
+    conn = psycopg2.connect(PSQL_DB)
+    cur = conn.cursor()
+    upserted = 0
+    for genus in genera:
+        stage_tab = STAGE_TAB % genus.lower()
+        cur.execute('''
+        DELETE FROM lis_germplasm.grin_accession acc
+        WHERE genus IN (SELECT genus FROM %s)
+        AND (accenumb IS NULL OR NOT EXISTS (
+         SELECT 1 FROM %s stage WHERE stage.accenumb = acc.accenumb))
+        ''' % (stage_tab, stage_tab))
+        cur.execute('''
+        INSERT INTO lis_germplasm.grin_accession (%s, is_legume)
+        SELECT %s, true FROM %s
+        ON CONFLICT (accenumb) DO UPDATE SET %s
+        ''' % (', '.join(SWAP_COLS), ', '.join(SWAP_COLS), stage_tab,
+               updates))
+        upserted += cur.rowcount
+    cur.execute('SELECT lis_germplasm.grin_accession_facet_refresh()')
+    cur.execute('SELECT lis_germplasm.grin_accession_timeline_refresh()')
+    for genus in genera:
+        cur.execute('DROP TABLE %s' % (STAGE_TAB % genus.lower()))
+    cur.execute('DROP TABLE %s' % CONSENSUS_TAB)
+    conn.commit()
+    conn.close()
+    return 'upserted %d' % upserted
+
+
+def evaluation_metadata(options):
+    # the purge stage purges the cache, once all the data is updated
+    _call([sys.executable, os.path.join(SCRIPTS_DIR, 'evaluation_metadata.py'),
+           '--no-purge'])
+    return 'updated'
+
+
+def purge(options, genera):
+    keys = ['genus-%s' % genus for genus in genera] + ['summary']
+    _call([sys.executable, MANAGE_PY, 'purge_cache'] + keys)
+    return ' '.join(keys)
+
+
+def snapshot(options):
+    _call([sys.executable, MANAGE_PY, 'build_search_index',
+           options['snapshot']])
+    return options['snapshot']
+
+
+def _call(args):
+    """Run a script, with its output discarded unless it fails."""
+    try:
+        subprocess.check_output(args, stderr=subprocess.STDOUT,
+                                cwd=SCRIPTS_DIR)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError('%s failed:\n%s' % (
+            ' '.join(args), e.output.decode('utf-8', 'replace')))
+
+
+def _csv_path(options, genus):
+    return os.path.join(options['csv_dir'], '%s.csv' % genus)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,12 +4,16 @@
 QA the data, update db wit a concensus for sign of latitude and
 longitude values for each country. Some of the lat/long signs are
 missing or wrong, locating the accessions in the wrong hemisphere.
+Purges the reverse proxy cache afterwards, unless --no-purge.
 """
 
+import argparse
 import psycopg2
 import math
 
-PSQL_DB = 'dbname=drupal user=www'
+from load import purge_cache
+
+PSQL_DB = 'dbname=drupal user=www target_session_attrs=read-write'
 DATE_FMT = '%Y%m%d'
 PNT_FMT = "ST_GeographyFromText('SRID=4326;POINT(%(longdec)s %(latdec)s)')"
 
@@ -21,6 +25,10 @@ if not hasattr(math, 'isclose'):
 
 
 def main():
+    parser = argparse.ArgumentParser(description='update lat/long consensus')
+    parser.add_argument('--no-purge', action='store_true',
+                        help="don't purge the reverse proxy cache")
+    args = parser.parse_args()
     print('making lat/long consensus...')
     conn = psycopg2.connect(PSQL_DB)
     cur = conn.cursor()
@@ -127,6 +135,8 @@ def main():
     '''
     cur.execute(sql)
     conn.commit()
+    if not args.no_purge:
+        purge_cache(['dataset'])
 
 
 def _dictfetchall(cursor):
@@ -1,17 +1,23 @@
 #!/bin/bash
 
-# load/update all legumes genera,
+# load/update all legumes genera, in parallel (see ingest.py),
 # update full text search index,
-# update lat/long consensus.
+# update lat/long consensus,
+# update facet and timeline counts,
+# update evaluation metadata,
+# purge the reverse proxy cache of the updated data.
+#
+# the scripts connect with target_session_attrs=read-write, so with
+# PGHOST listing the primary and its replicas, e.g.
+# PGHOST=db1,db2 ./load-all.sh, they only ever write to the primary.
+#
+# the csv files are downloaded to the current directory, and kept so a
+# failed run can be resumed with ./load-all.sh --resume
+#
+# write the search index snapshot, if a path was given, e.g.
+# SNAPSHOT=/usr/local/www/lis_gis/snapshot ./load-all.sh
 
-for g in Apios Arachis Cajanus Chamaecrista Cicer Glycine Lens Lotus Lupinus Medicago Phaseolus Pisum Trifolium Vicia Vigna;
-do
-    echo $g
-    curl -s -o $g.csv \
-         http://www.ars-grin.gov/~dbmuqs/cgi-bin/ex_mcpd.pl?genus=$g
-    ./load.py < $g.csv
-    rm $g.csv
-done
-
-./latlng_consensus.py
-./fts_index.py
+if [ -n "$SNAPSHOT" ]; then
+    exec ./ingest.py --snapshot "$SNAPSHOT" "$@"
+fi
+exec ./ingest.py "$@"
@@ -13,55 +13,53 @@ Expects csv on stdin:
 
  ./load.py < Arachis.csv
 
+Optionally write the search index snapshot after loading (see
+grin_app/search_index.py):
+
+ ./load.py --snapshot /path/to/snapshot < Arachis.csv
+
+The reverse proxy cache of the loaded genera and of the summaries is
+purged afterwards (see grin_app/surrogate_keys.py), unless --no-purge.
+
 for g in Apios Arachis Cajanus Chamaecrista Cicer Glycine Lens Lotus Lupinus \
      Medicago Phaseolus Pisum Trifolium Vicia Vigna;
       do
       echo $g; ./load.py < $g-passport.csv;
       done
 
+or load all genera in parallel with ingest.py.
+
 """
 
+import argparse
+import os
+import subprocess
+import sys
 import petl as etl
 import psycopg2
 from datetime import datetime as dt
 
-PSQL_DB = 'dbname=drupal user=www'
+PSQL_DB = 'dbname=drupal user=www target_session_attrs=read-write'
 DATE_FMT = '%Y%m%d'
 PNT_FMT = "ST_GeographyFromText('SRID=4326;POINT(%(longdec)s %(latdec)s)')"
+MANAGE_PY = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                         'manage.py')
 
 
 def main():
+    parser = argparse.ArgumentParser(description='load GRIN passport data')
+    parser.add_argument('--snapshot',
+                        help='write the search index snapshot to this path')
+    parser.add_argument('--no-purge', action='store_true',
+                        help="don't purge the reverse proxy cache")
+    args = parser.parse_args()
     conn = psycopg2.connect(PSQL_DB)
     cur = conn.cursor()
     table = etl.csv.fromcsv(encoding='latin1')
     inserts = 0
+    genera = set()
     for n in etl.dicts(table):
-        n['acckey'] = int(n['acckey'] or 0)
-        n['taxno'] = int(n['taxno'] or 0)
-        n['elevation'] = int(n['elevation'] or 0)
-        n['sampstat'] = int(n['sampstat'] or 0)
-        n['collsrc'] = int(n['collsrc'] or 0)
-        n['longdec'] = float(n['longdec'] or 0)
-        n['latdec'] = float(n['latdec'] or 0)
-        n['accenumb'] = n['accenumb'] or None  # don't allow empty strings
-        if n['acqdate']: 
-            n['acqdate'] = n['acqdate'].replace('--', '01')
-            try:
-                date = dt.strptime(n['acqdate'], DATE_FMT).date()
-                n['acqdate'] = date
-            except ValueError:
-                n['acqdate'] = None
-        else:
-            n['acqdate'] = None
-        if n['colldate']:
-            n['colldate'] = n['colldate'].replace('--', '01') 
-            try: 
-                date = dt.strptime(n['colldate'], DATE_FMT).date()
-                n['colldate'] = date
-            except ValueError:
-                n['colldate'] = None
-        else:
-            n['colldate'] = None
+        clean_row(n)
         if n['longdec'] and n['latdec']:
             geographic_coord = PNT_FMT
         else:
@@ -87,12 +85,66 @@ def main():
             cur.execute(sql, n)
             conn.commit()
             inserts += 1
+            genera.add(n['genus'])
         except psycopg2.Error as e:
             print(e)
             conn.rollback()
             
     conn.commit()
     print('\tinserted: %d' % inserts)
+    if args.snapshot:
+        write_snapshot(cur, args.snapshot)
+    if not args.no_purge:
+        purge_cache(['genus-%s' % genus for genus in sorted(genera) if genus] +
+                    ['summary'])
+
+
+def clean_row(n):
+    """Convert the passport csv row's values (all strings) to the
+    column types of grin_accession, in place.
+    """
+    n['acckey'] = int(n['acckey'] or 0)
+    n['taxno'] = int(n['taxno'] or 0)
+    n['elevation'] = int(n['elevation'] or 0)
+    n['sampstat'] = int(n['sampstat'] or 0)
+    n['collsrc'] = int(n['collsrc'] or 0)
+    n['longdec'] = float(n['longdec'] or 0)
+    n['latdec'] = float(n['latdec'] or 0)
+    n['accenumb'] = n['accenumb'] or None  # don't allow empty strings
+    n['acqdate'] = _date(n['acqdate'])
+    n['colldate'] = _date(n['colldate'])
+    return n
+
+
+def _date(value):
+    """Return the date for a YYYYMMDD string, with -- for an unknown
+    month or day, or None.
+    """
+    if not value:
+        return None
+    try:
+        return dt.strptime(value.replace('--', '01'), DATE_FMT).date()
+    except ValueError:
+        return None
+
+
+def write_snapshot(cur, path):
+    """Write the search index snapshot, with the grin_app module from
+    this repository.
+    """
+    sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+    from grin_app import search_index
+    print('writing search index snapshot...')
+    rows = search_index.build(cur, path)
+    print('\twrote: %d' % rows)
+
+
+def purge_cache(keys):
+    """Purge the reverse proxy cached responses tagged with the
+    surrogate keys, with manage.py purge_cache.
+    """
+    print('purging cache: %s' % ' '.join(keys))
+    subprocess.check_call([sys.executable, MANAGE_PY, 'purge_cache'] + keys)
 
 
 def _dictfetchall(cursor):
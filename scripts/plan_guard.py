@@ -0,0 +1,360 @@
+#!/usr/bin/env python
+
+"""
+Guard the query plans of the views' dynamically assembled SQL against
+regressions, e.g. a fragment change turning an index scan into a
+sequential scan.
+
+The canonical query shapes are enumerated from the views' fragment
+dicts: a search for each of the GRIN_ACC_WHERE_FRAGS, and a request for
+each of the GRIN_EVAL_WHERE_FRAGS, plus the evaluation_descr_names,
+evaluation_search, evaluation_metadata and timeline requests. Adding a
+fragment without a shape for it here fails the guard. Each shape's
+request is run through the views (with the django test client), and the
+SQL they execute is EXPLAINed against a scaled data set, made by
+benchmark.py (run from the repository root, or with it on PYTHONPATH):
+
+ ./benchmark.py generate --db lis_gis_bench --accessions 500000
+ ./plan_guard.py --db lis_gis_bench --save plans.json
+ ./plan_guard.py --db lis_gis_bench --baseline plans.json
+
+The plans are checked for:
+
+* the indexes each shape is expected to use
+* sequential scans of the large tables, unless the shape expects them
+* sorts of more than --max-sort-rows (estimated) input rows, unless the
+  shape expects them
+* with --baseline, an estimated cost more than --tolerance percent over
+  the baseline's, and indexes the baseline used but no longer used
+
+The plans (in EXPLAIN json format) are saved with --save, as an
+artifact to diff and compare later runs with. Exits non-zero if any
+check failed.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+LARGE_TABLES = ('grin_accession', 'legumes_grin_evaluation_data')
+INDEX_NODES = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+ACC_KEY_INDEXES = ('grin_accession_key_accenumb_norm_key',
+                   'grin_accession_accession_key_idx')
+EVAL_KEY_INDEX = \
+    'legumes_grin_evaluation_data_accession_key_descriptor_name_idx'
+FTS_INDEX = 'grin_accession_taxon_fts_idx'
+GEO_INDEX = 'grin_accession_geographic_coord_idx'
+# a year of benchmark.py's acqdate range (it has no colldates)
+DATE_RANGE_YEAR = 1990
+
+# search shape for each of the GRIN_ACC_WHERE_FRAGS: a function of the
+# sample data returning the search params (added to the map bounds), and
+# the expectations of its plans
+SEARCH_SHAPES = {
+    'fts': (lambda s: {'taxon_query': '%s & %s' % (s['genus'],
+                                                   s['taxon'].split()[-1])},
+            {'indexes': [FTS_INDEX]}),
+    'fts_simple': (lambda s: {'taxon_query': s['taxon']},
+                   {'indexes': [FTS_INDEX]}),
+    # there's no index on origcty
+    'country': (lambda s: {'country': s['country']},
+                {'seq_scan': True}),
+    'geocoded_only': (lambda s: {'geocoded_only': True},
+                      {'seq_scan': True, 'sort': True}),
+    # the geography column is compared as geometry, which its gist
+    # index can't be used for
+    'limit_geo_bounds': (lambda s: {'limit_geo_bounds': True},
+                         {'seq_scan': True}),
+    'region': (lambda s: {'region': s['region']},
+               {'indexes': [GEO_INDEX]}),
+    'trait_range': (lambda s: {
+        'taxon_query': s['taxon'],
+        'trait_filter': s['numeric_descriptor'],
+        'trait_min': s['trait_min'],
+    }, {'indexes': [FTS_INDEX,
+                    'legumes_grin_evaluation_data_descr_name_numeric_idx']}),
+    'trait_values': (lambda s: {
+        'taxon_query': s['taxon'],
+        'trait_filter': s['nominal_descriptor'],
+        'trait_values': [s['nominal_value']],
+    }, {'indexes': [FTS_INDEX,
+                    'legumes_grin_evaluation_data_descr_name_value_idx']}),
+    'acqdate_range': (lambda s: {
+        'acqdate_min': DATE_RANGE_YEAR,
+        'acqdate_max': DATE_RANGE_YEAR,
+    }, {'indexes': ['grin_accession_acqdate_idx']}),
+    'colldate_range': (lambda s: {
+        'colldate_min': DATE_RANGE_YEAR,
+        'colldate_max': DATE_RANGE_YEAR,
+    }, {'indexes': ['grin_accession_colldate_idx']}),
+}
+# request for each of the GRIN_EVAL_WHERE_FRAGS: method, path, params
+# function and expectations
+EVAL_SHAPES = {
+    'descriptor_name': ('POST', '/evaluation_metadata', lambda s: {
+        'taxon': s['taxon'],
+        'descriptor_name': s['numeric_descriptor'],
+        'trait_scale': 'global',
+        'accession_ids': s['accenumbs'],
+    }, {'indexes': [FTS_INDEX]}),
+    'accession_ids': ('GET', '/evaluation_detail', lambda s: {
+        'accenumb': s['accenumbs'][0],
+    }, {'indexes': [EVAL_KEY_INDEX]}),
+}
+# other canonical requests: name, method, path, params function and
+# expectations
+OTHER_SHAPES = [
+    ('search:accession_ids', 'POST', '/search', lambda s: dict(
+        s['bounds'], accession_ids=','.join(s['accenumbs'])),
+     {'indexes': list(ACC_KEY_INDEXES), 'seq_scan': True, 'sort': True}),
+    ('evaluation_descr_names', 'GET', '/evaluation_descr_names',
+     lambda s: {'taxon': s['taxon']},
+     {'indexes': [FTS_INDEX, EVAL_KEY_INDEX]}),
+    ('evaluation_search', 'POST', '/evaluation_search', lambda s: {
+        'descriptor_name': s['numeric_descriptor'],
+        'accession_ids': s['accenumbs'],
+    }, {'indexes': [EVAL_KEY_INDEX]}),
+    ('evaluation_metadata:local', 'POST', '/evaluation_metadata',
+     lambda s: {
+        'taxon': s['taxon'],
+        'descriptor_name': s['numeric_descriptor'],
+        'trait_scale': 'local',
+        'accession_ids': s['accenumbs'],
+     }, {'indexes': [FTS_INDEX, EVAL_KEY_INDEX]}),
+    ('timeline', 'GET', '/timeline', lambda s: {'taxon_query': s['taxon']},
+     {'indexes': [FTS_INDEX]}),
+    ('timeline:precomputed', 'GET', '/timeline',
+     lambda s: {'taxon_query': s['genus'], 'country': s['country']}, {}),
+]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='grin_app plan guard')
+    parser.add_argument('--db', required=True,
+                        help='database with a data set from benchmark.py')
+    parser.add_argument('--save', help='write the plans json to this file')
+    parser.add_argument('--baseline', help='compare with this plans json')
+    parser.add_argument('--tolerance', type=float, default=50.0,
+                        help='allowed estimated cost increase in percent')
+    parser.add_argument('--max-sort-rows', type=int, default=10000,
+                        help='largest sort input expected')
+    args = parser.parse_args()
+    connection, client = _setup(args.db)
+    from grin_app import views
+    sample = _sample_data(connection)
+    shapes = canonical_shapes(views, sample)
+    results = {}
+    problems = []
+    for name, method, path, params, expect in shapes:
+        results[name] = explain_shape(connection, client, method, path,
+                                      params)
+        problems += ['%s: %s' % (name, problem) for problem in
+                     check(results[name], expect, args.max_sort_rows)]
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        problems += compare(baseline, results, args.tolerance)
+    for name in sorted(results):
+        print('%s: cost %.1f, indexes %s' % (
+            name, results[name]['cost'],
+            ' '.join(results[name]['indexes']) or '-'))
+    for problem in problems:
+        print('** %s' % problem)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    sys.exit(1 if problems else 0)
+
+
+def _setup(db):
+    import django
+    from django.conf import settings
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'lis_germplasm.settings')
+    settings.DATABASES['default']['NAME'] = db
+    settings.RATE_LIMITS = {}  # not rate limited (see grin_app/rate_limits.py)
+    django.setup()
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    return connection, Client()
+
+
+def canonical_shapes(views, sample):
+    """Return the (name, method, path, params, expectations) of each
+    canonical query shape, for the views' fragment dicts.
+    """
+    shapes = []
+    for key in sorted(views.GRIN_ACC_WHERE_FRAGS):
+        if key not in SEARCH_SHAPES:
+            raise ValueError('no canonical search for fragment %s' % key)
+        params_func, expect = SEARCH_SHAPES[key]
+        params = dict(sample['bounds'], **params_func(sample))
+        if not views.GRIN_ACC_WHERE_FRAGS[key]['include'](params):
+            # e.g. the fragment's include condition changed
+            raise ValueError('the canonical search does not include %s' %
+                             key)
+        shapes.append(('search:' + key, 'POST', '/search', params, expect))
+    for key in sorted(views.GRIN_EVAL_WHERE_FRAGS):
+        if key not in EVAL_SHAPES:
+            raise ValueError('no canonical request for fragment %s' % key)
+        method, path, params_func, expect = EVAL_SHAPES[key]
+        shapes.append(('%s:%s' % (path.strip('/'), key), method, path,
+                       params_func(sample), expect))
+    for name, method, path, params_func, expect in OTHER_SHAPES:
+        shapes.append((name, method, path, params_func(sample), expect))
+    return shapes
+
+
+def explain_shape(connection, client, method, path, params):
+    """Run the request, and return the EXPLAIN plans of the data queries
+    it executed, with their total cost, and the indexes used.
+    """
+    from django.test.utils import CaptureQueriesContext
+    with CaptureQueriesContext(connection) as captured:
+        if method == 'GET':
+            res = client.get(path, params)
+        else:
+            res = client.post(path, content_type='application/json',
+                              data=json.dumps(params))
+    assert res.status_code == 200, '%s: %s' % (path, res.status_code)
+    cursor = connection.cursor()
+    queries = []
+    for query in captured.captured_queries:
+        sql = query['sql']
+        if 'lis_germplasm.' not in sql or not \
+                sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            continue  # statement_timeout, cancel etc.
+        cursor.execute('EXPLAIN (FORMAT JSON) ' + sql)
+        plan = cursor.fetchone()[0]
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        queries.append({'sql': sql, 'plan': plan[0]['Plan']})
+    nodes = [node for q in queries for node in _nodes(q['plan'])]
+    return {
+        'queries': queries,
+        'cost': sum(q['plan']['Total Cost'] for q in queries),
+        'indexes': sorted(set(node['Index Name'] for node in nodes
+                              if node['Node Type'] in INDEX_NODES)),
+        'seq_scans': sorted(set(node['Relation Name'] for node in nodes
+                                if node['Node Type'] == 'Seq Scan')),
+        'max_sort_rows': max([node['Plan Rows'] for node in nodes
+                              if node['Node Type'] == 'Sort'] or [0]),
+    }
+
+
+def check(result, expect, max_sort_rows):
+    """Return the problems of the shape's plans, vs. its expectations."""
+    problems = []
+    for index in expect.get('indexes', []):
+        if index not in result['indexes']:
+            problems.append('does not use %s' % index)
+    if not expect.get('seq_scan', False):
+        for table in result['seq_scans']:
+            if table in LARGE_TABLES:
+                problems.append('sequential scan of %s' % table)
+    if not expect.get('sort', False) and \
+            result['max_sort_rows'] > max_sort_rows:
+        problems.append('sorts %d rows' % result['max_sort_rows'])
+    return problems
+
+
+def compare(baseline, results, tolerance):
+    """Return the regressions of the results vs. the baseline results."""
+    problems = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['cost']
+        after = result['cost']
+        change = (after - before) / before * 100 if before else 0
+        if change > tolerance:
+            problems.append('%s: cost %.1f -> %.1f (%+.1f%%)' % (
+                name, before, after, change))
+        for index in baseline[name]['indexes']:
+            if index not in result['indexes']:
+                problems.append('%s: no longer uses %s' % (name, index))
+        for table in result['seq_scans']:
+            if table in LARGE_TABLES and \
+                    table not in baseline[name]['seq_scans']:
+                problems.append('%s: new sequential scan of %s' % (name,
+                                                                    table))
+    return problems
+
+
+def _nodes(plan):
+    """Yield the plan node and all its descendants."""
+    yield plan
+    for child in plan.get('Plans', []):
+        for node in _nodes(child):
+            yield node
+
+
+def _sample_data(connection):
+    """Return values from the data set to build the requests with: the
+    least common taxon with evaluation metadata (so its searches are
+    selective), the least common country, and map bounds around it.
+    """
+    cursor = connection.cursor()
+    cursor.execute('''
+    SELECT taxon, genus, count(*) FROM lis_germplasm.grin_accession
+    WHERE taxon IN (SELECT taxon FROM lis_germplasm.grin_evaluation_metadata
+                    WHERE obs_type = 'numeric')
+    AND taxon IN (SELECT taxon FROM lis_germplasm.grin_evaluation_metadata
+                  WHERE obs_type = 'nominal')
+    GROUP BY taxon, genus ORDER BY 3, 1 LIMIT 1
+    ''')
+    taxon, genus, count = cursor.fetchone()
+    cursor.execute('''
+    SELECT descriptor_name, (obs_min + obs_max) / 2
+    FROM lis_germplasm.grin_evaluation_metadata
+    WHERE taxon = %s AND obs_type = 'numeric'
+    ORDER BY descriptor_name LIMIT 1
+    ''', [taxon])
+    numeric_descriptor, trait_min = cursor.fetchone()
+    cursor.execute('''
+    SELECT descriptor_name, obs_nominal_values[1]
+    FROM lis_germplasm.grin_evaluation_metadata
+    WHERE taxon = %s AND obs_type = 'nominal'
+    ORDER BY descriptor_name LIMIT 1
+    ''', [taxon])
+    nominal_descriptor, nominal_value = cursor.fetchone()
+    cursor.execute('''
+    SELECT DISTINCT accenumb FROM lis_germplasm.legumes_grin_evaluation_data
+    WHERE descriptor_name = %s AND taxon = %s
+    ORDER BY accenumb LIMIT 20
+    ''', [numeric_descriptor, taxon])
+    accenumbs = [row[0] for row in cursor.fetchall()]
+    cursor.execute('''
+    SELECT origcty, avg(latdec), avg(longdec)
+    FROM lis_germplasm.grin_accession
+    WHERE latdec <> 0 AND longdec <> 0 AND origcty IS NOT NULL
+    GROUP BY origcty ORDER BY count(*), origcty LIMIT 1
+    ''')
+    country, lat, lng = cursor.fetchone()
+    return {
+        'taxon': taxon,
+        'genus': genus,
+        'numeric_descriptor': numeric_descriptor,
+        'trait_min': trait_min,
+        'nominal_descriptor': nominal_descriptor,
+        'nominal_value': nominal_value,
+        'accenumbs': accenumbs,
+        'country': country,
+        'bounds': {
+            'ne_lat': lat + 1, 'ne_lng': lng + 1,
+            'sw_lat': lat - 1, 'sw_lng': lng - 1,
+            'limit': 200,
+        },
+        'region': {
+            'type': 'Polygon',
+            'coordinates': [[[lng - 1, lat - 1], [lng + 1, lat - 1],
+                             [lng + 1, lat + 1], [lng - 1, lat + 1],
+                             [lng - 1, lat - 1]]],
+        },
+    }
+
+
+if __name__ == '__main__':
+    main()
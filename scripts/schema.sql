@@ -40,7 +40,10 @@ CREATE FUNCTION grin_evaluation_data_concat_accenumb() RETURNS trigger
     LANGUAGE plpgsql
     AS $$
   BEGIN
-      NEW.accenumb = NEW.accession_prefix || ' ' || NEW.accession_number;
+      NEW.accenumb = concat_ws(' ', NEW.accession_prefix, NEW.accession_number,
+                               NULLIF(NEW.accession_surfix, ''));
+      NEW.accession_key = lis_germplasm.grin_accession_key(NEW.accenumb);
+      NEW.observation_numeric = lis_germplasm.grin_numeric(NEW.observation_value);
       RETURN NEW;
   END
   $$;
@@ -48,6 +51,131 @@ CREATE FUNCTION grin_evaluation_data_concat_accenumb() RETURNS trigger
 
 ALTER FUNCTION lis_germplasm.grin_evaluation_data_concat_accenumb() OWNER TO www;
 
+--
+-- Name: grin_accession_norm(text); Type: FUNCTION; Schema: lis_germplasm; Owner: www
+--
+
+CREATE FUNCTION grin_accession_norm(accenumb text) RETURNS text
+    LANGUAGE sql IMMUTABLE
+    AS $$
+  SELECT upper(regexp_replace(btrim(accenumb), '\s+', ' ', 'g'));
+  $$;
+
+
+ALTER FUNCTION lis_germplasm.grin_accession_norm(text) OWNER TO www;
+
+--
+-- Name: grin_accession_key(text); Type: FUNCTION; Schema: lis_germplasm; Owner: www
+--
+
+CREATE FUNCTION grin_accession_key(accenumb text) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+  DECLARE
+      norm text := lis_germplasm.grin_accession_norm(accenumb);
+      new_key integer;
+  BEGIN
+      IF norm IS NULL OR norm = '' THEN
+          RETURN NULL;
+      END IF;
+      -- look the key up first: a conflicting insert would still take
+      -- (and waste) a sequence value, on every reload of the accession
+      SELECT accession_key INTO new_key
+      FROM lis_germplasm.grin_accession_key
+      WHERE accenumb_norm = norm;
+      IF new_key IS NULL THEN
+          INSERT INTO lis_germplasm.grin_accession_key (accenumb_norm)
+              VALUES (norm) ON CONFLICT (accenumb_norm) DO NOTHING;
+          SELECT accession_key INTO new_key
+          FROM lis_germplasm.grin_accession_key
+          WHERE accenumb_norm = norm;
+      END IF;
+      RETURN new_key;
+  END
+  $$;
+
+
+ALTER FUNCTION lis_germplasm.grin_accession_key(text) OWNER TO www;
+
+--
+-- Name: grin_accession_set_key(); Type: FUNCTION; Schema: lis_germplasm; Owner: www
+--
+
+CREATE FUNCTION grin_accession_set_key() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+  BEGIN
+      NEW.accession_key = lis_germplasm.grin_accession_key(NEW.accenumb);
+      RETURN NEW;
+  END
+  $$;
+
+
+ALTER FUNCTION lis_germplasm.grin_accession_set_key() OWNER TO www;
+
+--
+-- Name: grin_numeric(text); Type: FUNCTION; Schema: lis_germplasm; Owner: www
+--
+
+CREATE FUNCTION grin_numeric(value text) RETURNS double precision
+    LANGUAGE sql IMMUTABLE
+    AS $$
+  SELECT CASE
+    WHEN value ~ '^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+    THEN value::double precision
+  END;
+  $$;
+
+
+ALTER FUNCTION lis_germplasm.grin_numeric(text) OWNER TO www;
+
+--
+-- Name: grin_accession_facet_refresh(); Type: FUNCTION; Schema: lis_germplasm; Owner: www
+--
+
+CREATE FUNCTION grin_accession_facet_refresh() RETURNS void
+    LANGUAGE sql
+    AS $$
+  DELETE FROM lis_germplasm.grin_accession_facet;
+  INSERT INTO lis_germplasm.grin_accession_facet
+    (origcty, taxon, geocoded, cell_x, cell_y, accessions)
+  SELECT origcty, taxon, geocoded,
+         CASE WHEN geocoded THEN floor(longdec)::integer END,
+         CASE WHEN geocoded THEN floor(latdec)::integer END,
+         count(*)
+  FROM (SELECT origcty, taxon, longdec, latdec,
+               (latdec <> 0 AND longdec <> 0) AS geocoded
+        FROM lis_germplasm.grin_accession) acc
+  GROUP BY 1, 2, 3, 4, 5;
+  $$;
+
+
+ALTER FUNCTION lis_germplasm.grin_accession_facet_refresh() OWNER TO www;
+
+--
+-- Name: grin_accession_timeline_refresh(); Type: FUNCTION; Schema: lis_germplasm; Owner: www
+--
+
+CREATE FUNCTION grin_accession_timeline_refresh() RETURNS void
+    LANGUAGE sql
+    AS $$
+  DELETE FROM lis_germplasm.grin_accession_timeline;
+  INSERT INTO lis_germplasm.grin_accession_timeline
+    (date_field, genus, origcty, year, accessions)
+  SELECT 'acqdate', genus, origcty,
+         date_part('year', acqdate)::integer, count(*)
+  FROM lis_germplasm.grin_accession
+  GROUP BY 1, 2, 3, 4
+  UNION ALL
+  SELECT 'colldate', genus, origcty,
+         date_part('year', colldate)::integer, count(*)
+  FROM lis_germplasm.grin_accession
+  GROUP BY 1, 2, 3, 4;
+  $$;
+
+
+ALTER FUNCTION lis_germplasm.grin_accession_timeline_refresh() OWNER TO www;
+
 SET default_tablespace = '';
 
 SET default_with_oids = false;
@@ -96,12 +224,44 @@ CREATE TABLE grin_accession (
     geographic_coord public.geography(Point,4326),
     remarks text,
     history text,
-    released text
+    released text,
+    accession_key integer
 );
 
 
 ALTER TABLE lis_germplasm.grin_accession OWNER TO www;
 
+--
+-- Name: grin_accession_facet; Type: TABLE; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE TABLE grin_accession_facet (
+    origcty text,
+    taxon text,
+    geocoded boolean,
+    cell_x integer,
+    cell_y integer,
+    accessions integer
+);
+
+
+ALTER TABLE lis_germplasm.grin_accession_facet OWNER TO www;
+
+--
+-- Name: grin_accession_timeline; Type: TABLE; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE TABLE grin_accession_timeline (
+    date_field text,
+    genus text,
+    origcty text,
+    year integer,
+    accessions integer
+);
+
+
+ALTER TABLE lis_germplasm.grin_accession_timeline OWNER TO www;
+
 --
 -- Name: grin_accession_gid_seq; Type: SEQUENCE; Schema: lis_germplasm; Owner: www
 --
@@ -123,6 +283,39 @@ ALTER TABLE lis_germplasm.grin_accession_gid_seq OWNER TO www;
 ALTER SEQUENCE grin_accession_gid_seq OWNED BY grin_accession.gid;
 
 
+--
+-- Name: grin_accession_key; Type: TABLE; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE TABLE grin_accession_key (
+    accession_key integer NOT NULL,
+    accenumb_norm text NOT NULL
+);
+
+
+ALTER TABLE lis_germplasm.grin_accession_key OWNER TO www;
+
+--
+-- Name: grin_accession_key_accession_key_seq; Type: SEQUENCE; Schema: lis_germplasm; Owner: www
+--
+
+CREATE SEQUENCE grin_accession_key_accession_key_seq
+    START WITH 1
+    INCREMENT BY 1
+    NO MINVALUE
+    NO MAXVALUE
+    CACHE 1;
+
+
+ALTER TABLE lis_germplasm.grin_accession_key_accession_key_seq OWNER TO www;
+
+--
+-- Name: grin_accession_key_accession_key_seq; Type: SEQUENCE OWNED BY; Schema: lis_germplasm; Owner: www
+--
+
+ALTER SEQUENCE grin_accession_key_accession_key_seq OWNED BY grin_accession_key.accession_key;
+
+
 --
 -- Name: grin_evaluation_metadata; Type: TABLE; Schema: lis_germplasm; Owner: www; Tablespace: 
 --
@@ -186,7 +379,9 @@ CREATE TABLE legumes_grin_evaluation_data (
     inventory_number character varying(16),
     inventory_suffix character varying(64),
     accession_comment text,
-    accenumb text
+    accenumb text,
+    observation_numeric double precision,
+    accession_key integer
 );
 
 
@@ -199,6 +394,13 @@ ALTER TABLE lis_germplasm.legumes_grin_evaluation_data OWNER TO www;
 ALTER TABLE ONLY grin_accession ALTER COLUMN gid SET DEFAULT nextval('grin_accession_gid_seq'::regclass);
 
 
+--
+-- Name: accession_key; Type: DEFAULT; Schema: lis_germplasm; Owner: www
+--
+
+ALTER TABLE ONLY grin_accession_key ALTER COLUMN accession_key SET DEFAULT nextval('grin_accession_key_accession_key_seq'::regclass);
+
+
 --
 -- Name: id; Type: DEFAULT; Schema: lis_germplasm; Owner: www
 --
@@ -214,6 +416,22 @@ ALTER TABLE ONLY grin_accession
     ADD CONSTRAINT grin_accession_pkey PRIMARY KEY (gid);
 
 
+--
+-- Name: grin_accession_key_pkey; Type: CONSTRAINT; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+ALTER TABLE ONLY grin_accession_key
+    ADD CONSTRAINT grin_accession_key_pkey PRIMARY KEY (accession_key);
+
+
+--
+-- Name: grin_accession_key_accenumb_norm_key; Type: CONSTRAINT; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+ALTER TABLE ONLY grin_accession_key
+    ADD CONSTRAINT grin_accession_key_accenumb_norm_key UNIQUE (accenumb_norm);
+
+
 --
 -- Name: grin_evaluation_metadata_pkey; Type: CONSTRAINT; Schema: lis_germplasm; Owner: www; Tablespace: 
 --
@@ -229,6 +447,27 @@ ALTER TABLE ONLY grin_evaluation_metadata
 CREATE UNIQUE INDEX grin_accession_accenumb_idx ON grin_accession USING btree (accenumb);
 
 
+--
+-- Name: grin_accession_accession_key_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE INDEX grin_accession_accession_key_idx ON grin_accession USING btree (accession_key);
+
+
+--
+-- Name: grin_accession_acqdate_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE INDEX grin_accession_acqdate_idx ON grin_accession USING btree (acqdate) WHERE (acqdate IS NOT NULL);
+
+
+--
+-- Name: grin_accession_colldate_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE INDEX grin_accession_colldate_idx ON grin_accession USING btree (colldate) WHERE (colldate IS NOT NULL);
+
+
 --
 -- Name: grin_accession_geographic_coord_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
 --
@@ -236,6 +475,13 @@ CREATE UNIQUE INDEX grin_accession_accenumb_idx ON grin_accession USING btree (a
 CREATE INDEX grin_accession_geographic_coord_idx ON grin_accession USING gist (geographic_coord);
 
 
+--
+-- Name: grin_accession_geohash_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE INDEX grin_accession_geohash_idx ON grin_accession USING btree (public.st_geohash((geographic_coord)::public.geometry, 10));
+
+
 --
 -- Name: grin_accession_lower_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
 --
@@ -257,6 +503,20 @@ CREATE INDEX grin_accession_lower_idx1 ON grin_accession USING btree (lower(taxo
 CREATE INDEX grin_accession_taxon_fts_idx ON grin_accession USING gin (taxon_fts);
 
 
+--
+-- Name: grin_accession_facet_cell_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE INDEX grin_accession_facet_cell_idx ON grin_accession_facet USING btree (cell_x, cell_y);
+
+
+--
+-- Name: grin_accession_timeline_genus_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE INDEX grin_accession_timeline_genus_idx ON grin_accession_timeline USING btree (date_field, lower(genus));
+
+
 --
 -- Name: grin_evaluation_metadata_descriptor_name_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
 --
@@ -285,6 +545,13 @@ CREATE INDEX legumes_grin_evaluation_data_accenumb_descriptor_name_idx ON legume
 CREATE INDEX legumes_grin_evaluation_data_accenumb_idx ON legumes_grin_evaluation_data USING btree (accenumb);
 
 
+--
+-- Name: legumes_grin_evaluation_data_accession_key_descriptor_name_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE INDEX legumes_grin_evaluation_data_accession_key_descriptor_name_idx ON legumes_grin_evaluation_data USING btree (accession_key, descriptor_name);
+
+
 --
 -- Name: legumes_grin_evaluation_data_accession_number_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
 --
@@ -306,6 +573,20 @@ CREATE INDEX legumes_grin_evaluation_data_accession_prefix_idx ON legumes_grin_e
 CREATE INDEX legumes_grin_evaluation_data_descr_name_idx ON legumes_grin_evaluation_data USING btree (descriptor_name);
 
 
+--
+-- Name: legumes_grin_evaluation_data_descr_name_numeric_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE INDEX legumes_grin_evaluation_data_descr_name_numeric_idx ON legumes_grin_evaluation_data USING btree (descriptor_name, observation_numeric);
+
+
+--
+-- Name: legumes_grin_evaluation_data_descr_name_value_idx; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
+--
+
+CREATE INDEX legumes_grin_evaluation_data_descr_name_value_idx ON legumes_grin_evaluation_data USING btree (descriptor_name, observation_value);
+
+
 --
 -- Name: legumes_grin_evaluation_data_full_accnumb; Type: INDEX; Schema: lis_germplasm; Owner: www; Tablespace: 
 --
@@ -324,7 +605,14 @@ CREATE INDEX legumes_grin_evaluation_data_taxon_idx ON legumes_grin_evaluation_d
 -- Name: accenumb_trigger; Type: TRIGGER; Schema: lis_germplasm; Owner: www
 --
 
-CREATE TRIGGER accenumb_trigger BEFORE INSERT ON legumes_grin_evaluation_data FOR EACH ROW EXECUTE PROCEDURE grin_evaluation_data_concat_accenumb();
+CREATE TRIGGER accenumb_trigger BEFORE INSERT OR UPDATE OF accession_prefix, accession_number, accession_surfix, observation_value ON legumes_grin_evaluation_data FOR EACH ROW EXECUTE PROCEDURE grin_evaluation_data_concat_accenumb();
+
+
+--
+-- Name: accession_key_trigger; Type: TRIGGER; Schema: lis_germplasm; Owner: www
+--
+
+CREATE TRIGGER accession_key_trigger BEFORE INSERT OR UPDATE OF accenumb ON grin_accession FOR EACH ROW EXECUTE PROCEDURE grin_accession_set_key();
 
 
 --
@@ -349,6 +637,26 @@ GRANT ALL ON FUNCTION grin_evaluation_data_concat_accenumb() TO PUBLIC;
 GRANT ALL ON FUNCTION grin_evaluation_data_concat_accenumb() TO staff;
 
 
+--
+-- Name: grin_accession_key(text); Type: ACL; Schema: lis_germplasm; Owner: www
+--
+
+REVOKE ALL ON FUNCTION grin_accession_key(text) FROM PUBLIC;
+REVOKE ALL ON FUNCTION grin_accession_key(text) FROM www;
+GRANT ALL ON FUNCTION grin_accession_key(text) TO www;
+GRANT ALL ON FUNCTION grin_accession_key(text) TO staff;
+
+
+--
+-- Name: grin_accession_set_key(); Type: ACL; Schema: lis_germplasm; Owner: www
+--
+
+REVOKE ALL ON FUNCTION grin_accession_set_key() FROM PUBLIC;
+REVOKE ALL ON FUNCTION grin_accession_set_key() FROM www;
+GRANT ALL ON FUNCTION grin_accession_set_key() TO www;
+GRANT ALL ON FUNCTION grin_accession_set_key() TO staff;
+
+
 --
 -- Name: grin_accession; Type: ACL; Schema: lis_germplasm; Owner: www
 --
@@ -359,6 +667,26 @@ GRANT ALL ON TABLE grin_accession TO www;
 GRANT ALL ON TABLE grin_accession TO staff;
 
 
+--
+-- Name: grin_accession_facet; Type: ACL; Schema: lis_germplasm; Owner: www
+--
+
+REVOKE ALL ON TABLE grin_accession_facet FROM PUBLIC;
+REVOKE ALL ON TABLE grin_accession_facet FROM www;
+GRANT ALL ON TABLE grin_accession_facet TO www;
+GRANT ALL ON TABLE grin_accession_facet TO staff;
+
+
+--
+-- Name: grin_accession_timeline; Type: ACL; Schema: lis_germplasm; Owner: www
+--
+
+REVOKE ALL ON TABLE grin_accession_timeline FROM PUBLIC;
+REVOKE ALL ON TABLE grin_accession_timeline FROM www;
+GRANT ALL ON TABLE grin_accession_timeline TO www;
+GRANT ALL ON TABLE grin_accession_timeline TO staff;
+
+
 --
 -- Name: grin_accession_gid_seq; Type: ACL; Schema: lis_germplasm; Owner: www
 --
@@ -369,6 +697,26 @@ GRANT ALL ON SEQUENCE grin_accession_gid_seq TO www;
 GRANT ALL ON SEQUENCE grin_accession_gid_seq TO staff;
 
 
+--
+-- Name: grin_accession_key; Type: ACL; Schema: lis_germplasm; Owner: www
+--
+
+REVOKE ALL ON TABLE grin_accession_key FROM PUBLIC;
+REVOKE ALL ON TABLE grin_accession_key FROM www;
+GRANT ALL ON TABLE grin_accession_key TO www;
+GRANT ALL ON TABLE grin_accession_key TO staff;
+
+
+--
+-- Name: grin_accession_key_accession_key_seq; Type: ACL; Schema: lis_germplasm; Owner: www
+--
+
+REVOKE ALL ON SEQUENCE grin_accession_key_accession_key_seq FROM PUBLIC;
+REVOKE ALL ON SEQUENCE grin_accession_key_accession_key_seq FROM www;
+GRANT ALL ON SEQUENCE grin_accession_key_accession_key_seq TO www;
+GRANT ALL ON SEQUENCE grin_accession_key_accession_key_seq TO staff;
+
+
 --
 -- Name: grin_evaluation_metadata; Type: ACL; Schema: lis_germplasm; Owner: www
 --
@@ -0,0 +1,118 @@
+--
+-- Add the normalized integer accession_key to existing grin_accession
+-- and legumes_grin_evaluation_data tables, so the views can join and
+-- filter on it instead of the accenumb strings. (New databases get it
+-- from schema.sql.)
+--
+--  psql lis_gis < scripts/upgrade-accession-key.sql
+--
+
+SET search_path = lis_germplasm, pg_catalog;
+
+BEGIN;
+
+CREATE TABLE grin_accession_key (
+    accession_key serial PRIMARY KEY,
+    accenumb_norm text NOT NULL UNIQUE
+);
+
+CREATE OR REPLACE FUNCTION grin_accession_norm(accenumb text) RETURNS text
+    LANGUAGE sql IMMUTABLE
+    AS $$
+  SELECT upper(regexp_replace(btrim(accenumb), '\s+', ' ', 'g'));
+  $$;
+
+CREATE OR REPLACE FUNCTION grin_accession_key(accenumb text) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+  DECLARE
+      norm text := lis_germplasm.grin_accession_norm(accenumb);
+      new_key integer;
+  BEGIN
+      IF norm IS NULL OR norm = '' THEN
+          RETURN NULL;
+      END IF;
+      -- look the key up first: a conflicting insert would still take
+      -- (and waste) a sequence value, on every reload of the accession
+      SELECT accession_key INTO new_key
+      FROM lis_germplasm.grin_accession_key
+      WHERE accenumb_norm = norm;
+      IF new_key IS NULL THEN
+          INSERT INTO lis_germplasm.grin_accession_key (accenumb_norm)
+              VALUES (norm) ON CONFLICT (accenumb_norm) DO NOTHING;
+          SELECT accession_key INTO new_key
+          FROM lis_germplasm.grin_accession_key
+          WHERE accenumb_norm = norm;
+      END IF;
+      RETURN new_key;
+  END
+  $$;
+
+CREATE OR REPLACE FUNCTION grin_accession_set_key() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+  BEGIN
+      NEW.accession_key = lis_germplasm.grin_accession_key(NEW.accenumb);
+      RETURN NEW;
+  END
+  $$;
+
+CREATE OR REPLACE FUNCTION grin_evaluation_data_concat_accenumb() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+  BEGIN
+      NEW.accenumb = concat_ws(' ', NEW.accession_prefix, NEW.accession_number,
+                               NULLIF(NEW.accession_surfix, ''));
+      NEW.accession_key = lis_germplasm.grin_accession_key(NEW.accenumb);
+      NEW.observation_numeric = lis_germplasm.grin_numeric(NEW.observation_value);
+      RETURN NEW;
+  END
+  $$;
+
+ALTER TABLE grin_accession ADD COLUMN accession_key integer;
+
+ALTER TABLE legumes_grin_evaluation_data ADD COLUMN accession_key integer;
+
+-- the accenumb of suffixed accessions, e.g. 'PI 123456 A', included the
+-- prefix and number only
+UPDATE legumes_grin_evaluation_data
+    SET accenumb = concat_ws(' ', accession_prefix, accession_number,
+                             NULLIF(accession_surfix, ''))
+    WHERE accession_surfix <> '';
+
+INSERT INTO grin_accession_key (accenumb_norm)
+    SELECT DISTINCT grin_accession_norm(accenumb)
+    FROM (SELECT accenumb FROM grin_accession
+          UNION SELECT accenumb FROM legumes_grin_evaluation_data) acc
+    WHERE grin_accession_norm(accenumb) <> ''
+    ORDER BY 1;
+
+UPDATE grin_accession acc SET accession_key = k.accession_key
+    FROM grin_accession_key k
+    WHERE k.accenumb_norm = grin_accession_norm(acc.accenumb);
+
+UPDATE legumes_grin_evaluation_data ev SET accession_key = k.accession_key
+    FROM grin_accession_key k
+    WHERE k.accenumb_norm = grin_accession_norm(ev.accenumb);
+
+DROP TRIGGER accenumb_trigger ON legumes_grin_evaluation_data;
+
+CREATE TRIGGER accenumb_trigger BEFORE INSERT OR UPDATE OF accession_prefix, accession_number, accession_surfix, observation_value ON legumes_grin_evaluation_data FOR EACH ROW EXECUTE PROCEDURE grin_evaluation_data_concat_accenumb();
+
+CREATE TRIGGER accession_key_trigger BEFORE INSERT OR UPDATE OF accenumb ON grin_accession FOR EACH ROW EXECUTE PROCEDURE grin_accession_set_key();
+
+CREATE INDEX grin_accession_accession_key_idx ON grin_accession USING btree (accession_key);
+
+CREATE INDEX legumes_grin_evaluation_data_accession_key_descriptor_name_idx ON legumes_grin_evaluation_data USING btree (accession_key, descriptor_name);
+
+GRANT ALL ON TABLE grin_accession_key TO staff;
+
+GRANT ALL ON SEQUENCE grin_accession_key_accession_key_seq TO staff;
+
+COMMIT;
+
+ANALYZE grin_accession_key;
+
+ANALYZE grin_accession;
+
+ANALYZE legumes_grin_evaluation_data;
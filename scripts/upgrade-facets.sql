@@ -0,0 +1,47 @@
+--
+-- Add the precomputed accession counts per country, taxon, geocoded
+-- status and 1 degree grid cell, for the facets view, to an existing
+-- database. (New databases get them from schema.sql.)
+--
+--  psql lis_gis < scripts/upgrade-facets.sql
+--
+
+SET search_path = lis_germplasm, pg_catalog;
+
+BEGIN;
+
+CREATE TABLE grin_accession_facet (
+    origcty text,
+    taxon text,
+    geocoded boolean,
+    cell_x integer,
+    cell_y integer,
+    accessions integer
+);
+
+CREATE OR REPLACE FUNCTION grin_accession_facet_refresh() RETURNS void
+    LANGUAGE sql
+    AS $$
+  DELETE FROM lis_germplasm.grin_accession_facet;
+  INSERT INTO lis_germplasm.grin_accession_facet
+    (origcty, taxon, geocoded, cell_x, cell_y, accessions)
+  SELECT origcty, taxon, geocoded,
+         CASE WHEN geocoded THEN floor(longdec)::integer END,
+         CASE WHEN geocoded THEN floor(latdec)::integer END,
+         count(*)
+  FROM (SELECT origcty, taxon, longdec, latdec,
+               (latdec <> 0 AND longdec <> 0) AS geocoded
+        FROM lis_germplasm.grin_accession) acc
+  GROUP BY 1, 2, 3, 4, 5;
+  $$;
+
+CREATE INDEX grin_accession_facet_cell_idx ON grin_accession_facet USING btree (cell_x, cell_y);
+
+GRANT ALL ON TABLE grin_accession_facet TO www;
+GRANT ALL ON TABLE grin_accession_facet TO staff;
+
+SELECT grin_accession_facet_refresh();
+
+COMMIT;
+
+ANALYZE grin_accession_facet;
@@ -0,0 +1,44 @@
+--
+-- Add the observation_numeric column to an existing
+-- legumes_grin_evaluation_data table, for trait range filtering in the
+-- search view. (New databases get it from schema.sql.)
+--
+--  psql lis_gis < scripts/upgrade-observation-numeric.sql
+--
+
+SET search_path = lis_germplasm, pg_catalog;
+
+BEGIN;
+
+CREATE OR REPLACE FUNCTION grin_numeric(value text) RETURNS double precision
+    LANGUAGE sql IMMUTABLE
+    AS $$
+  SELECT CASE
+    WHEN value ~ '^\s*[-+]?([0-9]+\.?[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?\s*$'
+    THEN value::double precision
+  END;
+  $$;
+
+ALTER TABLE legumes_grin_evaluation_data
+    ADD COLUMN observation_numeric double precision;
+
+CREATE OR REPLACE FUNCTION grin_evaluation_data_concat_accenumb() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+  BEGIN
+      NEW.accenumb = NEW.accession_prefix || ' ' || NEW.accession_number;
+      NEW.observation_numeric = lis_germplasm.grin_numeric(NEW.observation_value);
+      RETURN NEW;
+  END
+  $$;
+
+UPDATE legumes_grin_evaluation_data
+    SET observation_numeric = grin_numeric(observation_value);
+
+CREATE INDEX legumes_grin_evaluation_data_descr_name_numeric_idx ON legumes_grin_evaluation_data USING btree (descriptor_name, observation_numeric);
+
+CREATE INDEX legumes_grin_evaluation_data_descr_name_value_idx ON legumes_grin_evaluation_data USING btree (descriptor_name, observation_value);
+
+COMMIT;
+
+ANALYZE legumes_grin_evaluation_data;
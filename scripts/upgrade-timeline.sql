@@ -0,0 +1,53 @@
+--
+-- Add the acqdate and colldate indexes for the search view's date range
+-- filters, and the precomputed per year accession counts for the
+-- timeline view, to an existing database. (New databases get them from
+-- schema.sql.)
+--
+--  psql lis_gis < scripts/upgrade-timeline.sql
+--
+
+SET search_path = lis_germplasm, pg_catalog;
+
+BEGIN;
+
+CREATE TABLE grin_accession_timeline (
+    date_field text,
+    genus text,
+    origcty text,
+    year integer,
+    accessions integer
+);
+
+CREATE OR REPLACE FUNCTION grin_accession_timeline_refresh() RETURNS void
+    LANGUAGE sql
+    AS $$
+  DELETE FROM lis_germplasm.grin_accession_timeline;
+  INSERT INTO lis_germplasm.grin_accession_timeline
+    (date_field, genus, origcty, year, accessions)
+  SELECT 'acqdate', genus, origcty,
+         date_part('year', acqdate)::integer, count(*)
+  FROM lis_germplasm.grin_accession
+  GROUP BY 1, 2, 3, 4
+  UNION ALL
+  SELECT 'colldate', genus, origcty,
+         date_part('year', colldate)::integer, count(*)
+  FROM lis_germplasm.grin_accession
+  GROUP BY 1, 2, 3, 4;
+  $$;
+
+CREATE INDEX grin_accession_timeline_genus_idx ON grin_accession_timeline USING btree (date_field, lower(genus));
+
+CREATE INDEX grin_accession_acqdate_idx ON grin_accession USING btree (acqdate) WHERE (acqdate IS NOT NULL);
+
+CREATE INDEX grin_accession_colldate_idx ON grin_accession USING btree (colldate) WHERE (colldate IS NOT NULL);
+
+GRANT ALL ON TABLE grin_accession_timeline TO www;
+GRANT ALL ON TABLE grin_accession_timeline TO staff;
+
+SELECT grin_accession_timeline_refresh();
+
+COMMIT;
+
+ANALYZE grin_accession;
+ANALYZE grin_accession_timeline;